@@ -0,0 +1,227 @@
+"""
+聊天服务端到端压测
+
+在本进程内启动 main.app（使用 FakeBackend 模拟LLM，临时SQLite数据库），
+模拟 N 个并发用户依次调用 /login、/generate_temp_token 和多轮 /chat_stream，
+统计首字节时间、块间延迟、p50/p95/p99、请求吞吐、事件循环延迟和 RSS，结果写入 JSON 文件。
+
+用法:
+    python -m benchmarks.bench_chat --users 200 --turns 5 --output bench_chat.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LLM_BACKEND", "fake")
+
+import httpx
+import uvicorn
+
+import utils.sqlite_manager as sqlite_manager
+from utils.llm_backend import FakeBackend, set_llm_backend
+
+BENCH_AVATAR_ID = "002"  # 初始化数据中 memory_version=0 的角色，避免加载记忆文件
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p95_ms": round(pick(0.95) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def current_rss_mb():
+    """当前常驻内存（MB），优先读取 /proc，其它平台退化为峰值RSS"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ServerThread(threading.Thread):
+    """在独立线程/事件循环中运行 uvicorn，同时采样该事件循环的调度延迟"""
+
+    def __init__(self, app, port, lag_interval=0.01):
+        super().__init__(daemon=True)
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        self.lag_interval = lag_interval
+        self.lag_samples = []
+
+    async def _monitor_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.lag_interval)
+            self.lag_samples.append(max(0.0, loop.time() - start - self.lag_interval))
+
+    async def _serve(self):
+        monitor = asyncio.create_task(self._monitor_lag())
+        try:
+            await self.server.serve()
+        finally:
+            monitor.cancel()
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    def wait_started(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline:
+                raise RuntimeError("server failed to start")
+            time.sleep(0.05)
+
+
+def prepare_database(db_path, users):
+    sqlite_manager.DB_FILE = db_path
+    if not os.path.exists(db_path):
+        sqlite_manager.init_db()
+        sqlite_manager.init_insert_data()
+    for unionid in users:
+        sqlite_manager.insert_or_update_table("users", unionid=unionid, nickname=unionid)
+
+
+async def run_user(client, unionid, turns, metrics):
+    start = time.perf_counter()
+    response = await client.post("/login", json={"unionid": unionid})
+    metrics["login"].append(time.perf_counter() - start)
+    response.raise_for_status()
+
+    start = time.perf_counter()
+    response = await client.post("/generate_temp_token", json={"unionid": unionid})
+    metrics["token"].append(time.perf_counter() - start)
+    response.raise_for_status()
+
+    for turn in range(turns):
+        body = {"unionid": unionid, "avatar_id": BENCH_AVATAR_ID, "prompt": f"第{turn}轮：今天过得怎么样？", "memory_prompt": []}
+        start = time.perf_counter()
+        last = None
+        frames = 0
+        try:
+            async with client.stream("POST", "/chat_stream", json=body) as response:
+                if response.status_code != 200:
+                    metrics["errors"].append(response.status_code)
+                    continue
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    now = time.perf_counter()
+                    if last is None:
+                        metrics["ttfb"].append(now - start)
+                    else:
+                        metrics["inter_chunk"].append(now - last)
+                    last = now
+                    frames += 1
+                    if json.loads(line).get("endpoint"):
+                        break
+        except httpx.HTTPError as e:
+            metrics["errors"].append(type(e).__name__)
+            continue
+        metrics["stream_total"].append(time.perf_counter() - start)
+        metrics["frames"].append(frames)
+
+
+async def run_benchmark(args):
+    users = [f"bench_{i:05d}" for i in range(args.users)]
+    workdir = tempfile.mkdtemp(prefix="matesx_bench_")
+    prepare_database(os.path.join(workdir, "users.db"), users)
+    set_llm_backend(FakeBackend(ttft=args.ttft, token_rate=args.token_rate, reply_tokens=args.reply_tokens,
+                                error_rate=args.error_rate, seed=args.seed))
+
+    import utils.session_snapshot as session_snapshot
+    session_snapshot.SESSION_SNAPSHOT_DB = os.path.join(workdir, "sessions_snapshot.db")
+    import utils.memory_job_queue as memory_job_queue
+    memory_job_queue.MEMORY_JOB_DB = os.path.join(workdir, "memory_jobs.db")
+    import main
+    prepare_database(sqlite_manager.DB_FILE, [])  # main 导入时可能已初始化，确保基础数据存在
+
+    async def fake_token():
+        return {"token": "st-bench", "expires_at": int(time.time()) + 60}
+    main.get_temp_token_from_dashscope = fake_token
+
+    server = ServerThread(main.app, args.port)
+    server.start()
+    server.wait_started()
+    rss_before = current_rss_mb()
+
+    metrics = {k: [] for k in ("login", "token", "ttfb", "inter_chunk", "stream_total", "frames", "errors")}
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", limits=limits, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(run_user(client, unionid, args.turns, metrics) for unionid in users))
+        elapsed = time.perf_counter() - start
+
+    rss_after = current_rss_mb()
+    server.server.should_exit = True
+    server.join(timeout=10)
+
+    completed = len(metrics["stream_total"])
+    return {
+        "config": vars(args),
+        "elapsed_s": round(elapsed, 3),
+        "chat_streams_completed": completed,
+        "chat_streams_per_s": round(completed / elapsed, 3) if elapsed else 0,
+        "requests_per_s": round((completed + len(metrics["login"]) + len(metrics["token"])) / elapsed, 3) if elapsed else 0,
+        "errors": len(metrics["errors"]),
+        "error_kinds": sorted({str(e) for e in metrics["errors"]}),
+        "login": percentiles(metrics["login"]),
+        "generate_temp_token": percentiles(metrics["token"]),
+        "ttfb": percentiles(metrics["ttfb"]),
+        "inter_chunk": percentiles(metrics["inter_chunk"]),
+        "stream_total": percentiles(metrics["stream_total"]),
+        "frames_per_stream": round(sum(metrics["frames"]) / completed, 2) if completed else 0,
+        "event_loop_lag": percentiles(server.lag_samples),
+        "rss_mb": {"before": round(rss_before, 1), "after": round(rss_after, 1)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MatesX 聊天服务端到端压测")
+    parser.add_argument("--users", type=int, default=50, help="并发模拟用户数")
+    parser.add_argument("--turns", type=int, default=3, help="每个用户的对话轮数")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--ttft", type=float, default=0.2, help="模拟LLM首字延迟（秒）")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="模拟LLM每秒增量数")
+    parser.add_argument("--reply-tokens", type=int, default=40, help="每次回复的增量个数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟LLM错误率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_chat.json", help="结果JSON文件路径")
+    parser.add_argument("--verbose", action="store_true", help="显示服务端打印输出")
+    args = parser.parse_args()
+
+    # 服务端逐请求打印日志，压测时默认静默以免干扰计时
+    sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with sink:
+        result = asyncio.run(run_benchmark(args))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+记忆检索基准：精确检索与 IVF 近似检索的召回率 / 延迟对比，以及 int8 量化向量的召回率 / 文件大小
+
+生成带聚类结构的合成向量（模拟同一话题的记忆彼此相近），查询为已有记忆加噪声（模拟换一种说法），
+对不同记忆条数和 nprobe 统计单次查询延迟 p50/p95 以及 recall@k（以精确检索的前 k 条为准），
+并对比 float16 / int8 两种向量编码的 memory.bin 大小、解析时间、精确检索延迟（int8 直接在码上计算）
+和 int8 精确检索的 recall@k，结果写入 JSON 文件。
+
+用法:
+    python -m benchmarks.bench_memory_search --sizes 2000 10000 50000 --queries 200 --output bench_memory_search.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import utils.memory_store as memory_store
+from utils.memory_format import build_memory_bin, parse_memory_bin
+from utils.memory_index import list_count, train_centroids
+from utils.memory_store import MemoryStore
+
+
+def synthetic_memories(size, dim, topics, noise, rng):
+    """每条记忆 = 所属话题中心 + 高斯噪声"""
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    labels = rng.integers(0, topics, size)
+    vectors = centers[labels] + noise * rng.standard_normal((size, dim)).astype(np.float32)
+    return vectors
+
+
+def percentiles(values):
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p95_ms": round(pick(0.95) * 1000, 3),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+def timed_search(store, queries, k, exact):
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(store.search([query], k=k, threshold=-1.0, exact=exact)[0])
+        latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def bench_quantization(store, queries, truth, k):
+    """两种向量编码的文件大小 / 解析时间 / 精确检索延迟，以及 int8 编码下精确检索相对 float32 的 recall@k"""
+    result = {}
+    for encoding in ("float16", "int8"):
+        data = bytes(build_memory_bin("bench", 1, 0, 0, store, vector_encoding=encoding))
+        start = time.perf_counter()
+        _, parsed = parse_memory_bin(data)
+        result[encoding] = {"bytes": len(data), "parse_ms": round((time.perf_counter() - start) * 1000, 3)}
+        hits, latencies = timed_search(parsed, queries, k, exact=True)
+        result[encoding]["search"] = percentiles(latencies)
+    recall = np.mean([len(expected & {index for index, _ in found}) / len(expected)
+                      for expected, found in zip(truth, hits) if expected])
+    result["int8"]["recall"] = round(float(recall), 4)
+    result["size_ratio"] = round(result["float16"]["bytes"] / result["int8"]["bytes"], 2)
+    return result
+
+
+def bench_size(size, args, rng):
+    vectors = synthetic_memories(size, args.dim, max(1, size // args.topic_size), args.noise, rng)
+    store = MemoryStore(args.dim)
+    store.extend(vectors, [""] * size)
+    picks = rng.integers(0, size, args.queries)
+    queries = vectors[picks] + args.query_noise * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+
+    exact_results, exact_latencies = timed_search(store, queries, args.k, exact=True)
+    truth = [{index for index, _ in hits} for hits in exact_results]
+    quantization = bench_quantization(store, queries, truth, args.k)
+
+    start = time.perf_counter()
+    store.set_centroids(train_centroids(store.vectors, list_count(size)))
+    train_seconds = time.perf_counter() - start
+
+    result = {
+        "size": size,
+        "lists": len(store.centroids),
+        "train_s": round(train_seconds, 3),
+        "exact": percentiles(exact_latencies),
+        "quantization": quantization,
+        "ann": [],
+    }
+    for nprobe in args.nprobe:
+        memory_store.MEMORY_ANN_NPROBE = nprobe
+        ann_results, ann_latencies = timed_search(store, queries, args.k, exact=False)
+        recall = np.mean([len(expected & {index for index, _ in hits}) / len(expected)
+                          for expected, hits in zip(truth, ann_results) if expected])
+        result["ann"].append({"nprobe": nprobe, "recall": round(float(recall), 4), **percentiles(ann_latencies)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MatesX 记忆检索召回率/延迟基准")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[2000, 10000, 50000], help="记忆条数")
+    parser.add_argument("--queries", type=int, default=200, help="每种条数的查询次数")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="检索的聚类数")
+    parser.add_argument("--topic-size", type=int, default=20, help="每个话题的平均记忆条数")
+    parser.add_argument("--noise", type=float, default=1.2, help="记忆相对话题中心的噪声")
+    parser.add_argument("--query-noise", type=float, default=0.5, help="查询相对原记忆的噪声")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_memory_search.json", help="结果JSON文件路径")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    result = {"config": vars(args), "results": [bench_size(size, args, rng) for size in args.sizes]}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
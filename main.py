@@ -6,19 +6,43 @@ import os
 import asyncio
 from contextlib import asynccontextmanager
 from fastapi.responses import StreamingResponse, JSONResponse,Response
-from utils.llm_streaming import gen_stream
-from utils.session_manager import cleanup_expired_sessions,user_locks,get_or_create_session
+from starlette.background import BackgroundTask
+from utils.llm_streaming import gen_stream, gen_cached_stream
+from utils.response_cache import response_cache, RESPONSE_CACHE_ENABLED
+from utils.llm_backend import close_llm_backend, get_llm_backend
+from utils.embedding_cache import get_cached_embeddings
+from utils.session_manager import cleanup_expired_sessions,session_store,user_session_lock,load_session,commit_session,start_memory_jobs,drain_memory_jobs
+from utils.session_snapshot import load_snapshot, save_snapshot, snapshot_sessions_periodically
+from utils.admission import llm_admission, user_key, AdmissionRejected, PRIORITY_INTERACTIVE
+from utils.context_builder import build_context
+import utils.memory_segments as memory_segments
+import utils.memory_index as memory_index
 import utils.sqlite_manager as sqlite_manager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    cleanup_task = asyncio.create_task(cleanup_expired_sessions())
+    # 继续处理上次运行遗留的记忆任务
+    start_memory_jobs()
+    tasks = [asyncio.create_task(cleanup_expired_sessions())]
+    # 共享会话存储本身就是持久化的，只有进程内存储需要快照
+    if session_store is None:
+        # 恢复上次运行留下的会话快照
+        print(f"从快照恢复 {load_snapshot()} 个会话")
+        tasks.append(asyncio.create_task(snapshot_sessions_periodically()))
     yield
-    cleanup_task.cancel()
-    try:
-        await cleanup_task
-    except asyncio.CancelledError:
-        pass
+    for task in tasks:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    # 关闭前写入最后一次快照，并等待已提交的记忆处理完成
+    if session_store is None:
+        await save_snapshot()
+    else:
+        await session_store.aclose()
+    await drain_memory_jobs()
+    await close_llm_backend()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -35,39 +59,78 @@ async def upload_memory_bin(avatar_id: str, request: Request):
         memory_data = await request.body()
         if not memory_data:
             raise HTTPException(status_code=400, detail="No data received")
-        path = Path(f"assets/{avatar_id}")
-        path.mkdir(parents=True, exist_ok=True)
-        file_path = path / "memory.bin"
-        with open(file_path, "wb") as f:
-            f.write(memory_data)
+        # 写入前先校验，避免截断或损坏的上传覆盖已有记忆
+        try:
+            await asyncio.to_thread(memory_segments.write_snapshot, avatar_id, memory_data)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         return JSONResponse(
-            content={"message": "Upload successful", "path": str(file_path)},
+            content={"message": "Upload successful", "path": memory_segments.base_key(avatar_id)},
             status_code=200
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
+async def _stream_memory_file(key, filename):
+    """从记忆存储流式返回文件，不在内存中缓冲整个文件"""
+    try:
+        chunks = await asyncio.to_thread(memory_segments.storage.stream, key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
+    if chunks is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return StreamingResponse(
+        chunks,
+        media_type="application/octet-stream",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}"
+        }
+    )
+
 @app.get("/api/assets/{avatar_id}/memory.bin")
 async def download_memory_bin(avatar_id: str):
+    return await _stream_memory_file(memory_segments.base_key(avatar_id), "memory.bin")
+
+@app.get("/api/assets/{avatar_id}/memory.index")
+async def download_memory_index(avatar_id: str):
+    """近似检索索引（聚类中心和聚类分配），只有记忆条数较多的角色才有"""
+    return await _stream_memory_file(memory_index.index_key(avatar_id), "memory.index")
+
+@app.get("/api/assets/{avatar_id}/memory.manifest")
+async def memory_manifest(avatar_id: str):
+    """记忆存储状态：基准快照版本和之后的增量段列表，客户端据此只下载本地版本之后的增量段"""
     try:
-        file_path = Path(f"assets/{avatar_id}/memory.bin")
-        if not file_path.exists():
-            raise HTTPException(status_code=404, detail="File not found")
-        # 读取二进制数据
-        with open(file_path, "rb") as f:
-            data = f.read()
-        # 返回二进制响应
-        return Response(
-            content=data,
-            media_type="application/octet-stream",
-            headers={
-                "Content-Disposition": f"attachment; filename=memory.bin"
-            }
-        )
+        return await asyncio.to_thread(memory_segments.manifest, avatar_id)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=f"Invalid memory.bin: {str(e)}")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
+@app.put("/api/assets/{avatar_id}/memory.delta")
+async def upload_memory_delta(avatar_id: str, request: Request):
+    """追加一个增量段；基准版本不是最新版本时返回 409，增量段过多时在后台合并"""
+    memory_data = await request.body()
+    if not memory_data:
+        raise HTTPException(status_code=400, detail="No data received")
+    try:
+        version = await asyncio.to_thread(memory_segments.append_delta, avatar_id, memory_data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except memory_segments.MemoryVersionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return JSONResponse(
+        content={"message": "Upload successful", "version": version},
+        status_code=200,
+        background=BackgroundTask(memory_segments.compact_if_needed, avatar_id)
+    )
+
+@app.get("/api/assets/{avatar_id}/memory.delta/{version}")
+async def download_memory_delta(avatar_id: str, version: int):
+    # 404 表示已被合并进基准快照，客户端应重新读取 manifest
+    return await _stream_memory_file(memory_segments.delta_key(avatar_id, version), f"{version}.bin")
 
 DB_FILE = 'users.db'
 # 初始化数据库（如果不存在则创建）
@@ -133,6 +196,39 @@ async def generate_temp_token(data: dict = Body(...)):
             detail=f"Internal server error: {str(e)}"
         )
 
+EMBEDDING_API_MAX_TEXTS = 32  # /embeddings 单次请求的最大文本数
+
+
+@app.post("/embeddings")
+async def embeddings(data: dict = Body(...)):
+    """
+    获取文本的嵌入向量（经共享的嵌入缓存，只有未命中的文本请求上游），前端检索记忆时使用
+    请求: { "unionid": "...", "texts": ["..."] }，返回: { "embeddings": [[...], ...] }
+    """
+    unionid = data.get("unionid")
+    texts = data.get("texts")
+    if not unionid:
+        raise HTTPException(400, detail="unionid不能为空")
+    if not isinstance(texts, list) or not texts or len(texts) > EMBEDDING_API_MAX_TEXTS \
+            or not all(isinstance(text, str) for text in texts):
+        raise HTTPException(400, detail=f"texts必须是1到{EMBEDDING_API_MAX_TEXTS}个字符串")
+    if sqlite_manager.get_user_by_unionid(unionid) is None:
+        raise HTTPException(404, detail="用户不存在")
+
+    try:
+        vectors = await asyncio.to_thread(
+            get_cached_embeddings, get_llm_backend(), texts,
+            admission=lambda: llm_admission.slot_sync(user_key(unionid), PRIORITY_INTERACTIVE))
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    return {"embeddings": [vector.astype(float).tolist() for vector in vectors]}
+
 @app.post("/chat_stream")
 async def chat_stream(request: Request):
     print("chat_stream")
@@ -148,23 +244,43 @@ async def chat_stream(request: Request):
         user_prompt = body.get("prompt")
         memory_prompt = body.get("memory_prompt")
 
-        async with user_locks[unionid]:  # 获取用户级锁
+        async with user_session_lock(unionid):  # 获取用户级锁
             # 获取或创建会话
-            session = get_or_create_session(unionid, avatar_id, memory_prompt)
+            session = await load_session(unionid, avatar_id, memory_prompt)
             print("****",session)
-            # 构建符合OpenAI格式的消息数组
-            messages = [
-                {"role": "system", "content": session.combined_prompt},
-                *session.messages[-100:],  # 保留最近50轮对话（100条消息）
-                {"role": "user", "content": user_prompt}
-            ]
+            # 构建符合OpenAI格式的消息数组，历史按token预算从新到旧填充
+            messages = build_context(session, user_prompt)
+            await commit_session(unionid, avatar_id, session)
+        # 常见短句命中回复缓存时直接回放，不占用上游名额
+        if RESPONSE_CACHE_ENABLED:
+            cached_reply = await response_cache.lookup(
+                avatar_id, messages, admission=lambda: llm_admission.slot_sync(user_key(unionid), PRIORITY_INTERACTIVE))
+            if cached_reply is not None:
+                return StreamingResponse(
+                    gen_cached_stream(unionid, avatar_id, user_prompt, cached_reply),
+                    media_type="application/json"
+                )
+
+        # 申请上游LLM调用名额，排队超限时快速返回 429/503
+        try:
+            ticket = await llm_admission.acquire(user_key(unionid), PRIORITY_INTERACTIVE)
+        except AdmissionRejected as e:
+            raise HTTPException(
+                status_code=e.status_code,
+                detail=str(e),
+                headers={"Retry-After": str(e.retry_after)}
+            )
         return StreamingResponse(
             gen_stream(
                 unionid = unionid,
                 avatar_id = avatar_id,
                 messages=messages,
+                is_disconnected=request.is_disconnected,
+                ticket=ticket,
             ),
-            media_type="application/json"
+            media_type="application/json",
+            # 生成器未被消费（如客户端提前断开）时也能归还名额
+            background=BackgroundTask(ticket.release)
         )
     except HTTPException as e:
         raise e  # 直接重新抛出原有异常
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from utils.admission import (AdmissionController, AdmissionRejected, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE,
+                             avatar_key, user_key)
+
+
+def make_controller(**kwargs):
+    options = dict(max_concurrency=1, weights={PRIORITY_INTERACTIVE: 2, PRIORITY_BACKGROUND: 1},
+                   max_queue_wait={PRIORITY_INTERACTIVE: 100.0, PRIORITY_BACKGROUND: 100.0}, max_pending_per_key=4)
+    options.update(kwargs)
+    return AdmissionController(**options)
+
+
+def test_user_and_avatar_keys_do_not_collide():
+    assert user_key("001") != avatar_key("001")
+    controller = make_controller(max_concurrency=8, max_pending_per_key=2)
+    tickets = [controller.acquire_sync(user_key("001"), PRIORITY_INTERACTIVE) for _ in range(2)]
+    with pytest.raises(AdmissionRejected):
+        controller.acquire_sync(user_key("001"), PRIORITY_INTERACTIVE)
+    # 同名角色的后台任务不受该用户名额影响
+    tickets.append(controller.acquire_sync(avatar_key("001")))
+    for ticket in tickets:
+        ticket.release()
+    assert controller.stats()["active"] == 0
+
+
+def test_per_key_limit_rejects_with_429():
+    controller = make_controller(max_concurrency=8, max_pending_per_key=1)
+    ticket = controller.acquire_sync(user_key("u"), PRIORITY_INTERACTIVE)
+    with pytest.raises(AdmissionRejected) as excinfo:
+        controller.acquire_sync(user_key("u"), PRIORITY_INTERACTIVE)
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.retry_after >= 1
+    ticket.release()
+    controller.acquire_sync(user_key("u"), PRIORITY_INTERACTIVE).release()
+
+
+def test_expected_queue_wait_rejects_with_503():
+    controller = make_controller(max_queue_wait={PRIORITY_INTERACTIVE: 0.5, PRIORITY_BACKGROUND: 0.5})
+    ticket = controller.acquire_sync(user_key("a"), PRIORITY_INTERACTIVE)
+    # 名额已满，预计排队 1 个平均耗时（初始 1 秒）超过 0.5 秒期限
+    with pytest.raises(AdmissionRejected) as excinfo:
+        controller.acquire_sync(user_key("b"), PRIORITY_INTERACTIVE)
+    assert excinfo.value.status_code == 503
+    assert controller.stats()["rejected"] == 1
+    ticket.release()
+
+
+def test_queue_timeout_rejects_with_503():
+    controller = make_controller(max_queue_wait={PRIORITY_INTERACTIVE: 100.0, PRIORITY_BACKGROUND: 0.05})
+    ticket = controller.acquire_sync(user_key("a"), PRIORITY_INTERACTIVE)
+    with pytest.raises(AdmissionRejected) as excinfo:
+        controller.acquire_sync(avatar_key("x"), PRIORITY_BACKGROUND)
+    assert excinfo.value.status_code == 503
+    assert controller.stats()["queued"] == 0
+    ticket.release()
+
+
+def test_dispatch_is_weighted_by_priority_and_round_robin_by_key():
+    async def run():
+        controller = make_controller()
+        holder = await controller.acquire(user_key("holder"))
+        order = []
+
+        async def request(key, priority):
+            ticket = await controller.acquire(key, priority)
+            order.append(key)
+            ticket.release()
+
+        requests = [(user_key("a"), PRIORITY_INTERACTIVE)] * 3 + [(user_key("b"), PRIORITY_INTERACTIVE)] * 3 + \
+            [(avatar_key("x"), PRIORITY_BACKGROUND)] * 3
+        tasks = []
+        for key, priority in requests:
+            tasks.append(asyncio.create_task(request(key, priority)))
+            await asyncio.sleep(0)  # 按顺序入队
+        assert controller.stats()["queued"] == len(requests)
+        holder.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    # 权重 2:1 的平滑加权轮询；同一优先级内用户 a、b 交替，不因 a 先入队而连续放行
+    assert order == [user_key("a"), avatar_key("x"), user_key("b"), user_key("a"), avatar_key("x"),
+                     user_key("b"), user_key("a"), avatar_key("x"), user_key("b")]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        controller = make_controller()
+        holder = await controller.acquire(user_key("holder"))
+        task = asyncio.create_task(controller.acquire(user_key("a")))
+        await asyncio.sleep(0)
+        assert controller.stats()["queued"] == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        stats = controller.stats()
+        holder.release()
+        return stats, controller.stats()
+
+    while_waiting, after = asyncio.run(run())
+    assert while_waiting["queued"] == 0
+    assert after["active"] == 0
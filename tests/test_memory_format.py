@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+
+from utils.memory_format import (build_memory_bin, build_memory_delta, load_memory_file, parse_memory_bin,
+                                 parse_memory_delta, parse_memory_header, read_v2_sections, SECTION_TEXTS,
+                                 SECTION_VECTOR_SCALES, SECTION_VECTORS, SECTION_VECTORS_INT8)
+from utils.memory_store import MemoryStore, quantize_int8
+
+TEXTS = ["用户叫张三", "住在北京朝阳区", "", "喜欢爬山和摄影 🏔"]
+
+
+def make_store(dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    # float16 可精确表示的向量，round trip 后应完全相同
+    vectors = rng.standard_normal((len(TEXTS), dim)).astype(np.float16).astype(np.float32)
+    store = MemoryStore(dim)
+    store.extend(vectors, TEXTS, frequency=[1, 2, 3, 4], created_at=[10, 20, 30, 40], updated_at=[11, 21, 31, 41])
+    return store
+
+
+def assert_same_entries(actual, expected):
+    assert len(actual) == len(expected)
+    np.testing.assert_array_equal(actual.vectors, expected.vectors)
+    np.testing.assert_array_equal(actual.frequency, expected.frequency)
+    np.testing.assert_array_equal(actual.created_at, expected.created_at)
+    np.testing.assert_array_equal(actual.updated_at, expected.updated_at)
+    assert list(actual.texts) == list(expected.texts)
+
+
+@pytest.mark.parametrize("format_version", [1, 2])
+def test_round_trip(format_version):
+    store = make_store()
+    data = bytes(build_memory_bin("001", 7, 100, 200, store, format_version=format_version))
+    header, parsed = parse_memory_bin(data)
+    assert header["format_version"] == format_version
+    assert (header["avatar_id"], header["memory_version"], header["created_at"], header["updated_at"]) == \
+        ("001", 7, 100, 200)
+    assert (header["num_entries"], header["dim"]) == (len(TEXTS), 16)
+    assert_same_entries(parsed, store)
+    assert parse_memory_header(data[:256])["memory_version"] == 7
+
+
+def test_empty_store_round_trip():
+    header, parsed = parse_memory_bin(bytes(build_memory_bin("001", 1, 0, 0, MemoryStore(16))))
+    assert header["num_entries"] == 0 and len(parsed) == 0
+
+
+def test_reencoding_is_byte_identical():
+    data = bytes(build_memory_bin("001", 7, 100, 200, make_store()))
+    _, parsed = parse_memory_bin(data)
+    assert bytes(build_memory_bin("001", 7, 100, 200, parsed)) == data
+
+
+def test_sections_are_aligned():
+    data = bytes(build_memory_bin("001", 7, 100, 200, make_store()))
+    _, sections = read_v2_sections(data)
+    assert all(offset % 64 == 0 for offset, _, _ in sections.values())
+
+
+def test_load_memory_file_maps_the_file(tmp_path):
+    path = tmp_path / "memory.bin"
+    path.write_bytes(build_memory_bin("001", 7, 100, 200, make_store()))
+    _, parsed = load_memory_file(path)
+    assert_same_entries(parsed, make_store())
+
+
+@pytest.mark.parametrize("section_id", [SECTION_VECTORS, SECTION_TEXTS])
+def test_corrupted_section_is_rejected(section_id):
+    data = bytearray(build_memory_bin("001", 7, 100, 200, make_store()))
+    _, sections = read_v2_sections(data)
+    offset, length, _ = sections[section_id]
+    data[offset + length // 2] ^= 0xFF
+    with pytest.raises(ValueError, match="checksum"):
+        parse_memory_bin(bytes(data))
+    # 跳过区校验时仍能解析（头部始终校验）
+    parse_memory_bin(bytes(data), verify=False)
+
+
+def test_corrupted_header_is_rejected():
+    data = bytearray(build_memory_bin("001", 7, 100, 200, make_store()))
+    data[12] ^= 0x01  # memory_version
+    with pytest.raises(ValueError, match="header checksum"):
+        parse_memory_bin(bytes(data))
+    with pytest.raises(ValueError):
+        parse_memory_header(bytes(data))
+
+
+@pytest.mark.parametrize("format_version", [1, 2])
+def test_truncated_file_is_rejected(format_version):
+    data = bytes(build_memory_bin("001", 7, 100, 200, make_store(), format_version=format_version))
+    for size in (3, 40, len(data) // 2, len(data) - 1):
+        with pytest.raises(ValueError):
+            parse_memory_bin(data[:size])
+
+
+def test_int8_round_trip():
+    store = make_store()
+    data = bytes(build_memory_bin("001", 7, 100, 200, store, vector_encoding="int8"))
+    _, sections = read_v2_sections(data)
+    assert SECTION_VECTORS_INT8 in sections and SECTION_VECTORS not in sections
+    _, parsed = parse_memory_bin(data)
+    # 解析后直接保存 int8 码，不还原为浮点向量
+    assert parsed.quantized and parsed.codes.dtype == np.int8
+    codes, scales = quantize_int8(store.vectors)
+    np.testing.assert_array_equal(parsed.codes, codes)
+    np.testing.assert_array_equal(parsed.scales, scales)
+    cosine = np.einsum("ij,ij->i", parsed.vectors, store.vectors) / \
+        (np.linalg.norm(parsed.vectors, axis=1) * np.linalg.norm(store.vectors, axis=1))
+    assert cosine.min() > 0.999
+    assert list(parsed.texts) == TEXTS
+    np.testing.assert_array_equal(parsed.frequency, store.frequency)
+    # 再次保存时写出原有的码，结果逐字节相同
+    assert bytes(build_memory_bin("001", 7, 100, 200, parsed, vector_encoding="int8")) == data
+
+
+def test_int8_scores_are_computed_on_the_codes():
+    _, parsed = parse_memory_bin(bytes(build_memory_bin("001", 7, 100, 200, make_store(), vector_encoding="int8")))
+    queries = np.random.default_rng(1).standard_normal((3, 16)).astype(np.float32)
+    vectors = parsed.vectors
+    expected = (queries @ vectors.T) / np.outer(np.linalg.norm(queries, axis=1), np.linalg.norm(vectors, axis=1))
+    np.testing.assert_allclose(parsed.similarities(queries), expected, rtol=1e-5, atol=1e-6)
+    best = [hits[0][0] for hits in parsed.search(queries, k=1, threshold=-1)]
+    assert best == np.argmax(expected, axis=1).tolist()
+
+
+def test_int8_delta_applies_to_a_quantized_store():
+    data = bytes(build_memory_bin("001", 1, 0, 0, make_store(), vector_encoding="int8"))
+    _, head = parse_memory_bin(data)
+    head.mark_clean()
+    head.delete([1])
+    head.update(0, text="改过的文本")
+    head.append(np.ones(16, dtype=np.float32), "新记忆")
+    deletions, ids = head.changes()
+    delta = bytes(build_memory_delta("001", 1, 2, 0, 0, head, deletions, ids, vector_encoding="int8"))
+
+    _, base = parse_memory_bin(data)
+    _, deletions, ids, rows = parse_memory_delta(delta)
+    base.apply_changes(deletions, ids, rows)
+    assert base.quantized
+    np.testing.assert_array_equal(base.codes, head.codes)
+    np.testing.assert_array_equal(base.scales, head.scales)
+    assert list(base.texts) == list(head.texts)
+    # 量化的记忆库也可以保存为 float16
+    _, converted = parse_memory_bin(bytes(build_memory_bin("001", 2, 0, 0, base, vector_encoding="float16")))
+    assert not converted.quantized
+    np.testing.assert_allclose(converted.vectors, base.vectors, rtol=1e-3, atol=1e-3)
+
+
+@pytest.mark.parametrize("section_id", [SECTION_VECTORS_INT8, SECTION_VECTOR_SCALES])
+def test_corrupted_int8_section_is_rejected(section_id):
+    data = bytearray(build_memory_bin("001", 7, 100, 200, make_store(), vector_encoding="int8"))
+    _, sections = read_v2_sections(data)
+    offset, length, _ = sections[section_id]
+    data[offset + length // 2] ^= 0xFF
+    with pytest.raises(ValueError, match="checksum"):
+        parse_memory_bin(bytes(data))
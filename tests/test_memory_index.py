@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+import utils.memory_index as memory_index
+import utils.memory_segments as memory_segments
+from utils.memory_format import build_memory_index, parse_memory_index, read_v2_sections, SECTION_LISTS
+from utils.memory_storage import InMemoryStorage
+from utils.memory_store import MEMORY_ANN_MIN_ENTRIES, MemoryStore
+
+DIM = 32
+
+
+def clustered_vectors(count, clusters=50, seed=0):
+    """围绕若干个随机中心分布的向量，近似真实文本向量的聚类结构"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, DIM))
+    vectors = centers[rng.integers(clusters, size=count)] + 0.3 * rng.standard_normal((count, DIM))
+    return vectors.astype(np.float16).astype(np.float32)
+
+
+def make_store(count=3000, seed=0):
+    store = MemoryStore(DIM)
+    store.extend(clustered_vectors(count, seed=seed), [f"记忆 {i}" for i in range(count)])
+    return store
+
+
+def make_indexed_store(count=3000):
+    store = make_store(count)
+    store.set_centroids(memory_index.train_centroids(store.vectors, memory_index.list_count(len(store))))
+    return store
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = InMemoryStorage()
+    monkeypatch.setattr(memory_segments, "storage", storage)
+    return storage
+
+
+def test_index_round_trip():
+    store = make_indexed_store()
+    header, centroids, lists = parse_memory_index(bytes(build_memory_index("001", 7, store)))
+    assert (header["avatar_id"], header["memory_version"], header["num_entries"], header["dim"]) == \
+        ("001", 7, len(store), DIM)
+    # 聚类中心以 float16 保存
+    np.testing.assert_allclose(centroids, store.centroids, atol=1e-3)
+    np.testing.assert_array_equal(lists, store.lists)
+
+
+def test_corrupted_index_is_rejected():
+    data = bytearray(build_memory_index("001", 1, make_indexed_store()))
+    _, sections = read_v2_sections(data)
+    offset, _, _ = sections[SECTION_LISTS]
+    data[offset] ^= 0xFF
+    with pytest.raises(ValueError):
+        parse_memory_index(bytes(data))
+    with pytest.raises(ValueError):
+        parse_memory_index(bytes(data[:len(data) // 2]))
+    with pytest.raises(ValueError):
+        parse_memory_index(b"MXMEMBIN" + bytes(data[8:]))
+
+
+def test_ann_recall_against_exact():
+    store = make_indexed_store()
+    rng = np.random.default_rng(1)
+    queries = store.vectors[rng.choice(len(store), 200, replace=False)] + 0.1 * rng.standard_normal((200, DIM))
+    approximate = store.search(queries, k=5, threshold=-1)
+    exact = store.search(queries, k=5, threshold=-1, exact=True)
+    hits = sum(len({i for i, _ in a} & {i for i, _ in e}) for a, e in zip(approximate, exact))
+    assert hits / (5 * len(queries)) >= 0.95
+    # 近似检索返回的相似度与精确计算一致
+    for query, a in zip(queries[:10], approximate):
+        np.testing.assert_allclose([s for _, s in a], store.similarities(query)[0, [i for i, _ in a]], rtol=1e-5)
+
+
+def test_unassigned_entries_are_always_scored():
+    store = make_indexed_store()
+    lists = store.lists.copy()
+    lists[123] = -1
+    store.set_centroids(store.centroids, lists)
+    # 查询向量与第 123 条方向相反的聚类无关：未分配聚类的记忆始终参与计算
+    far = int(np.argmin(store.centroids @ store.vectors[123]))
+    lists[123] = far
+    query = store.vectors[123]
+    assert store.search(query, k=1, threshold=-1)[0][0][0] == 123
+    store.set_centroids(store.centroids, lists)
+    assert store.search(query, k=1, threshold=-1)[0][0][0] != 123
+
+
+def test_new_entries_are_assigned_to_the_nearest_list():
+    store = make_indexed_store()
+    vectors = clustered_vectors(10, seed=2)
+    store.extend(vectors, [f"新记忆 {i}" for i in range(10)])
+    np.testing.assert_array_equal(store.lists[-10:], np.argmax(vectors @ store.centroids.T, axis=1))
+
+
+def test_update_and_load_index(storage):
+    store = make_indexed_store()
+    store.set_centroids(None)
+    assert memory_index.update_index("001", store, 5)
+    assert len(store.centroids) == memory_index.list_count(len(store))
+
+    # 版本一致时直接使用保存的聚类分配
+    loaded = make_store()
+    assert memory_index.load_index("001", loaded, 5)
+    np.testing.assert_array_equal(loaded.lists, store.lists)
+
+    # 版本不一致时只复用聚类中心，重新分配全部条目
+    changed = make_store(seed=3)
+    assert memory_index.load_index("001", changed, 6)
+    np.testing.assert_array_equal(changed.lists, np.argmax(changed.vectors @ changed.centroids.T, axis=1))
+
+
+def test_index_is_skipped_for_small_or_corrupted_stores(storage):
+    small = make_store(MEMORY_ANN_MIN_ENTRIES - 1)
+    assert not memory_index.update_index("001", small, 1)
+    assert storage.get(memory_index.index_key("001")) is None
+
+    store = make_indexed_store()
+    storage.put(memory_index.index_key("001"), b"MXMEMIDX" + bytes(56))
+    assert not memory_index.load_index("001", store, 1)
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+import utils.memory_job_queue as memory_job_queue
+from utils.memory_job_queue import MemoryJobQueue, retry_delay
+from utils.memory_scheduler import MemoryJobScheduler
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(memory_job_queue, "time", clock)
+    return clock
+
+
+def history(tag, count):
+    return [{"role": "user", "content": f"{tag}-{i}"} for i in range(count)]
+
+
+def test_oversized_backlog_is_split_into_successive_jobs(tmp_path, clock):
+    queue = MemoryJobQueue(str(tmp_path / "jobs.db"))
+    queue.enqueue_many([("001", 0, history(tag, 3), 1) for tag in "abc"])
+    processed = []
+    while True:
+        job = queue.lease("w", max_messages=5)
+        if job is None:
+            break
+        # 该角色有租约期间，其余历史不会被其他 worker 取走
+        assert queue.lease("other", max_messages=5) is None
+        processed.extend(message["content"] for message in job.messages)
+        queue.complete(job, "w")
+        clock.now += 1
+    assert processed == [message["content"] for tag in "abc" for message in history(tag, 3)]
+    assert queue.stats()["pending"] == 0
+
+
+def test_single_history_above_the_limit_is_not_truncated(tmp_path, clock):
+    queue = MemoryJobQueue(str(tmp_path / "jobs.db"))
+    queue.enqueue_many([("001", 0, history("a", 8), 1), ("001", 0, history("b", 1), 1)])
+    job = queue.lease("w", max_messages=5)
+    assert len(job.messages) == 8 and job.histories == 1
+
+
+def test_expired_lease_is_taken_over(tmp_path, clock):
+    queue = MemoryJobQueue(str(tmp_path / "jobs.db"), lease_seconds=60)
+    queue.enqueue_many([("001", 0, history("a", 2), 1)])
+    job = queue.lease("crashed")
+    clock.now += 30
+    assert queue.lease("w") is None
+    queue.renew(job, "crashed")
+    clock.now += 59
+    assert queue.lease("w") is None
+    clock.now += 2
+    taken = queue.lease("w")
+    assert taken is not None and taken.ids == job.ids
+    # 原持有者的租约已失效，它的完成记录不会删除任务
+    queue.complete(job, "crashed")
+    assert queue.stats()["pending"] == 1
+    queue.complete(taken, "w")
+    assert queue.stats()["pending"] == 0
+
+
+def test_retry_backoff_and_abandon(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(memory_job_queue.random, "uniform", lambda low, high: 1.0)
+    assert [retry_delay(attempts) for attempts in (1, 2, 3)] == [30, 60, 120]
+    assert retry_delay(20) == memory_job_queue.MEMORY_JOB_RETRY_MAX
+
+    queue = MemoryJobQueue(str(tmp_path / "jobs.db"), max_attempts=3)
+    queue.enqueue_many([("001", 0, history("a", 2), 1)])
+    for attempts, delay in ((1, 30), (2, 60)):
+        job = queue.lease("w")
+        assert job.attempts == attempts - 1
+        assert queue.fail(job, "w", "upstream error") == attempts
+        clock.now += delay - 1
+        assert queue.lease("w") is None  # 退避期内不会重新出队
+        clock.now += 1
+    job = queue.lease("w")
+    assert queue.fail(job, "w", "upstream error") == 3
+    assert queue.lease("w") is None
+    assert queue.stats() == {"pending": 0, "leased": 0, "retrying": 0, "abandoned": 1}
+
+
+def test_shutdown_drain_is_bounded(tmp_path):
+    release = threading.Event()
+    started = threading.Event()
+
+    def runner(avatar_id, messages, histories):
+        started.set()
+        release.wait(10)
+
+    queue = MemoryJobQueue(str(tmp_path / "jobs.db"))
+    scheduler = MemoryJobScheduler(runner, queue=queue, workers=1)
+    scheduler.start()
+    scheduler.submit("001", history("a", 2))
+    assert started.wait(5)
+    begin = time.monotonic()
+    scheduler.shutdown(timeout=0.2)
+    assert time.monotonic() - begin < 2
+    # 仍在运行的任务保留在任务表中，由租约到期后重新处理
+    assert queue.stats()["leased"] == 1
+    release.set()
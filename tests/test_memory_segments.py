@@ -0,0 +1,198 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import utils.memory_segments as memory_segments
+from utils.memory_format import (build_memory_bin, build_memory_delta, parse_memory_delta, read_v2_sections,
+                                 SECTION_ENTRY_IDS)
+from utils.memory_storage import InMemoryStorage, LocalStorage
+from utils.memory_store import MemoryStore
+
+DIM = 8
+
+
+def make_store(texts, seed=0):
+    rng = np.random.default_rng(seed)
+    store = MemoryStore(DIM)
+    store.extend(rng.standard_normal((len(texts), DIM)).astype(np.float16).astype(np.float32), texts)
+    return store
+
+
+def texts_of(store):
+    return [store.texts[i] for i in range(len(store))]
+
+
+def delta_for(store, base_version, avatar_id="001"):
+    deletions, ids = store.changes()
+    return bytes(build_memory_delta(avatar_id, base_version, base_version + 1, 0, 0, store, deletions, ids))
+
+
+def add_text(store, text, seed=1):
+    store.append(np.random.default_rng(seed).standard_normal(DIM).astype(np.float16).astype(np.float32), text)
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = InMemoryStorage()
+    monkeypatch.setattr(memory_segments, "storage", storage)
+    return storage
+
+
+def test_delta_round_trip_applies_deletions_updates_and_appends():
+    base = make_store(["a", "b", "c", "d"])
+    store = make_store(["a", "b", "c", "d"])
+    store.mark_clean()
+    store.delete([1])
+    store.update(1, text="c2", updated_at=5, frequency_increment=2)
+    add_text(store, "e")
+
+    header, deletions, ids, rows = parse_memory_delta(delta_for(store, 3))
+    assert (header["base_version"], header["memory_version"]) == (3, 4)
+    base.apply_changes(deletions, ids, rows)
+    assert texts_of(base) == texts_of(store) == ["a", "c2", "d", "e"]
+    np.testing.assert_array_equal(base.vectors, store.vectors)
+    np.testing.assert_array_equal(base.frequency, store.frequency)
+    np.testing.assert_array_equal(base.updated_at, store.updated_at)
+
+
+def test_corrupted_delta_is_rejected():
+    store = make_store(["a"])
+    store.mark_clean()
+    add_text(store, "b")
+    data = bytearray(delta_for(store, 1))
+    offset, _, _ = read_v2_sections(data)[1][SECTION_ENTRY_IDS]
+    data[offset] ^= 0xFF
+    with pytest.raises(ValueError):
+        parse_memory_delta(bytes(data))
+    with pytest.raises(ValueError):
+        parse_memory_delta(bytes(build_memory_bin("001", 1, 0, 0, store)))  # 不是增量段
+
+
+def test_delta_with_out_of_range_ids_is_rejected():
+    store = make_store(["a"])
+    store.mark_clean()
+    add_text(store, "b")
+    _, deletions, ids, rows = parse_memory_delta(delta_for(store, 1))
+    with pytest.raises(ValueError):
+        MemoryStore(DIM).apply_changes(deletions, ids, rows)  # 基准只有 0 条，ids=[1] 不能追加
+
+
+def test_append_and_compact(storage):
+    store = make_store(["a", "b"])
+    memory_segments.write_snapshot("001", bytes(build_memory_bin("001", 1, 0, 0, store)))
+    store.mark_clean()
+    add_text(store, "c")
+    assert memory_segments.append_delta("001", delta_for(store, 1)) == 2
+    with pytest.raises(memory_segments.MemoryVersionConflict):
+        memory_segments.append_delta("001", delta_for(store, 1))  # 基于过期版本
+    assert memory_segments.manifest("001")["version"] == 2
+
+    assert memory_segments.compact("001", force=True)
+    state = memory_segments.manifest("001")
+    assert (state["base_version"], state["version"], state["deltas"]) == (2, 2, [])
+    version, head, _ = memory_segments.load_head("001")
+    assert version == 2 and texts_of(head) == ["a", "b", "c"]
+
+
+def test_append_detects_a_version_compacted_by_another_process(storage, monkeypatch):
+    """
+    另一个进程在本进程读取 manifest 之后写入了同一版本的增量段并把它合并进基准快照（随后删除了该增量段），
+    本进程的独占写入会成功，但这个增量段永远不会被应用，必须报告冲突而不是静默丢失
+    """
+    memory_segments.write_snapshot("001", bytes(build_memory_bin("001", 1, 0, 0, make_store(["a"]))))
+    ours, theirs = make_store(["a"]), make_store(["a"])
+    ours.mark_clean()
+    theirs.mark_clean()
+    add_text(ours, "ours")
+    add_text(theirs, "theirs")
+
+    put_if_absent = storage.put_if_absent
+
+    def racing_put_if_absent(key, data):
+        if key == memory_segments.delta_key("001", 2):
+            # 另一个进程：追加版本 2、合并为基准快照、删除增量段
+            assert put_if_absent(key, delta_for(theirs, 1))
+            with monkeypatch.context() as other_process:
+                other_process.setattr(memory_segments, "_locks", {})  # 另一个进程有自己的进程内锁
+                assert memory_segments.compact("001", force=True)
+            assert storage.get(key) is None
+        return put_if_absent(key, data)
+
+    monkeypatch.setattr(storage, "put_if_absent", racing_put_if_absent)
+    with pytest.raises(memory_segments.MemoryVersionConflict):
+        memory_segments.append_delta("001", delta_for(ours, 1))
+    assert storage.get(memory_segments.delta_key("001", 2)) is None
+    version, head, _ = memory_segments.load_head("001")
+    assert version == 2 and texts_of(head) == ["a", "theirs"]
+
+
+def test_append_compacted_right_after_the_write_succeeds(storage, monkeypatch):
+    """另一个进程在本进程写入之后、复查基准快照之前合并了本进程的增量段：追加成功，不能误报冲突导致重复写入"""
+    memory_segments.write_snapshot("001", bytes(build_memory_bin("001", 1, 0, 0, make_store(["a"]))))
+    ours = make_store(["a"])
+    ours.mark_clean()
+    add_text(ours, "ours")
+
+    put_if_absent = storage.put_if_absent
+
+    def put_then_compact(key, data):
+        written = put_if_absent(key, data)
+        if key == memory_segments.delta_key("001", 2):
+            with monkeypatch.context() as other_process:
+                other_process.setattr(memory_segments, "_locks", {})
+                assert memory_segments.compact("001", force=True)
+        return written
+
+    monkeypatch.setattr(storage, "put_if_absent", put_then_compact)
+    assert memory_segments.append_delta("001", delta_for(ours, 1)) == 2
+    version, head, _ = memory_segments.load_head("001")
+    assert version == 2 and texts_of(head) == ["a", "ours"]
+
+
+def _appender(root, name, count):
+    memory_segments.storage = LocalStorage(root)
+    for i in range(count):
+        while True:
+            try:
+                version, store, _ = memory_segments.load_head("001")
+                store.mark_clean()
+                add_text(store, f"{name}-{i}", seed=i)
+                memory_segments.append_delta("001", delta_for(store, version))
+                break
+            except (memory_segments.MemoryVersionConflict, ValueError):
+                continue  # 被其他进程抢先或读取期间增量段被合并：重新加载后重试
+
+
+def _compactor(root, stop):
+    memory_segments.storage = LocalStorage(root)
+    while not stop.is_set():
+        memory_segments.compact("001", force=True)
+
+
+def test_concurrent_appends_and_compaction_across_processes(tmp_path):
+    root = str(tmp_path)
+    memory_segments.storage = LocalStorage(root)
+    try:
+        memory_segments.write_snapshot("001", bytes(build_memory_bin("001", 1, 0, 0, make_store(["seed"]))))
+        context = multiprocessing.get_context("fork")
+        stop = context.Event()
+        compactor = context.Process(target=_compactor, args=(root, stop))
+        appenders = [context.Process(target=_appender, args=(root, name, 15)) for name in ("p", "q")]
+        compactor.start()
+        for process in appenders:
+            process.start()
+        for process in appenders:
+            process.join(60)
+            assert process.exitcode == 0
+        stop.set()
+        compactor.join(60)
+        assert compactor.exitcode == 0
+
+        version, head, _ = memory_segments.load_head("001")
+        texts = texts_of(head)
+        # 每次成功的追加都恰好出现一次，没有被合并静默吞掉的更新
+        assert sorted(texts) == sorted(["seed"] + [f"{name}-{i}" for name in ("p", "q") for i in range(15)])
+        assert version == 31
+    finally:
+        memory_segments.storage = memory_segments.create_memory_storage()
@@ -0,0 +1,25 @@
+import asyncio
+
+from utils.response_cache import ResponseCache, context_fingerprint
+
+
+def conversation(system_prompt, prompt="你好"):
+    return [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}]
+
+
+def test_fingerprint_covers_the_system_prompt():
+    assert context_fingerprint(conversation("记忆：用户A住在北京")) != context_fingerprint(conversation("记忆：用户B"))
+    assert context_fingerprint(conversation("同一设定")) == context_fingerprint(conversation("同一设定", "在吗"))
+
+
+def test_replies_are_not_shared_between_users_with_different_memories():
+    async def run():
+        cache = ResponseCache(semantic=False)
+        await cache.store("001", conversation("记忆：用户A住在北京"), "你好呀，北京今天冷吗？")
+        other = await cache.lookup("001", conversation("记忆：用户B"))
+        same = await cache.lookup("001", conversation("记忆：用户A住在北京", "你好！"))
+        return other, same
+
+    other, same = asyncio.run(run())
+    assert other is None
+    assert same == "你好呀，北京今天冷吗？"
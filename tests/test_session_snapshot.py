@@ -0,0 +1,20 @@
+import asyncio
+
+import utils.session_snapshot as session_snapshot
+from utils.session_manager import Session, SessionExpiryIndex, SessionRegistry
+
+
+def test_snapshot_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(session_snapshot, "SESSION_SNAPSHOT_DB", str(tmp_path / "snapshot.db"))
+    registry = SessionRegistry()
+    session = Session(system_prompt="设定", memory_prompt=["用户住在北京"], memory_version=3, chat_count=2)
+    session.add_messages([{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好呀"}])
+    registry.put("u", "001", session)
+
+    assert asyncio.run(session_snapshot.save_snapshot(registry)) == (1, 0)
+    assert asyncio.run(session_snapshot.save_snapshot(registry)) == (0, 0)  # 没有变化时不重复写入
+
+    restored = SessionRegistry()
+    assert session_snapshot.load_snapshot(restored, SessionExpiryIndex()) == 1
+    assert restored.get("u", "001").to_dict() == session.to_dict()
+    assert not restored.get("u", "001").dirty
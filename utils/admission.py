@@ -0,0 +1,276 @@
+# admission.py
+# 上游LLM调用的全局准入控制：限制并发、按优先级加权调度、按 unionid 轮询保证公平，
+# 预计排队超时则快速拒绝（429/503 + Retry-After），避免高峰期所有请求一起拖到超时
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+PRIORITY_INTERACTIVE = 0  # 实时对话
+PRIORITY_BACKGROUND = 1  # 后台记忆整理等
+
+LLM_MAX_CONCURRENCY = 64  # 全局同时进行的上游调用数
+LLM_PRIORITY_WEIGHTS = {PRIORITY_INTERACTIVE: 8, PRIORITY_BACKGROUND: 1}  # 加权轮询的权重
+LLM_MAX_QUEUE_WAIT = {PRIORITY_INTERACTIVE: 10.0, PRIORITY_BACKGROUND: 600.0}  # 各优先级最长排队时间（秒）
+LLM_MAX_PENDING_PER_KEY = 4  # 单个 key 同时占用+排队的上限
+
+
+def user_key(unionid):
+    """实时对话按用户计数的 key；与 avatar_key 分属不同命名空间，unionid 与角色ID相同时也不会共用名额"""
+    return f"user:{unionid}"
+
+
+def avatar_key(avatar_id):
+    """后台记忆任务按角色计数的 key"""
+    return f"avatar:{avatar_id}"
+
+
+class AdmissionRejected(Exception):
+    """准入被拒绝，status_code 为建议返回的HTTP状态码（429/503），retry_after 为建议重试秒数"""
+
+    def __init__(self, status_code, retry_after, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """一次准入的凭证，release() 可重复调用"""
+    __slots__ = ("_controller", "key", "acquired_at", "_released")
+
+    def __init__(self, controller, key):
+        self._controller = controller
+        self.key = key
+        self.acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self)
+
+
+class _Waiter:
+    __slots__ = ("key", "priority", "granted", "loop", "future", "event")
+
+    def __init__(self, key, priority, loop=None):
+        self.key = key
+        self.priority = priority
+        self.granted = False
+        self.loop = loop
+        if loop is not None:
+            self.future = loop.create_future()
+            self.event = None
+        else:
+            self.future = None
+            self.event = threading.Event()
+
+    def wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(_resolve_future, self.future)
+        else:
+            self.event.set()
+
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class AdmissionController:
+    """
+    线程安全的准入控制器，同时支持协程（acquire/slot）和线程（acquire_sync/slot_sync）调用方。
+    调度顺序：优先级之间按权重平滑加权轮询，同一优先级内按 key（user_key/avatar_key）轮询。
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, weights=None, max_queue_wait=None,
+                 max_pending_per_key=LLM_MAX_PENDING_PER_KEY):
+        self.max_concurrency = max_concurrency
+        self.weights = dict(LLM_PRIORITY_WEIGHTS if weights is None else weights)
+        self.max_queue_wait = dict(LLM_MAX_QUEUE_WAIT if max_queue_wait is None else max_queue_wait)
+        self.max_pending_per_key = max_pending_per_key
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._queues = {priority: OrderedDict() for priority in self.weights}  # priority -> {key: deque[_Waiter]}
+        self._credits = {priority: 0 for priority in self.weights}
+        self._pending_per_key = {}
+        self._service_time = 1.0  # 单次调用耗时的滑动平均，用于估算排队时间
+        self.admitted = 0
+        self.rejected = 0
+
+    # ---------- 内部调度 ----------
+
+    def _check_key_limit(self, key):
+        """在锁内调用：检查单用户上限，超出则抛出 AdmissionRejected(429)"""
+        if self.max_pending_per_key and self._pending_per_key.get(key, 0) >= self.max_pending_per_key:
+            self.rejected += 1
+            raise AdmissionRejected(429, max(1, math.ceil(self._service_time)), "Too many concurrent requests")
+
+    def _check_queue_wait(self, priority):
+        """在锁内调用：预计排队时间超过该优先级的期限时抛出 AdmissionRejected(503)"""
+        estimated_wait = (self._queued + 1) / self.max_concurrency * self._service_time
+        if estimated_wait > self.max_queue_wait[priority]:
+            self.rejected += 1
+            raise AdmissionRejected(503, max(1, math.ceil(estimated_wait)), "LLM service is busy")
+
+    def _admit(self, key):
+        self._active += 1
+        self.admitted += 1
+        self._pending_per_key[key] = self._pending_per_key.get(key, 0) + 1
+        return AdmissionTicket(self, key)
+
+    def _try_fast_path(self, key, priority):
+        """在锁内调用：有空闲名额且无人排队时直接放行，否则检查是否值得排队"""
+        self._check_key_limit(key)
+        if self._active < self.max_concurrency and self._queued == 0:
+            return self._admit(key)
+        self._check_queue_wait(priority)
+        return None
+
+    def _enqueue(self, waiter):
+        queue = self._queues[waiter.priority]
+        if waiter.key not in queue:
+            queue[waiter.key] = deque()
+        queue[waiter.key].append(waiter)
+        self._queued += 1
+        self._pending_per_key[waiter.key] = self._pending_per_key.get(waiter.key, 0) + 1
+
+    def _remove(self, waiter):
+        """在锁内调用：移除未被放行的等待者"""
+        queue = self._queues[waiter.priority]
+        waiters = queue.get(waiter.key)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del queue[waiter.key]
+        self._queued -= 1
+        self._decrement_key(waiter.key)
+
+    def _decrement_key(self, key):
+        count = self._pending_per_key.get(key, 0) - 1
+        if count > 0:
+            self._pending_per_key[key] = count
+        else:
+            self._pending_per_key.pop(key, None)
+
+    def _pick(self):
+        """平滑加权轮询选出下一个优先级，再在该优先级内按 key 轮询"""
+        candidates = [priority for priority, queue in self._queues.items() if queue]
+        if not candidates:
+            return None
+        total = 0
+        for priority in candidates:
+            self._credits[priority] += self.weights[priority]
+            total += self.weights[priority]
+        chosen = max(candidates, key=lambda p: self._credits[p])
+        self._credits[chosen] -= total
+
+        queue = self._queues[chosen]
+        key, waiters = next(iter(queue.items()))
+        waiter = waiters.popleft()
+        if waiters:
+            queue.move_to_end(key)
+        else:
+            del queue[key]
+        return waiter
+
+    def _dispatch(self):
+        """在锁内调用：把空闲名额分配给排队者"""
+        while self._active < self.max_concurrency:
+            waiter = self._pick()
+            if waiter is None:
+                break
+            self._queued -= 1
+            self._active += 1
+            self.admitted += 1
+            waiter.granted = True
+            waiter.wake()
+
+    def _release(self, ticket):
+        with self._lock:
+            self._active -= 1
+            self._decrement_key(ticket.key)
+            elapsed = time.monotonic() - ticket.acquired_at
+            self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+            self._dispatch()
+
+    # ---------- 对外接口 ----------
+
+    async def acquire(self, key, priority=PRIORITY_INTERACTIVE):
+        """协程方式申请名额，返回 AdmissionTicket；超过排队期限抛出 AdmissionRejected"""
+        with self._lock:
+            ticket = self._try_fast_path(key, priority)
+            if ticket is not None:
+                return ticket
+            waiter = _Waiter(key, priority, asyncio.get_running_loop())
+            self._enqueue(waiter)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.max_queue_wait[priority])
+        except asyncio.TimeoutError:
+            with self._lock:
+                if not waiter.granted:
+                    self._remove(waiter)
+                    self.rejected += 1
+                    raise AdmissionRejected(503, max(1, math.ceil(self._service_time)), "LLM queue timeout")
+        except BaseException:
+            # 等待期间被取消：已放行则归还名额，否则出队
+            with self._lock:
+                if not waiter.granted:
+                    self._remove(waiter)
+                    raise
+            AdmissionTicket(self, key).release()
+            raise
+        return AdmissionTicket(self, key)
+
+    def acquire_sync(self, key, priority=PRIORITY_BACKGROUND):
+        """线程方式申请名额（供线程池中的记忆处理使用）"""
+        with self._lock:
+            ticket = self._try_fast_path(key, priority)
+            if ticket is not None:
+                return ticket
+            waiter = _Waiter(key, priority)
+            self._enqueue(waiter)
+
+        waiter.event.wait(timeout=self.max_queue_wait[priority])
+        with self._lock:
+            if not waiter.granted:
+                self._remove(waiter)
+                self.rejected += 1
+                raise AdmissionRejected(503, max(1, math.ceil(self._service_time)), "LLM queue timeout")
+        return AdmissionTicket(self, key)
+
+    @asynccontextmanager
+    async def slot(self, key, priority=PRIORITY_INTERACTIVE):
+        ticket = await self.acquire(key, priority)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    @contextmanager
+    def slot_sync(self, key, priority=PRIORITY_BACKGROUND):
+        ticket = self.acquire_sync(key, priority)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self._active,
+                "queued": self._queued,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "avg_service_time": round(self._service_time, 3),
+            }
+
+
+# 全局共享的上游LLM准入控制器
+llm_admission = AdmissionController()
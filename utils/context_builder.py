@@ -0,0 +1,68 @@
+# context_builder.py
+# 按token预算构建发送给LLM的上下文：从最新到最旧填充历史消息，超出预算的旧消息可折叠为滚动摘要
+import math
+import re
+
+CONTEXT_TOKEN_BUDGET = 3000  # 单次请求的上下文预算（系统提示词 + 历史 + 本轮输入）
+MESSAGE_TOKEN_OVERHEAD = 4  # 每条消息的角色/分隔符开销
+CONTEXT_ROLLING_SUMMARY = False  # 是否把从历史中丢弃的旧消息折叠为滚动摘要
+SUMMARY_TOKEN_BUDGET = 300  # 滚动摘要的最大token数
+SUMMARY_SNIPPET_CHARS = 40  # 摘要中每条被折叠消息保留的最大字符数
+
+# 中日韩字符（含全角标点）大致每字一个token，其余字符约每4个一个token
+_CJK_RE = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text):
+    """不依赖分词器的token数估算"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def message_tokens(message):
+    """单条消息的token数（含固定开销）"""
+    return estimate_tokens(message.get("content", "")) + MESSAGE_TOKEN_OVERHEAD
+
+
+def fold_into_summary(summary, dropped_messages):
+    """
+    把被丢弃的旧消息折叠进滚动摘要（抽取式，不额外调用LLM）：
+    每条用户发言保留开头片段，超出摘要预算时丢弃最早的片段
+    """
+    snippets = [summary] if summary else []
+    for message in dropped_messages:
+        if message.get("role") != "user":
+            continue
+        content = message.get("content", "").strip()
+        if content:
+            snippets.append(content[:SUMMARY_SNIPPET_CHARS])
+    summary = "；".join(snippets)
+    while estimate_tokens(summary) > SUMMARY_TOKEN_BUDGET and "；" in summary:
+        summary = summary.split("；", 1)[1]
+    return summary
+
+
+def build_context(session, user_prompt, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    构建OpenAI格式的消息数组：系统提示词 + 预算内尽可能多的最近历史 + 本轮输入
+    历史消息的token数在 Session 中按条缓存，这里不重复计算
+    """
+    system_prompt = session.combined_prompt
+    if session.summary:
+        system_prompt += "更早的对话要点：" + session.summary
+    system_message = {"role": "system", "content": system_prompt}
+    user_message = {"role": "user", "content": user_prompt}
+
+    remaining = budget - message_tokens(system_message) - message_tokens(user_message)
+    history = session.messages
+    start = len(history)
+    while start > 0 and history.tokens(start - 1) <= remaining:
+        start -= 1
+        remaining -= history.tokens(start)
+    # 历史从用户消息开始，避免出现孤立的助手回复
+    while start < len(history) and history.role(start) != "user":
+        start += 1
+
+    return [system_message, *history.iter_messages(start), user_message]
@@ -0,0 +1,163 @@
+# embedding_cache.py
+# 内容寻址的向量嵌入缓存，所有角色和进程共享：键为 hash(模型, 维度, 归一化文本)
+# 内存中的 LRU 在前，SQLite 中按 float16 存储的向量在后；批量查询时只把未命中的文本一次性发给上游
+# 常见的记忆片段（"用户叫张三"）、合并后的记忆文本和前端的重复查询都不必重新计算嵌入
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+from cachetools import LRUCache
+
+from utils.llm_backend import EMBEDDING_DIM
+
+EMBEDDING_CACHE_ENABLED = True
+EMBEDDING_CACHE_DB = "embedding_cache.db"
+EMBEDDING_CACHE_MEMORY_SIZE = 20000  # 内存 LRU 的条数（768 维 float16 每条约 1.5KB）
+EMBEDDING_CACHE_MAX_ROWS = 1000000  # 磁盘上保留的最大条数，超出时删除最早写入的
+_SQLITE_MAX_PARAMS = 500  # 单条 IN 查询的最大参数个数
+
+
+def normalize_text(text):
+    """归一化文本：全半角统一、去除首尾空白、连续空白合并为一个空格（不改变大小写和标点，它们会影响语义）"""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+def embedding_model_name(backend):
+    """参与缓存键的模型名：不同后端/模型的向量不能混用"""
+    return f"{backend.name}:{getattr(backend, 'embedding_model', '')}"
+
+
+def cache_key(model, dimensions, text):
+    return hashlib.blake2b(f"{model}\0{dimensions}\0{text}".encode("utf-8"), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """线程安全：内存 LRU 由锁保护，SQLite 每次操作使用独立连接，可被多个线程/进程同时使用"""
+
+    def __init__(self, path=None, maxsize=EMBEDDING_CACHE_MEMORY_SIZE, max_rows=EMBEDDING_CACHE_MAX_ROWS):
+        self.path = path or EMBEDDING_CACHE_DB
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._entries = LRUCache(maxsize=maxsize)  # key -> float16 向量
+        self._initialized = False  # 第一次使用时才创建数据库文件
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key BLOB PRIMARY KEY,       /* blake2b(模型, 维度, 归一化文本) */
+                vector BLOB NOT NULL,       /* float16 小端 */
+                created_at REAL NOT NULL
+            )""")
+            self._initialized = True
+        return conn
+
+    def _load(self, keys):
+        """从磁盘读取，返回 {key: float16 向量}"""
+        found = {}
+        conn = self._connect()
+        try:
+            for start in range(0, len(keys), _SQLITE_MAX_PARAMS):
+                chunk = keys[start:start + _SQLITE_MAX_PARAMS]
+                rows = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                                    chunk).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype="<f2")
+        finally:
+            conn.close()
+        return found
+
+    def _store(self, items):
+        """写入磁盘 [(key, float16 向量), ...]，超过 max_rows 时删除最早写入的"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                                 [(key, vector.tobytes(), now) for key, vector in items])
+                conn.execute("DELETE FROM embeddings WHERE rowid <= (SELECT MAX(rowid) FROM embeddings) - ?",
+                             (self.max_rows,))
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def get_many(self, texts, embed_fn, model, dimensions=EMBEDDING_DIM):
+        """
+        返回与 texts 等长的 float16 向量列表
+        未命中的文本去重后调用一次 embed_fn(归一化文本列表) -> 向量列表，结果写回缓存；embed_fn 的异常原样抛出
+        """
+        normalized = [normalize_text(text) for text in texts]
+        keys = [cache_key(model, dimensions, text) for text in normalized]
+        vectors = {}
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    vectors[key] = vector
+        memory_hits = sum(key in vectors for key in keys)
+
+        pending = list(dict.fromkeys(key for key in keys if key not in vectors))
+        disk_found = self._load(pending) if pending else {}
+        disk_found = {key: vector for key, vector in disk_found.items() if len(vector) == dimensions}
+        vectors.update(disk_found)
+        disk_hits = sum(key in disk_found for key in keys)
+
+        missing = list(dict.fromkeys((key, text) for key, text in zip(keys, normalized) if key not in vectors))
+        if missing:
+            fetched = embed_fn([text for _, text in missing])
+            if len(fetched) != len(missing):
+                raise ValueError(f"expected {len(missing)} embeddings, got {len(fetched)}")
+            stored = [(key, np.asarray(vector, dtype="<f2")) for (key, _), vector in zip(missing, fetched)]
+            vectors.update(stored)
+            self._store(stored)
+
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                self._entries[key] = vectors[key]
+            self.memory_hits += memory_hits
+            self.disk_hits += disk_hits
+            self.misses += len(keys) - memory_hits - disk_hits
+        return [vectors[key] for key in keys]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+embedding_cache = EmbeddingCache()
+
+
+def get_cached_embeddings(backend, texts, dimensions=EMBEDDING_DIM, admission=None):
+    """
+    经缓存获取嵌入向量（float16），只有未命中的文本会请求上游
+    admission 为上下文管理器工厂时，请求上游前先申请调用名额（命中时不占用名额）
+    """
+    def embed(missing):
+        if admission is None:
+            return backend.embed(missing, dimensions=dimensions)
+        with admission():
+            return backend.embed(missing, dimensions=dimensions)
+
+    if not EMBEDDING_CACHE_ENABLED:
+        return [np.asarray(vector, dtype=np.float16) for vector in embed([normalize_text(text) for text in texts])]
+    return embedding_cache.get_many(texts, embed, embedding_model_name(backend), dimensions)
@@ -0,0 +1,291 @@
+# llm_backend.py
+# 可插拔的LLM后端：流式对话、JSON模式补全和向量嵌入
+# - dashscope：线上 DashScope OpenAI 兼容接口（默认）
+# - fake：确定性的本地模拟后端，可配置首字延迟、吐字速率、错误注入，用于无网络压测
+# 通过环境变量 LLM_BACKEND=fake 切换，或在代码中调用 set_llm_backend()
+import abc
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+
+import httpx
+import numpy as np
+from openai import AsyncOpenAI, OpenAI
+
+from utils.dashscope import DASHSCOPE_API_KEY, DASHSCOPE_LLM_URL
+
+CHAT_MODEL = "qwen-plus"
+EMBEDDING_MODEL = "text-embedding-v4"
+EMBEDDING_DIM = 768
+
+LLM_TIMEOUT = 30  # 上游单次读超时（秒）
+LLM_MAX_CONNECTIONS = 500  # 每个worker共享连接池的最大连接数
+LLM_MAX_KEEPALIVE = 100
+
+
+class LLMBackendError(Exception):
+    """后端调用失败（模拟后端注入的错误也使用该异常）"""
+
+
+class LLMBackend(abc.ABC):
+    """LLM后端接口"""
+    name = "base"
+
+    @abc.abstractmethod
+    def stream_chat(self, messages, max_tokens=200):
+        """
+        异步流式对话，逐个产出增量文本
+        实现为异步生成器（async def + yield）；调用方提前关闭生成器时应取消上游请求
+        """
+
+    @abc.abstractmethod
+    def complete(self, messages, json_mode=False):
+        """同步补全，返回回复文本；json_mode=True 时要求返回 JSON 对象"""
+
+    @abc.abstractmethod
+    def embed(self, texts, dimensions=EMBEDDING_DIM):
+        """同步获取嵌入向量，返回与 texts 等长的 float32 数组列表"""
+
+    async def aclose(self):
+        pass
+
+
+class DashScopeBackend(LLMBackend):
+    """DashScope OpenAI 兼容接口"""
+    name = "dashscope"
+
+    def __init__(self, api_key=DASHSCOPE_API_KEY, base_url=DASHSCOPE_LLM_URL,
+                 chat_model=CHAT_MODEL, embedding_model=EMBEDDING_MODEL):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.chat_model = chat_model
+        self.embedding_model = embedding_model
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = OpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url
+            )
+        return self._client
+
+    @property
+    def async_client(self):
+        """共享的异步客户端，所有流式请求复用同一个连接池"""
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                timeout=httpx.Timeout(LLM_TIMEOUT, connect=10),
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_KEEPALIVE
+                    )
+                )
+            )
+        return self._async_client
+
+    async def stream_chat(self, messages, max_tokens=200):
+        stream = await self.async_client.chat.completions.create(
+            model=self.chat_model,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # 提前结束（客户端断开/被取消）时关闭上游连接，停止继续生成
+            await stream.close()
+
+    def complete(self, messages, json_mode=False):
+        kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+        completion = self.client.chat.completions.create(
+            model=self.chat_model,
+            messages=messages,
+            **kwargs
+        )
+        return completion.choices[0].message.content
+
+    def embed(self, texts, dimensions=EMBEDDING_DIM):
+        completion = self.client.embeddings.create(
+            model=self.embedding_model,
+            input=texts,
+            dimensions=dimensions,
+        )
+        return [np.asarray(item.embedding, dtype=np.float32) for item in completion.data]
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+
+class FakeBackend(LLMBackend):
+    """
+    确定性的本地模拟后端
+    ttft: 首个增量前的延迟（秒）；token_rate: 每秒产出的增量数（0 表示不限速）
+    reply_tokens: 每次回复的增量个数；error_rate: 调用失败的概率（按 seed 可复现）
+    latency: 同步补全/嵌入调用的模拟耗时（秒）
+    """
+    name = "fake"
+
+    def __init__(self, ttft=0.2, token_rate=50.0, reply_tokens=40, error_rate=0.0, latency=0.05, seed=0):
+        self.ttft = ttft
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.latency = latency
+        self._random = random.Random(seed)
+        self.calls = {"stream_chat": 0, "complete": 0, "embed": 0}
+
+    def _maybe_fail(self, kind):
+        self.calls[kind] += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise LLMBackendError(f"fake backend injected error ({kind})")
+
+    @staticmethod
+    def _digest(text):
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def reply_for(self, messages):
+        """根据最后一条用户消息生成确定性的回复文本"""
+        prompt = messages[-1]["content"] if messages else ""
+        words = ["好的", "我明白", "你说的", "很有意思", "我们", "可以", "继续", "聊聊", "这个", "话题"]
+        seed = int.from_bytes(self._digest(prompt)[:8], "little")
+        rng = random.Random(seed)
+        tokens = []
+        for i in range(self.reply_tokens):
+            token = rng.choice(words)
+            tokens.append(token + ("。" if i % 8 == 7 else "，" if i % 4 == 3 else ""))
+        return tokens
+
+    async def stream_chat(self, messages, max_tokens=200):
+        self._maybe_fail("stream_chat")
+        await asyncio.sleep(self.ttft)
+        interval = 1.0 / self.token_rate if self.token_rate else 0
+        for i, token in enumerate(self.reply_for(messages)[:max_tokens]):
+            if i and interval:
+                await asyncio.sleep(interval)
+            yield token
+
+    def complete(self, messages, json_mode=False):
+        self._maybe_fail("complete")
+        if self.latency:
+            time.sleep(self.latency)
+        prompt = messages[-1]["content"] if messages else ""
+        if not json_mode:
+            return "".join(self.reply_for(messages))
+        if '"decisions"' in prompt:
+            # 批量记忆整合：所有片段都创建为新记忆
+            fragments = re.findall(r"^\s*(F\d+)\. ", prompt, re.M)
+            decisions = [{"fragment": fragment, "decision": "create_new", "reason": "fake backend"} for fragment in fragments]
+            return json.dumps({"decisions": decisions, "merged": {}}, ensure_ascii=False)
+        if "fragments" in prompt:
+            # 记忆提取：把对话中的每条用户发言作为一个记忆片段
+            fragments = re.findall(r"用户: (.+)", prompt)
+            return json.dumps({"fragments": fragments}, ensure_ascii=False)
+        if "decision" in prompt:
+            return json.dumps({"decision": "create_new", "reason": "fake backend"}, ensure_ascii=False)
+        return json.dumps({}, ensure_ascii=False)
+
+    def embed(self, texts, dimensions=EMBEDDING_DIM):
+        self._maybe_fail("embed")
+        if self.latency:
+            time.sleep(self.latency)
+        embeddings = []
+        for text in texts:
+            # 以文本哈希为种子生成单位向量，相同文本总是得到相同向量
+            rng = np.random.default_rng(int.from_bytes(self._digest(text)[:8], "little"))
+            vector = rng.standard_normal(dimensions).astype(np.float32)
+            embeddings.append(vector / np.linalg.norm(vector))
+        return embeddings
+
+
+def create_fake_llm_app(backend=None):
+    """
+    创建一个 OpenAI 兼容的本地替身服务（/v1/chat/completions、/v1/embeddings），
+    便于通过真实HTTP链路压测：将 DASHSCOPE_LLM_URL 指向该服务即可
+    """
+    from fastapi import FastAPI, Body
+    from fastapi.responses import StreamingResponse
+
+    backend = FakeBackend() if backend is None else backend
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(body: dict = Body(...)):
+        messages = body.get("messages", [])
+        created = int(time.time())
+        if not body.get("stream"):
+            json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+            content = await asyncio.to_thread(backend.complete, messages, json_mode)
+            return {
+                "id": "fake", "object": "chat.completion", "created": created, "model": body.get("model"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}]
+            }
+
+        async def sse():
+            async for token in backend.stream_chat(messages, body.get("max_tokens") or 200):
+                chunk = {
+                    "id": "fake", "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+                }
+                yield "data: " + json.dumps(chunk, ensure_ascii=False) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(sse(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(body: dict = Body(...)):
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        vectors = await asyncio.to_thread(backend.embed, texts, body.get("dimensions") or EMBEDDING_DIM)
+        return {
+            "object": "list", "model": body.get("model"),
+            "data": [{"object": "embedding", "index": i, "embedding": v.tolist()} for i, v in enumerate(vectors)]
+        }
+
+    return app
+
+
+_backend = None
+def get_llm_backend():
+    """获取全局LLM后端，默认由环境变量 LLM_BACKEND 决定（dashscope/fake）"""
+    global _backend
+    if _backend is None:
+        if os.environ.get("LLM_BACKEND", "dashscope") == "fake":
+            _backend = FakeBackend()
+        else:
+            _backend = DashScopeBackend()
+    return _backend
+
+
+def set_llm_backend(backend):
+    """替换全局LLM后端（压测/调试用）"""
+    global _backend
+    _backend = backend
+
+
+async def close_llm_backend():
+    """关闭后端持有的连接池（在应用关闭时调用）"""
+    if _backend is not None:
+        await _backend.aclose()
+
+
+if __name__ == "__main__":
+    # 启动本地替身服务：python -m utils.llm_backend
+    import uvicorn
+    uvicorn.run(create_fake_llm_app(), host="127.0.0.1", port=8001)
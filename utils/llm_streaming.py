@@ -1,100 +1,200 @@
 import asyncio
-import datetime
 import json
 import logging
-import time
-from openai import OpenAI
-from queue import Queue
-from threading import Thread
-
-from utils.dashscope import DASHSCOPE_API_KEY, DASHSCOPE_LLM_URL
-from utils.session_manager import user_locks, get_or_create_session
-
-_client = None
-def get_client():
-    global _client
-    if _client is None:
-        _client = OpenAI(
-            api_key=DASHSCOPE_API_KEY,
-            base_url=DASHSCOPE_LLM_URL
-        )
-    return _client
-
-
-# 包装原始同步函数
-def run_llm_thread(messages, response_queue):
-    full_response = ""  # 新增：用于收集完整回复
-    print("run_llm_tts", messages)
-    try:
-        # 流式获取LLM响应
-        client = get_client()
-        stream = client.chat.completions.create(
-            model="qwen-plus",
-            messages=messages,
-            max_tokens=200,
-            stream=True,
-            stream_options={"include_usage": True}
-        )
-        for chunk in stream:
-            if chunk.choices and chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_response += content  # 收集完整回复
-                # 打印流式回复的时间戳
-                current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-                print(f"Content chunk received at: {current_time}")
-                response_queue.put(("text", content))
-                time.sleep(0.05)
-                # 这里要模拟一下异步延时
-        # 结束流式合成
-        response_queue.put(("end", full_response))
+import anyio
 
-    except Exception as e:
-        logging.error(f"Processing error: {str(e)}")
-        response_queue.put(("error", str(e)))
+from utils.llm_backend import get_llm_backend
+from utils.session_manager import user_session_lock, load_session, commit_session
+from utils.sentence_segmenter import SentenceSegmenter
+from utils.response_cache import response_cache, RESPONSE_CACHE_ENABLED
+from utils.admission import llm_admission, user_key, PRIORITY_INTERACTIVE
 
 
-async def gen_stream(unionid, avatar_id, messages):
-    # system_prompt = "" if system_prompt is None else system_prompt
-    user_prompt = messages[-1]["content"]
+# 输出刷新策略：按时间窗口和/或字节数合并相邻的增量文本
+# STREAM_FLUSH_INTERVAL = 0 表示不做任何人为延迟，每个增量立即发送
+STREAM_FLUSH_INTERVAL = 0.05  # 合并窗口（秒）
+STREAM_FLUSH_BYTES = 64  # 缓冲达到该字节数时立即发送
+
+# 是否在逗号等分句标点处也标记 sentence_end（更早触发TTS，但片段更碎）
+STREAM_SEGMENT_CLAUSES = False
+
+# 预编码的帧模板，避免每个增量都调用 json.dumps 构造整个字典
+# sentence_end 为新增字段：为 True 时表示该帧以一个完整句子结尾，旧客户端可忽略
+_encode_text = json.encoder.encode_basestring_ascii
+_TEXT_FRAME_PREFIX = '{"text": '
+_TEXT_FRAME_SUFFIX = ', "endpoint": false, "sentence_end": false}\n'
+_SENTENCE_FRAME_SUFFIX = ', "endpoint": false, "sentence_end": true}\n'
+_END_FRAME = json.dumps({"text": "", "endpoint": True}) + "\n"
+
+
+def encode_text_frame(text, sentence_end=False):
+    """编码一条文本帧，输出与 json.dumps({"text": text, "endpoint": False, "sentence_end": ...}) 一致"""
+    suffix = _SENTENCE_FRAME_SUFFIX if sentence_end else _TEXT_FRAME_SUFFIX
+    return _TEXT_FRAME_PREFIX + _encode_text(text) + suffix
 
-    # 创建跨线程通信队列
-    response_queue = Queue()
-    # 在独立线程中运行同步处理
-    Thread(target=run_llm_thread, args=(messages, response_queue)).start()
-    while True:
+
+async def iter_llm_deltas(messages):
+    """异步消费上游流，逐个产出增量文本"""
+    deltas = get_llm_backend().stream_chat(messages, max_tokens=200)
+    try:
+        async for delta in deltas:
+            yield delta
+    finally:
+        # 提前结束（客户端断开/被取消）时关闭上游流，停止继续生成
+        await deltas.aclose()
+
+
+async def coalesce_deltas(deltas, flush_interval=STREAM_FLUSH_INTERVAL, flush_bytes=STREAM_FLUSH_BYTES):
+    """
+    合并增量文本：首个增量立即发送以保证首字延迟，
+    之后缓冲直到超过时间窗口或字节上限；上游停顿时由超时触发刷新
+    """
+    if not flush_interval:
+        # 零延迟模式：每个增量到达即发送
         try:
-            item_type, data = response_queue.get(timeout=30)
-
-            if item_type == "text":
-                yield json.dumps({
-                    "text": data,
-                    "endpoint": False
-                }) + "\n"
-                await asyncio.sleep(0.05)  # 模拟异步延迟
-
-            elif item_type == "end":
-                yield json.dumps({
-                    "text": "",
-                    "endpoint": True,
-                }) + "\n"
-
-                # 保存对话历史
-                async with user_locks[unionid]:  # 获取用户级锁
-                    session = get_or_create_session(unionid, avatar_id, None)
-                    session.add_messages([
-                        {"role": "user", "content": user_prompt},
-                        {"role": "assistant", "content": data}  # data包含完整回复
-                    ])
+            async for delta in deltas:
+                yield delta
+        finally:
+            await deltas.aclose()
+        return
 
-                break
+    loop = asyncio.get_running_loop()
+    iterator = deltas.__aiter__()
+    buffer = []
+    buffered_bytes = 0
+    deadline = None
+    first = True
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait((pending,), timeout=timeout)
+            if not done:
+                # 时间窗口到期，发送缓冲内容
+                yield "".join(buffer)
+                buffer.clear()
+                buffered_bytes = 0
+                deadline = None
+                continue
 
-            elif item_type == "error":
-                yield json.dumps({
-                    "error": data,
-                    "endpoint": True
-                }) + "\n"
+            try:
+                delta = pending.result()
+            except StopAsyncIteration:
+                pending = None
                 break
+            pending = None
+
+            if first:
+                first = False
+                yield delta
+                continue
+
+            buffer.append(delta)
+            buffered_bytes += len(delta.encode("utf-8"))
+            if deadline is None:
+                deadline = loop.time() + flush_interval
+            if flush_bytes and buffered_bytes >= flush_bytes:
+                yield "".join(buffer)
+                buffer.clear()
+                buffered_bytes = 0
+                deadline = None
 
-        except Exception as e:
-            logging.error(f"Queue timeout: {str(e)}")
-            break
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            # 先等待被取消的读取任务结束，再关闭上游生成器
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration, Exception):
+                pass
+        await iterator.aclose()
+
+
+async def _save_turn(unionid, avatar_id, user_prompt, assistant_reply):
+    """保存一轮对话到会话历史"""
+    async with user_session_lock(unionid):  # 获取用户级锁
+        session = await load_session(unionid, avatar_id, None)
+        session.add_messages([
+            {"role": "user", "content": user_prompt},
+            {"role": "assistant", "content": assistant_reply}
+        ])
+        await commit_session(unionid, avatar_id, session)
+
+
+async def gen_stream(unionid, avatar_id, messages, flush_interval=None, flush_bytes=None, is_disconnected=None,
+                     ticket=None):
+    """
+    流式生成回复
+    is_disconnected: 可选的异步回调（如 request.is_disconnected），返回 True 时
+    立即停止并取消上游请求；已发送的部分回复仍会写入会话历史
+    会话历史在结束帧之前写入：客户端收到结束帧时可能立即断开，生成器会在该 yield 处被关闭
+    ticket: 调用方预先申请的 AdmissionTicket，流结束时归还
+    """
+    user_prompt = messages[-1]["content"]
+    sent_response = ""  # 已发送给客户端的回复
+    logging.debug(f"gen_stream: unionid={unionid}, avatar_id={avatar_id}, messages={len(messages)}")
+    flush_interval = STREAM_FLUSH_INTERVAL if flush_interval is None else flush_interval
+    flush_bytes = STREAM_FLUSH_BYTES if flush_bytes is None else flush_bytes
+
+    # 直接在事件循环中异步消费上游流，不再为每个请求创建线程
+    deltas = coalesce_deltas(iter_llm_deltas(messages), flush_interval, flush_bytes)
+    completed = False
+    try:
+        segmenter = SentenceSegmenter(clause=STREAM_SEGMENT_CLAUSES)
+        async for text in deltas:
+            if is_disconnected is not None and await is_disconnected():
+                logging.info(f"Client disconnected, cancel upstream: unionid={unionid}")
+                return
+            # 在句子边界处切分，句末片段单独成帧并带上 sentence_end 标记
+            for piece, sentence_end in segmenter.feed(text):
+                # 帧在 yield 时即交给了服务器发送，先计入已发送内容
+                sent_response += piece
+                yield encode_text_frame(piece, sentence_end)
+        for piece, sentence_end in segmenter.flush():
+            sent_response += piece
+            yield encode_text_frame(piece, sentence_end)
+        completed = True
+
+    except Exception as e:
+        logging.error(f"Processing error: {str(e)}")
+        yield json.dumps({
+            "error": str(e),
+            "endpoint": True
+        }) + "\n"
+        return
+
+    finally:
+        # 无论正常结束、出错还是客户端断开（生成器被关闭/任务被取消），都要关闭上游流
+        # 屏蔽外层取消，保证清理和历史写入能够完成
+        with anyio.CancelScope(shield=True):
+            await deltas.aclose()
+            if ticket is not None:
+                ticket.release()
+            # 记录已发送的回复（被打断时为部分回复），保持历史与用户听到的内容一致
+            if completed or sent_response:
+                await _save_turn(unionid, avatar_id, user_prompt, sent_response)
+            if completed and RESPONSE_CACHE_ENABLED:
+                await response_cache.store(avatar_id, messages, sent_response,
+                                           admission=lambda: llm_admission.slot_sync(user_key(unionid), PRIORITY_INTERACTIVE))
+
+    yield _END_FRAME
+
+
+async def gen_cached_stream(unionid, avatar_id, user_prompt, reply):
+    """以与 gen_stream 相同的帧格式回放缓存命中的回复，并照常写入会话历史"""
+    sent_response = ""
+    try:
+        segmenter = SentenceSegmenter(clause=STREAM_SEGMENT_CLAUSES)
+        for piece, sentence_end in segmenter.feed(reply) + segmenter.flush():
+            sent_response += piece
+            yield encode_text_frame(piece, sentence_end)
+        yield _END_FRAME
+    finally:
+        # 与 gen_stream 一致：客户端在回放中途或收到结束帧后断开时屏蔽取消，照常写入已发送的回复
+        with anyio.CancelScope(shield=True):
+            if sent_response:
+                await _save_turn(unionid, avatar_id, user_prompt, sent_response)
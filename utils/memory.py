@@ -1,14 +1,34 @@
 import os
 import json
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import struct
 from datetime import datetime
-from openai import OpenAI
-import requests
-from utils.dashscope import DASHSCOPE_API_KEY,DASHSCOPE_LLM_URL,HOST_URL
+from utils.llm_backend import get_llm_backend, EMBEDDING_DIM
+from utils.admission import llm_admission, avatar_key, AdmissionRejected, PRIORITY_BACKGROUND
+from utils.embedding_cache import get_cached_embeddings, embedding_cache
+from utils.memory_store import MemoryStore
+from utils.memory_format import parse_memory_bin, build_memory_bin, build_memory_delta
+from utils import memory_segments, memory_index
 
-# 使用相同的URL进行上传和下载
-memory_data_url = HOST_URL + "/api/assets/{avatar_id}/memory.bin"
+# 记忆文件直接通过 memory_segments 的存储后端读写（本地目录 / S3 兼容对象存储），不再经由本服务的 HTTP 接口
+
+MEMORY_DELTA_UPLOADS = True  # 只写入增量段；False 时每次写入完整的 memory.bin
+MEMORY_LOAD_ATTEMPTS = 3  # 加载过程中增量段被合并删除时重新读取 manifest 的次数
+MEMORY_HEAD_CACHE_SIZE = 16  # 在进程内缓存最新记忆库（MemoryStore）的角色数，下次只需下载之后的增量段；0 为不缓存
+MEMORY_BATCH_CONSOLIDATION = True  # 一次 LLM 调用给出全部片段的整合决策和合并文本；False 时逐片段决策（并发调用）
+MEMORY_CONSOLIDATION_WORKERS = 2  # 逐片段决策时单个任务的并发 LLM 调用数（须小于 LLM_MAX_PENDING_PER_KEY，运行时会再限制）
+MEMORY_SIMILAR_K = 5  # 每个片段参考的相似记忆数
+MEMORY_SIMILAR_THRESHOLD = 0.7  # 相似记忆的最低余弦相似度
+
+_head_cache = OrderedDict()  # avatar_id -> (memory_version, created_at, updated_at, MemoryStore)
+_head_cache_lock = threading.Lock()
+
+
+class DeltaUnavailable(Exception):
+    """增量段已被合并进基准快照，需要重新读取 manifest"""
 
 class MemoryManager:
     def __init__(self, avatar_id, memory_version):
@@ -19,200 +39,170 @@ class MemoryManager:
         self.num_entries = 0
         self.dim = 768
 
-        self.memories = []  # 存储格式: [{"vector": [], "norm": float, "text": str, "frequency": int, "created_at": timestamp, "updated_at": timestamp}]
-        self.client = OpenAI(
-            api_key=DASHSCOPE_API_KEY,
-            base_url=DASHSCOPE_LLM_URL
-        )
+        self.memories = MemoryStore(self.dim)  # 向量矩阵 + 各字段数组，按下标访问时返回 {"vector", "norm", "text", "frequency", "created_at", "updated_at"}
+        self.backend = get_llm_backend()
 
     def load_memories(self):
-        """从二进制文件加载记忆数据"""
-        if self.memory_version == 0:
-            print("memory_version = 0，创建新的空记忆库")
-            self.memories = []
-            return
-
-        # memory_version > 0，从URL加载记忆
-        memory_url = memory_data_url.format(avatar_id=self.avatar_id)
-
+        """
+        加载最新的记忆数据，返回是否成功
+        存储中的版本为准（基准快照 + 之后的增量段），本进程缓存了较新的快照时只下载缓存之后的增量段
+        """
+        for _ in range(MEMORY_LOAD_ATTEMPTS):
+            try:
+                self._load_head()
+                print(f"成功加载 {len(self.memories)} 条记忆 (版本: {self.memory_version})")
+                return True
+            except DeltaUnavailable as e:
+                print(f"增量段已被合并，重新加载: {e}")
+            except OSError as e:
+                print(f"读取记忆文件失败: {e}")
+                break
+            except Exception as e:
+                print(f"加载记忆失败: {e}")
+                break
+        self.memories = MemoryStore(self.dim)
+        return False
+
+    def _load_head(self):
+        manifest = memory_segments.manifest(self.avatar_id)
+
+        # 取走缓存的记忆库（之后由本对象修改），同一角色并发的其他任务改为从存储读取
+        with _head_cache_lock:
+            cached = _head_cache.pop(self.avatar_id, None)
+        if cached is not None and manifest["base_version"] <= cached[0] <= manifest["version"]:
+            self.memory_version, self.created_at, self.updated_at, self.memories = cached
+            self.dim = self.memories.dim
+        elif manifest["base_version"] > 0:
+            base = memory_segments.read_base(self.avatar_id)
+            if base is None:
+                raise DeltaUnavailable("memory.bin")
+            self._apply_header(*base)
+        else:
+            self.memory_version = 0
+            self.memories = MemoryStore(self.dim)
+
+        for version in range(self.memory_version + 1, manifest["version"] + 1):
+            parsed = memory_segments.read_delta(self.avatar_id, version)
+            if parsed is None:
+                raise DeltaUnavailable(f"delta {version}")
+            header, deletions, ids, rows = parsed
+            if header["base_version"] != self.memory_version:
+                raise ValueError(f"delta {version} does not apply to version {self.memory_version}")
+            if not self.memories and self.memories.dim != header["dim"]:
+                self.dim = header["dim"]
+                self.memories = MemoryStore(self.dim)
+            self.memories.apply_changes(deletions, ids, rows)
+            self.memory_version = header["memory_version"]
+            self.updated_at = header["updated_at"]
+        self.num_entries = len(self.memories)
+        self.memories.mark_clean()
+        if self.memories.centroids is not None:
+            return  # 缓存的记忆库已带有聚类，新增条目在追加时已分配
         try:
-        # if 1:
-            # 从URL下载文件
-            response = requests.get(memory_url)
-            response.raise_for_status()  # 检查请求是否成功
-            memory_data = response.content
-
-            # 解析二进制数据
-            self._parse_binary_data(memory_data)
-            print(f"成功从URL加载 {len(self.memories)} 条记忆 (版本: {self.memory_version})")
-
-        except requests.exceptions.RequestException as e:
-            print(f"下载记忆文件失败: {e}")
-            self.memories = []
-        except Exception as e:
-            print(f"加载记忆失败: {e}")
-            self.memories = []
+            memory_index.load_index(self.avatar_id, self.memories, self.memory_version)
+        except OSError as e:
+            print(f"读取记忆索引失败，使用精确检索: {e}")
 
     def _parse_binary_data(self, binary_data):
-        """解析二进制格式的记忆数据"""
-        memories = []
-        position = 0
-
+        """
+        解析二进制格式的记忆数据（自动识别 v1/v2，数值数据零拷贝映射，文本按需解码）
+        文件损坏时抛出 ValueError，由 load_memories 返回失败、任务稍后重试，不会用空记忆库覆盖已有记忆
+        """
         try:
-            # 读取头部信息
-            avatar_id_len = struct.unpack('I', binary_data[position:position + 4])[0]
-            position += 4
-            self.avatar_id = binary_data[position:position + avatar_id_len].decode('utf-8')
-            position += avatar_id_len
-
-            self.memory_version = struct.unpack('I', binary_data[position:position + 4])[0]
-            position += 4
-
-            self.created_at = struct.unpack('I', binary_data[position:position + 4])[0]
-            position += 4
-
-            self.updated_at = struct.unpack('I', binary_data[position:position + 4])[0]
-            position += 4
-
-            self.num_entries = struct.unpack('I', binary_data[position:position + 4])[0]
-            position += 4
-
-            self.dim = struct.unpack('I', binary_data[position:position + 4])[0]
-            position += 4
-
-            # 读取所有向量数据、模和频率数据
-            for _ in range(self.num_entries):
-                # 读取向量数据
-                vector_bytes = binary_data[position:position + self.dim * 2]  # float16占2字节
-                vector = np.frombuffer(vector_bytes, dtype=np.float16).tolist()
-                position += self.dim * 2
-
-                # 读取向量的模
-                norm = struct.unpack('e', binary_data[position:position + 2])[0]
-                position += 2
-
-                # 读取频率数据
-                frequency = struct.unpack('I', binary_data[position:position + 4])[0]
-                position += 4
-
-                created_at = struct.unpack('I', binary_data[position:position + 4])[0]
-                position += 4
-                updated_at = struct.unpack('I', binary_data[position:position + 4])[0]
-                position += 4
-
-                memories.append({
-                    "vector": vector,
-                    "norm": norm,
-                    "frequency": frequency,
-                    "created_at": created_at,
-                    "updated_at": updated_at
-                })
-
-            # 读取所有文本数据
-            for i in range(self.num_entries):
-                text_len = struct.unpack('I', binary_data[position:position + 4])[0]
-                position += 4
-
-                text = binary_data[position:position + text_len].decode('utf-8')
-                position += text_len
-
-                memories[i]["text"] = text
-
-        except Exception as e:
+            header, store = parse_memory_bin(binary_data)
+        except ValueError as e:
             print(f"解析二进制数据失败: {e}")
-            self.memories = []
-            return
-
-        self.memories = memories
+            raise
+        self._apply_header(header, store)
+
+    def _apply_header(self, header, store):
+        self.avatar_id = header["avatar_id"]
+        self.memory_version = header["memory_version"]
+        self.created_at = header["created_at"]
+        self.updated_at = header["updated_at"]
+        self.num_entries = header["num_entries"]
+        self.dim = header["dim"]
+        self.memories = store
 
     def _create_binary_data(self):
         """创建二进制格式的记忆数据"""
-        # 准备二进制数据
-        binary_parts = []
-
-        # 头部信息
-        avatar_id_bytes = self.avatar_id.encode('utf-8')
-        binary_parts.append(struct.pack('I', len(avatar_id_bytes)))
-        binary_parts.append(avatar_id_bytes)
-
         # 使用更新后的版本号
-        binary_parts.append(struct.pack('I', self.memory_version))
-
-
-        binary_parts.append(struct.pack('I', self.created_at))
-        current_time = int(datetime.now().timestamp())
-        binary_parts.append(struct.pack('I', current_time))
-
-        binary_parts.append(struct.pack('I', len(self.memories)))
-
-        if self.memories:
-            dim = len(self.memories[0]["vector"])
-        else:
-            dim = 768  # 默认维度
-        binary_parts.append(struct.pack('I', dim))
-
-        # 写入所有向量数据、模和频率数据
-        for memory in self.memories:
-            # 向量数据
-            vector_bytes = np.array(memory["vector"], dtype=np.float16).tobytes()
-            binary_parts.append(vector_bytes)
-
-            # 向量的模
-            binary_parts.append(struct.pack('e', memory.get("norm", 0.0)))
+        return build_memory_bin(self.avatar_id, self.memory_version, self.created_at,
+                                int(datetime.now().timestamp()), self.memories)
 
-            # 频率数据
-            binary_parts.append(struct.pack('I', memory.get("frequency", 1)))
-
-            # 添加时间戳数据
-            binary_parts.append(struct.pack('I', memory.get("created_at", 0)))
-            binary_parts.append(struct.pack('I', memory.get("updated_at", 0)))
-
-        # 写入所有文本数据
-        for memory in self.memories:
-            text_bytes = memory["text"].encode('utf-8')
-            binary_parts.append(struct.pack('I', len(text_bytes)))
-            binary_parts.append(text_bytes)
-
-        return b''.join(binary_parts)
+    def _cache_head(self):
+        """
+        写入成功后直接缓存当前的记忆库对象（不重新生成 memory.bin），同一角色的下一个任务只需应用之后的增量段
+        缓存后本对象不应再修改 memories；完整的 memory.bin 只在合并（memory_segments.compact）时生成
+        """
+        if MEMORY_HEAD_CACHE_SIZE <= 0:
+            return
+        with _head_cache_lock:
+            _head_cache[self.avatar_id] = (self.memory_version, self.created_at, self.updated_at, self.memories)
+            _head_cache.move_to_end(self.avatar_id)
+            while len(_head_cache) > MEMORY_HEAD_CACHE_SIZE:
+                _head_cache.popitem(last=False)
+
+    def _update_index(self):
+        """写入成功后更新近似检索索引，失败只影响检索速度"""
+        try:
+            memory_index.update_index(self.avatar_id, self.memories, self.memory_version)
+        except Exception as e:
+            print(f"更新记忆索引失败: {e}")
 
     def save_memories(self):
-        """保存记忆数据到二进制文件并上传到OSS"""
+        """保存记忆数据：默认只写入本次新增/修改的条目组成的增量段"""
+        if MEMORY_DELTA_UPLOADS:
+            return self._save_delta()
         # 计算新版本号
         self.memory_version = self.memory_version + 1
-        print(self.memory_version)
-
-        # try:
-        if 1:
-            # 创建二进制数据
-            memory_data = self._create_binary_data()
-            # print(memory_data)
-            # 上传到OSS
-            upload_url = memory_data_url.format(avatar_id=self.avatar_id)
-            print(upload_url)
-            # 使用PUT方法上传文件到OSS
-            response = requests.put(upload_url, data=memory_data)
-
-            if response.status_code == 200:
-                print(f"成功上传 {len(self.memories)} 条记忆到OSS (版本: {self.memory_version})")
-                return True
-            else:
-                print(f"上传失败，状态码: {response.status_code}, 响应: {response.text}")
-                return False
-
-        # except Exception as e:
-        #     print(f"保存记忆数据失败: {e}")
-        #     return False
+        try:
+            memory_segments.write_snapshot(self.avatar_id, self._create_binary_data())
+        except (OSError, ValueError) as e:
+            print(f"保存记忆数据失败: {e}")
+            self.memory_version -= 1
+            return False
+        print(f"成功保存 {len(self.memories)} 条记忆 (版本: {self.memory_version})")
+        self.memories.mark_clean()
+        self._cache_head()
+        self._update_index()
+        return True
+
+    def _save_delta(self):
+        deletions, ids = self.memories.changes()
+        if not len(deletions) and not len(ids):
+            print("记忆没有变化，无需写入")
+            return True
+        base_version = self.memory_version
+        now = int(datetime.now().timestamp())
+        memory_data = build_memory_delta(self.avatar_id, base_version, base_version + 1, self.created_at, now,
+                                         self.memories, deletions, ids)
+        try:
+            memory_segments.append_delta(self.avatar_id, memory_data)
+        except memory_segments.MemoryVersionConflict as e:
+            # 存储中已有更新的版本，任务重试时会基于最新版本重新生成
+            print(f"写入增量段失败: {e}")
+            return False
+        except (OSError, ValueError) as e:
+            print(f"写入增量段失败: {e}")
+            return False
+        self.memory_version = base_version + 1
+        self.updated_at = now
+        print(f"成功写入增量段：{len(ids)} 条写入、{len(deletions)} 条删除，{len(memory_data)} 字节 (版本: {self.memory_version})")
+        self.memories.mark_clean()
+        self._cache_head()
+        self._update_index()
+        # 记忆任务本身在后台线程中运行，增量段过多时直接在这里合并
+        memory_segments.compact_if_needed(self.avatar_id)
+        return True
 
     def get_embeddings(self, texts):
-        """获取文本的嵌入向量"""
+        """获取文本的嵌入向量（经共享的嵌入缓存，只有未命中的文本请求上游）"""
         try:
-            completion = self.client.embeddings.create(
-                model="text-embedding-v4",
-                input=texts,
-                dimensions=768,
-            )
-
-            embeddings = [np.array(item.embedding, dtype=np.float16) for item in completion.data]
+            # 后台记忆任务以低优先级参与上游调用的准入排队
+            embeddings = get_cached_embeddings(self.backend, texts, EMBEDDING_DIM,
+                                                lambda: llm_admission.slot_sync(avatar_key(self.avatar_id), PRIORITY_BACKGROUND))
+            print(f"嵌入缓存: {embedding_cache.stats()}")
             return embeddings
 
         except Exception as e:
@@ -230,18 +220,13 @@ class MemoryManager:
         return np.dot(vec1, vec2) / (vec1_norm * vec2_norm)
 
     def search_similar_memories(self, query_embedding, k=5, threshold=0.7):
-        """搜索相似的记忆"""
-        similarities = []
+        """搜索相似的记忆，返回按相似度降序的 [(下标, 相似度, 记忆), ...]"""
+        return self.search_similar_memories_batch([query_embedding], k, threshold)[0]
 
-        for i, memory in enumerate(self.memories):
-            if 'vector' in memory:
-                similarity = self.cosine_similarity(query_embedding, np.array(memory['vector'], dtype=np.float32))
-                if similarity >= threshold:
-                    similarities.append((i, similarity, memory))
-
-        # 按相似度排序并取前k个
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        return similarities[:k]
+    def search_similar_memories_batch(self, query_embeddings, k=5, threshold=0.7, start=0):
+        """一次检索一批查询向量（一次矩阵乘法），每个查询返回与 search_similar_memories 相同格式的结果"""
+        return [[(idx, similarity, self.memories[idx]) for idx, similarity in hits]
+                for hits in self.memories.search(query_embeddings, k, threshold, start)]
 
     def extract_memory_fragments(self, chat_history):
         """从聊天历史中提取记忆片段"""
@@ -257,21 +242,21 @@ class MemoryManager:
         """
 
         try:
-            completion = self.client.chat.completions.create(
-                model="qwen-plus",
-                messages=[
-                    {"role": "system", "content": "你是一个专业的记忆提取助手，能够从对话中准确提取重要信息。"},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format={"type": "json_object"}
-            )
-
-            response = json.loads(completion.choices[0].message.content)
+            with llm_admission.slot_sync(avatar_key(self.avatar_id), PRIORITY_BACKGROUND):
+                content = self.backend.complete(
+                    messages=[
+                        {"role": "system", "content": "你是一个专业的记忆提取助手，能够从对话中准确提取重要信息。"},
+                        {"role": "user", "content": prompt}
+                    ],
+                    json_mode=True
+                )
+
+            response = json.loads(content)
             return response.get("fragments", [])
 
         except Exception as e:
             print(f"提取记忆片段失败: {e}")
-            return []
+            return None
 
     def decide_memory_integration(self, new_fragment, similar_memories):
         """决定如何整合记忆"""
@@ -301,38 +286,34 @@ class MemoryManager:
         """
 
         try:
-            completion = self.client.chat.completions.create(
-                model="qwen-plus",
-                messages=[
-                    {"role": "system", "content": "你是一个专业的记忆管理助手，能够智能地决定如何整合记忆。"},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format={"type": "json_object"}
-            )
-
-            response = json.loads(completion.choices[0].message.content)
+            with llm_admission.slot_sync(avatar_key(self.avatar_id), PRIORITY_BACKGROUND):
+                content = self.backend.complete(
+                    messages=[
+                        {"role": "system", "content": "你是一个专业的记忆管理助手，能够智能地决定如何整合记忆。"},
+                        {"role": "user", "content": prompt}
+                    ],
+                    json_mode=True
+                )
+
+            response = json.loads(content)
             return response.get("decision", "create_new"), response.get("reason", "")
 
+        except AdmissionRejected as e:
+            print(f"记忆整合决策未获得LLM名额，退回创建新记忆: {new_fragment} ({e})")
+            return "create_new", "未获得LLM名额，默认创建新记忆"
         except Exception as e:
-            print(f"记忆整合决策失败: {e}")
+            print(f"记忆整合决策失败，退回创建新记忆: {e}")
             return "create_new", "决策失败，默认创建新记忆"
 
-    def update_memory(self, fragment, fragment_embedding, decision, similar_memory_idx=None):
-        """根据决策更新记忆"""
+    def update_memory(self, fragment, fragment_embedding, decision, similar_memory_idx=None, merged_text=None):
+        """根据决策更新记忆；merged_text 为已生成的合并文本时不再调用 LLM 合并"""
         current_time = int(datetime.now().timestamp())
         fragment_norm = np.linalg.norm(fragment_embedding).astype(np.float16)
 
         if decision == "create_new":
             # 创建新记忆
-            new_memory = {
-                "vector": fragment_embedding.tolist(),
-                "norm": fragment_norm,
-                "text": fragment,
-                "frequency": 1,
-                "created_at": current_time,
-                "updated_at": current_time
-            }
-            self.memories.append(new_memory)
+            self.memories.append(fragment_embedding, fragment, norm=fragment_norm, frequency=1,
+                                 created_at=current_time, updated_at=current_time)
             print(f"创建新记忆: {fragment}")
 
         elif decision.startswith("merge_with:") and similar_memory_idx is not None:
@@ -340,11 +321,10 @@ class MemoryManager:
             memory_idx = similar_memory_idx
             if memory_idx < len(self.memories):
                 # 使用LLM合并记忆内容
-                merged_text = self.merge_memories(self.memories[memory_idx]["text"], fragment)
+                if merged_text is None:
+                    merged_text = self.merge_memories(self.memories.texts[memory_idx], fragment)
 
-                self.memories[memory_idx]["text"] = merged_text
-                self.memories[memory_idx]["updated_at"] = current_time
-                self.memories[memory_idx]["frequency"] += 1
+                self.memories.update(memory_idx, text=merged_text, updated_at=current_time, frequency_increment=1)
                 print(f"合并记忆: {fragment} -> 现有记忆#{memory_idx}")
 
         # 如果decision是"ignore"，则不进行任何操作
@@ -364,19 +344,139 @@ class MemoryManager:
         """
 
         try:
-            completion = self.client.chat.completions.create(
-                model="qwen-plus",
+            with llm_admission.slot_sync(avatar_key(self.avatar_id), PRIORITY_BACKGROUND):
+                content = self.backend.complete(
+                    messages=[
+                        {"role": "system", "content": "你擅长将相关信息合并成简洁连贯的记忆。"},
+                        {"role": "user", "content": prompt}
+                    ]
+                )
+
+            return content.strip()
+
+        except AdmissionRejected as e:
+            print(f"记忆合并未获得LLM名额，退回简单拼接: {new_fragment} ({e})")
+            return f"{existing_memory} | {new_fragment}"
+        except Exception as e:
+            print(f"记忆合并失败，退回简单拼接: {e}")
+            return f"{existing_memory} | {new_fragment}"  # 失败时简单拼接
+
+    def consolidate_memories_batch(self, fragments, batch_similar):
+        """
+        一次 LLM 调用决定全部片段的整合方式并给出合并后的文本
+        返回 (plan, merged)：plan[i] 为片段 i 的 (decision, 目标记忆下标)，merged 为 {目标记忆下标: 合并后的文本}
+        回复不完整或引用了未提供的记忆时抛出 ValueError，调用方不做任何修改
+        """
+        candidates = {}  # 记忆下标 -> 文本，每条相关记忆只列出一次
+        fragment_lines = []
+        for i, (fragment, similar) in enumerate(zip(fragments, batch_similar)):
+            refs = []
+            for idx, similarity, memory in similar:
+                candidates.setdefault(idx, memory["text"])
+                refs.append(f"M{idx}({similarity:.3f})")
+            fragment_lines.append(f"F{i + 1}. \"{fragment}\" 相似记忆: {', '.join(refs) or '无'}")
+        memory_lines = [f"M{idx}. \"{text}\"" for idx, text in sorted(candidates.items())]
+
+        prompt = f"""
+        你是一个记忆管理专家。请一次性决定如何处理以下每个新的记忆片段。
+
+        相关的现有记忆:
+        {chr(10).join(memory_lines) or "无"}
+
+        新的记忆片段（括号内为与现有记忆的相似度）:
+        {chr(10).join(fragment_lines)}
+
+        对每个片段选择以下操作之一:
+        1. 如果片段与它的某个相似记忆高度相关，选择"merge_with:MX"（MX 必须是该片段列出的相似记忆）
+        2. 如果片段是全新的信息，选择"create_new"
+        3. 如果片段不重要，或与现有记忆、本批中其他片段重复，选择"ignore"
+        对每个被合并的现有记忆，给出把所有并入它的片段与原文合并后的连贯、简洁的文本，保留所有重要信息。
+
+        请用JSON格式返回，"decisions"数组必须覆盖每个片段，"merged"给出每个被合并记忆的新文本。
+        示例: {{"decisions": [{{"fragment": "F1", "decision": "merge_with:M3", "reason": "理由"}}, {{"fragment": "F2", "decision": "create_new", "reason": "理由"}}], "merged": {{"M3": "合并后的记忆"}}}}
+        """
+
+        with llm_admission.slot_sync(avatar_key(self.avatar_id), PRIORITY_BACKGROUND):
+            content = self.backend.complete(
                 messages=[
-                    {"role": "system", "content": "你擅长将相关信息合并成简洁连贯的记忆。"},
+                    {"role": "system", "content": "你是一个专业的记忆管理助手，能够智能地决定如何整合记忆。"},
                     {"role": "user", "content": prompt}
-                ]
+                ],
+                json_mode=True
             )
-
-            return completion.choices[0].message.content.strip()
-
-        except Exception as e:
-            print(f"记忆合并失败: {e}")
-            return f"{existing_memory} | {new_fragment}"  # 失败时简单拼接
+        response = json.loads(content)
+        return self._validate_batch_decisions(response, fragments, batch_similar)
+
+    @staticmethod
+    def _validate_batch_decisions(response, fragments, batch_similar):
+        decisions, merged_texts = response.get("decisions"), response.get("merged") or {}
+        if not isinstance(decisions, list) or not isinstance(merged_texts, dict):
+            raise ValueError("missing decisions")
+
+        plan = [None] * len(fragments)
+        for item in decisions:
+            match = re.fullmatch(r"F?(\d+)", str(item.get("fragment", "")).strip())
+            i = int(match.group(1)) - 1 if match else -1
+            if not 0 <= i < len(fragments) or plan[i] is not None:
+                raise ValueError(f"invalid fragment {item.get('fragment')!r}")
+            decision = str(item.get("decision", "")).strip()
+            if decision in ("create_new", "ignore"):
+                plan[i] = (decision, None)
+                continue
+            match = re.fullmatch(r"merge_with:M?(\d+)", decision)
+            if not match or int(match.group(1)) not in {idx for idx, _, _ in batch_similar[i]}:
+                raise ValueError(f"invalid decision {decision!r} for F{i + 1}")
+            plan[i] = ("merge_with", int(match.group(1)))
+        if None in plan:
+            raise ValueError(f"no decision for F{plan.index(None) + 1}")
+
+        merged = {}
+        for _, idx in plan:
+            if idx is None or idx in merged:
+                continue
+            text = merged_texts.get(f"M{idx}", merged_texts.get(str(idx)))
+            if not isinstance(text, str) or not text.strip():
+                raise ValueError(f"no merged text for M{idx}")
+            merged[idx] = text.strip()
+        return plan, merged
+
+    def consolidate_memories_concurrent(self, fragments, batch_similar):
+        """
+        逐片段决策：各片段的决策调用并发执行，随后按目标记忆并发合并（同一记忆的多个片段依次合并）
+        返回与 consolidate_memories_batch 相同的 (plan, merged)
+        """
+        # 并发调用与同一角色的其他 LLM 调用共用单 key 上限，至少留出一个名额，否则并发调用会被 429 拒绝
+        workers = MEMORY_CONSOLIDATION_WORKERS
+        if llm_admission.max_pending_per_key:
+            workers = min(workers, llm_admission.max_pending_per_key - 1)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            decisions = list(executor.map(self.decide_memory_integration, fragments, batch_similar))
+
+            plan, targets = [], defaultdict(list)
+            for i, (decision, reason) in enumerate(decisions):
+                print(f"片段 {i + 1} 决策: {decision}, 理由: {reason}")
+                if decision.startswith("merge_with:"):
+                    # 提取要合并的记忆编号并找到对应的实际记忆下标
+                    try:
+                        idx = batch_similar[i][int(decision.split(":")[1]) - 1][0]
+                    except (IndexError, ValueError):
+                        plan.append(("create_new", None))
+                        continue
+                    plan.append(("merge_with", idx))
+                    targets[idx].append(fragments[i])
+                elif decision == "ignore":
+                    plan.append(("ignore", None))
+                else:
+                    plan.append(("create_new", None))
+
+            def merge_into(idx):
+                text = self.memories.texts[idx]
+                for fragment in targets[idx]:
+                    text = self.merge_memories(text, fragment)
+                return text
+
+            merged = dict(zip(targets, executor.map(merge_into, list(targets))))
+        return plan, merged
 
     # 将 OpenAI 消息列表转换为多行字符串格式，适配 process_chat_history
     def format_messages_to_chat_history(self, messages):
@@ -404,66 +504,64 @@ class MemoryManager:
         return "\n".join(lines)
 
     def process_chat_history(self, chat_history):
-        """处理聊天历史并更新记忆"""
+        """处理聊天历史并更新记忆，返回是否成功（失败时由记忆任务队列重试）"""
         print("开始处理聊天历史...")
         chat_history = self.format_messages_to_chat_history(chat_history)
         # 1. 加载记忆（根据memory_version决定是否从URL加载）
-        self.load_memories()
+        if not self.load_memories():
+            # 加载失败时不能继续，否则会用空记忆库覆盖已有记忆
+            return False
         print(f"当前记忆库大小: {len(self.memories)} 条记忆")
 
         # 2. 提取记忆片段
         fragments = self.extract_memory_fragments(chat_history)
+        if fragments is None:
+            return False
         print(f"提取到 {len(fragments)} 个记忆片段")
 
         if not fragments:
             print("没有提取到记忆片段，终止处理")
-            return
+            return True
 
         # 3. 为每个片段生成嵌入向量
         fragment_embeddings = self.get_embeddings(fragments)
         print(f"提取到 {len(fragment_embeddings)} 个嵌入向量")
         if not fragment_embeddings or len(fragment_embeddings) != len(fragments):
             print("嵌入向量生成失败，终止处理")
-            return
-
-        # 4. 处理每个记忆片段
-        for i, (fragment, embedding) in enumerate(zip(fragments, fragment_embeddings)):
-            print(f"\n处理片段 {i + 1}/{len(fragments)}: {fragment[:50]}...")
-
-            # 5. 搜索相似记忆（只有在有现有记忆时才搜索）
-            similar_memories = []
-            if self.memories:
-                similar_memories = self.search_similar_memories(embedding, k=5, threshold=0.7)
-                print(f"找到 {len(similar_memories)} 个相似记忆")
-            else:
-                print("记忆库为空，无需搜索相似记忆")
-
-            # 6. 决定如何整合
-            decision, reason = self.decide_memory_integration(fragment, similar_memories)
-            print(f"决策: {decision}, 理由: {reason}")
-
-            # 7. 执行更新
-            if decision.startswith("merge_with:"):
-                # 提取要合并的记忆索引
-                try:
-                    merge_idx = int(decision.split(":")[1]) - 1
-                    # 找到对应的实际记忆索引
-                    if merge_idx < len(similar_memories):
-                        actual_idx = similar_memories[merge_idx][0]
-                        self.update_memory(fragment, embedding, decision, actual_idx)
-                    else:
-                        self.update_memory(fragment, embedding, "create_new", None)
-                except (IndexError, ValueError):
-                    self.update_memory(fragment, embedding, "create_new", None)
+            return False
+
+        # 4. 一次性检索所有片段在已有记忆中的相似项
+        batch_similar = self.search_similar_memories_batch(fragment_embeddings, k=MEMORY_SIMILAR_K,
+                                                           threshold=MEMORY_SIMILAR_THRESHOLD)
+        print(f"找到相似记忆: {[len(similar) for similar in batch_similar]}")
+
+        # 5. 决定如何整合：默认一次调用给出全部决策和合并文本，回复无效时退回逐片段决策
+        plan = None
+        if not any(batch_similar):
+            # 没有任何相似记忆时全部创建为新记忆，无需调用 LLM
+            plan, merged = [("create_new", None)] * len(fragments), {}
+        elif MEMORY_BATCH_CONSOLIDATION:
+            try:
+                plan, merged = self.consolidate_memories_batch(fragments, batch_similar)
+            except Exception as e:
+                print(f"批量记忆整合失败，改为逐片段决策: {e}")
+        if plan is None:
+            plan, merged = self.consolidate_memories_concurrent(fragments, batch_similar)
+
+        # 6. 全部决策确定后统一执行更新
+        for fragment, embedding, (decision, idx) in zip(fragments, fragment_embeddings, plan):
+            if decision == "merge_with":
+                self.update_memory(fragment, embedding, f"merge_with:M{idx}", idx, merged[idx])
             else:
                 self.update_memory(fragment, embedding, decision, None)
 
-        # 8. 保存更新后的记忆
+        # 7. 保存更新后的记忆
         success = self.save_memories()
         if success:
             print(f"记忆处理完成! 新版本号: {self.memory_version}")
         else:
             print("记忆处理完成，但保存失败!")
+        return success
 
 
 # 使用示例
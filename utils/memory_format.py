@@ -0,0 +1,493 @@
+# memory_format.py
+# memory.bin 的编解码，读取时自动识别 v1/v2 两种格式，保存时使用 MEMORY_BIN_FORMAT_VERSION
+#
+# v1（旧版，无魔数，小端序）：
+#   uint32 avatar_id 长度 + avatar_id(UTF-8)
+#   uint32 memory_version, uint32 created_at, uint32 updated_at, uint32 num_entries, uint32 dim
+#   num_entries 条定长记录：float16[dim] vector, float16 norm, uint32 frequency, uint32 created_at, uint32 updated_at
+#   num_entries 条文本：uint32 长度 + UTF-8 字节
+#
+# v2（分区容器，小端序，各区起点按 64 字节对齐，可直接映射为类型化数组）：
+#   64 字节头部：magic, format_version, header_size, memory_version, created_at, updated_at,
+#               num_entries, dim, avatar_id 长度, 区数, 头部 CRC32, base_version, 保留字段
+#   avatar_id(UTF-8，补齐到 8 字节)
+#   区表：每区 (uint32 id, uint32 crc32, uint64 offset, uint64 length)，未知的区 id 读取时忽略
+#   向量区：float16[num_entries][dim]；或可选的量化编码（MEMORY_BIN_VECTOR_ENCODING="int8"，约为一半大小，有损）：
+#     int8 向量区 int8[num_entries][dim] + 缩放区 float32 scale[num_entries]，向量 = code * scale
+#   元数据区：float16 norm[num_entries]（补齐到 4 字节）, uint32 frequency[], created_at[], updated_at[]
+#   文本索引区：uint32 offset[num_entries + 1]，相对文本区起点，可随机访问任意一条文本
+#   文本区：全部文本的 UTF-8 字节依次拼接
+#   合并记录区（可选，位于其他区之前）：uint32 (版本, 头部 CRC)[]，基准快照由合并生成时记录最近并入的增量段
+#   头部 CRC 覆盖 [0, header_size)（计算时 CRC 字段按 0 处理），每个区单独校验
+#
+# 增量段（memory.deltas/<版本>.bin）使用同样的容器，magic 为 "MXMEMDLT"：
+#   base_version 为它所基于的版本，memory_version 为应用后的版本，num_entries 为写入的条目数
+#   上述四个区保存新增或修改后的条目，另有条目下标区（uint32 ids[num_entries]）和删除区（uint32 基准下标[]）
+#   应用顺序：先删除，再把第 j 条写入下标 ids[j]（替换已有条目或追加到末尾）
+#
+# 近似检索索引（memory.index）同样使用该容器，magic 为 "MXMEMIDX"：
+#   memory_version / num_entries 为建立索引时的记忆版本和条数
+#   聚类中心区（float16[聚类数][dim]）和聚类分配区（int32[num_entries]，-1 为未分配）
+#
+# 数值数据只做映射（np.frombuffer / np.memmap，零拷贝），文本在首次访问时才解码
+import zlib
+
+import numpy as np
+
+from utils.memory_store import MemoryStore, TextColumn, quantize_int8
+
+MEMORY_BIN_MAGIC = b"MXMEMBIN"
+MEMORY_DELTA_MAGIC = b"MXMEMDLT"
+MEMORY_INDEX_MAGIC = b"MXMEMIDX"
+MEMORY_BIN_FORMAT_VERSION = 2  # 保存时使用的格式版本（1 为旧版格式，供旧客户端使用）
+MEMORY_BIN_SECTION_ALIGN = 64  # v2 各区起点的对齐字节数
+MEMORY_BIN_VECTOR_ENCODING = "float16"  # v2 保存向量的编码："float16"，或有损的 "int8"（按行缩放量化，需显式开启）
+
+SECTION_VECTORS = 1
+SECTION_METADATA = 2
+SECTION_TEXT_INDEX = 3
+SECTION_TEXTS = 4
+SECTION_ENTRY_IDS = 5
+SECTION_DELETIONS = 6
+SECTION_CENTROIDS = 7
+SECTION_LISTS = 8
+SECTION_VECTORS_INT8 = 9
+SECTION_VECTOR_SCALES = 10
+SECTION_COMPACTED_DELTAS = 11
+
+_HEADER_FIELDS = ("memory_version", "created_at", "updated_at", "num_entries", "dim")
+_U32 = np.dtype("<u4")
+_V2_HEADER = np.dtype([
+    ("magic", "S8"),
+    ("format_version", "<u4"),
+    ("header_size", "<u4"),
+    ("memory_version", "<u4"),
+    ("created_at", "<u4"),
+    ("updated_at", "<u4"),
+    ("num_entries", "<u4"),
+    ("dim", "<u4"),
+    ("avatar_id_len", "<u4"),
+    ("section_count", "<u4"),
+    ("header_crc", "<u4"),
+    ("base_version", "<u4"),
+    ("reserved", "<u4", (3,)),
+])
+_V2_HEADER_CRC_AT = _V2_HEADER.fields["header_crc"][1]
+_V2_SECTION = np.dtype([("id", "<u4"), ("crc", "<u4"), ("offset", "<u8"), ("length", "<u8")])
+
+
+def record_dtype(dim):
+    """v1 单条记忆定长记录的结构化 dtype（紧凑排列，无对齐填充，与 struct 逐字段写入的布局一致）"""
+    return np.dtype([
+        ("vector", "<f2", (dim,)),
+        ("norm", "<f2"),
+        ("frequency", "<u4"),
+        ("created_at", "<u4"),
+        ("updated_at", "<u4"),
+    ])
+
+
+def _align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def _read_u32(buffer, position):
+    return int(np.frombuffer(buffer, dtype=_U32, count=1, offset=position)[0])
+
+
+def _metadata_layout(count):
+    """v2 元数据区内 norm / frequency / created_at / updated_at 的偏移，以及区的总长度"""
+    norms_size = _align(2 * count, 4)
+    return 0, norms_size, norms_size + 4 * count, norms_size + 8 * count, norms_size + 12 * count
+
+
+def _header_crc(buffer, header_size):
+    crc = zlib.crc32(buffer[:_V2_HEADER_CRC_AT])
+    crc = zlib.crc32(b"\0\0\0\0", crc)
+    return zlib.crc32(buffer[_V2_HEADER_CRC_AT + 4:header_size], crc)
+
+
+def parse_memory_bin(buffer, verify=True):
+    """
+    解析 memory.bin（bytes / bytearray / memoryview / np.memmap 均可），返回 (header, store)
+    header 中的 format_version 为文件实际的格式版本；verify=False 时跳过 v2 各区的 CRC 校验（头部始终校验）
+    格式错误、文件被截断或校验失败时抛出 ValueError
+    """
+    buffer = memoryview(buffer).cast("B")
+    try:
+        if bytes(buffer[:len(MEMORY_BIN_MAGIC)]) == MEMORY_BIN_MAGIC:
+            header, sections = read_v2_sections(buffer)
+            return header, _read_entries(buffer, sections, header["num_entries"], header["dim"], verify)
+        return _parse_v1(buffer)
+    except (ValueError, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"invalid memory.bin: {e}") from e
+
+
+def parse_memory_header(buffer):
+    """只解析 memory.bin 的头部（不读取、不校验各区），buffer 可以只是文件开头的一部分，返回 header"""
+    buffer = memoryview(buffer).cast("B")
+    try:
+        if bytes(buffer[:len(MEMORY_BIN_MAGIC)]) == MEMORY_BIN_MAGIC:
+            return _read_v2_header(buffer)[0]
+        avatar_id_len = _read_u32(buffer, 0)
+        header = {"avatar_id": bytes(buffer[4:4 + avatar_id_len]).decode("utf-8"), "format_version": 1}
+        for i, name in enumerate(_HEADER_FIELDS):
+            header[name] = _read_u32(buffer, 4 + avatar_id_len + 4 * i)
+        return header
+    except (ValueError, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"invalid memory.bin: {e}") from e
+
+
+def parse_memory_delta(buffer, verify=True):
+    """
+    解析增量段，返回 (header, deletions, ids, rows)：header["base_version"] 为基准版本，
+    rows 为写入条目组成的 MemoryStore，可直接交给 MemoryStore.apply_changes；格式错误时抛出 ValueError
+    """
+    buffer = memoryview(buffer).cast("B")
+    try:
+        if bytes(buffer[:len(MEMORY_DELTA_MAGIC)]) != MEMORY_DELTA_MAGIC:
+            raise ValueError("not a memory delta")
+        header, sections = read_v2_sections(buffer)
+        count = header["num_entries"]
+        rows = _read_entries(buffer, sections, count, header["dim"], verify)
+        _, data = _section(buffer, sections, SECTION_ENTRY_IDS, verify)
+        ids = np.frombuffer(data, dtype=_U32, count=count)
+        _, data = _section(buffer, sections, SECTION_DELETIONS, verify)
+        deletions = np.frombuffer(data, dtype=_U32, count=len(data) // 4)
+        return header, deletions, ids, rows
+    except (ValueError, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"invalid memory delta: {e}") from e
+
+
+def parse_memory_index(buffer, verify=True):
+    """解析近似检索索引，返回 (header, centroids, lists)；格式错误时抛出 ValueError"""
+    buffer = memoryview(buffer).cast("B")
+    try:
+        if bytes(buffer[:len(MEMORY_INDEX_MAGIC)]) != MEMORY_INDEX_MAGIC:
+            raise ValueError("not a memory index")
+        header, sections = read_v2_sections(buffer)
+        dim = header["dim"]
+        _, data = _section(buffer, sections, SECTION_CENTROIDS, verify)
+        if not dim or len(data) % (2 * dim):
+            raise ValueError("centroid section size mismatch")
+        centroids = np.frombuffer(data, dtype="<f2").reshape(-1, dim).astype(np.float32)
+        _, data = _section(buffer, sections, SECTION_LISTS, verify)
+        lists = np.frombuffer(data, dtype="<i4", count=header["num_entries"])
+        return header, centroids, lists
+    except (ValueError, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"invalid memory index: {e}") from e
+
+
+def _parse_v1(buffer):
+    position = 0
+    avatar_id_len = _read_u32(buffer, position)
+    position += 4
+    avatar_id = bytes(buffer[position:position + avatar_id_len]).decode("utf-8")
+    position += avatar_id_len
+    header = {"avatar_id": avatar_id, "format_version": 1}
+    for name in _HEADER_FIELDS:
+        header[name] = _read_u32(buffer, position)
+        position += 4
+
+    num_entries, dim = header["num_entries"], header["dim"]
+    dtype = record_dtype(dim)
+    records = np.frombuffer(buffer, dtype=dtype, count=num_entries, offset=position)
+    position += num_entries * dtype.itemsize
+
+    # 文本区：只记录每段文本的起止位置
+    starts, lengths = [], []
+    for _ in range(num_entries):
+        length = int.from_bytes(buffer[position:position + 4], "little")
+        starts.append(position + 4)
+        lengths.append(length)
+        position += 4 + length
+    if position > len(buffer):
+        raise ValueError("text section truncated")
+    starts = np.array(starts, dtype=np.int64)
+    lengths = np.array(lengths, dtype=np.int64)
+
+    store = MemoryStore.from_columns(records["vector"], records["norm"], records["frequency"],
+                                     records["created_at"], records["updated_at"],
+                                     TextColumn(buffer, starts, lengths), dim)
+    return header, store
+
+
+def read_compacted_deltas(buffer):
+    """
+    读取基准快照的合并记录区，返回 {增量段版本: 增量段头部 CRC}；没有该区（上传的快照、v1）时返回空字典
+    buffer 可以只是文件开头的一部分（该区位于其他区之前）
+    """
+    buffer = memoryview(buffer).cast("B")
+    try:
+        if bytes(buffer[:len(MEMORY_BIN_MAGIC)]) != MEMORY_BIN_MAGIC:
+            return {}
+        _, table_at, section_count = _read_v2_header(buffer)
+        for section in np.frombuffer(buffer, dtype=_V2_SECTION, count=section_count, offset=table_at):
+            if section["id"] != SECTION_COMPACTED_DELTAS:
+                continue
+            offset, length = int(section["offset"]), int(section["length"])
+            data = buffer[offset:offset + length]
+            if len(data) != length or length % 8 or zlib.crc32(data) != section["crc"]:
+                raise ValueError(f"section {SECTION_COMPACTED_DELTAS} truncated or corrupted")
+            pairs = np.frombuffer(data, dtype=_U32).reshape(-1, 2)
+            return {int(version): int(checksum) for version, checksum in pairs}
+        return {}
+    except (ValueError, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"invalid memory.bin: {e}") from e
+
+
+def read_v2_sections(buffer):
+    """
+    读取并校验 v2 容器（memory.bin 或增量段）的头部和区表，返回 (header, {区 id: (offset, length, crc)})
+    只需要部分区（例如只读元数据）时可单独使用，各区数据按需再校验
+    """
+    buffer = memoryview(buffer).cast("B")
+    header, table_at, section_count = _read_v2_header(buffer)
+    sections = {}
+    for section in np.frombuffer(buffer, dtype=_V2_SECTION, count=section_count, offset=table_at):
+        offset, length = int(section["offset"]), int(section["length"])
+        if offset + length > len(buffer):
+            raise ValueError(f"section {int(section['id'])} truncated")
+        sections[int(section["id"])] = (offset, length, int(section["crc"]))
+    return header, sections
+
+
+def _read_v2_header(buffer):
+    """读取并校验 v2 头部，返回 (header, 区表位置, 区数)"""
+    if len(buffer) < _V2_HEADER.itemsize:
+        raise ValueError("header truncated")
+    raw = np.frombuffer(buffer, dtype=_V2_HEADER, count=1)[0]
+    if raw["format_version"] != 2:
+        raise ValueError(f"unsupported format version {int(raw['format_version'])}")
+    header_size = int(raw["header_size"])
+    avatar_id_len = int(raw["avatar_id_len"])
+    table_at = _V2_HEADER.itemsize + _align(avatar_id_len, 8)
+    if header_size > len(buffer) or header_size < table_at + int(raw["section_count"]) * _V2_SECTION.itemsize:
+        raise ValueError("header truncated")
+    if _header_crc(buffer, header_size) != raw["header_crc"]:
+        raise ValueError("header checksum mismatch")
+
+    header = {
+        "avatar_id": bytes(buffer[_V2_HEADER.itemsize:_V2_HEADER.itemsize + avatar_id_len]).decode("utf-8"),
+        "format_version": 2,
+        "base_version": int(raw["base_version"]),
+        "checksum": int(raw["header_crc"]),
+    }
+    for name in _HEADER_FIELDS:
+        header[name] = int(raw[name])
+    return header, table_at, int(raw["section_count"])
+
+
+def _section(buffer, sections, section_id, verify):
+    if section_id not in sections:
+        raise ValueError(f"missing section {section_id}")
+    offset, length, crc = sections[section_id]
+    data = buffer[offset:offset + length]
+    if verify and zlib.crc32(data) != crc:
+        raise ValueError(f"section {section_id} checksum mismatch")
+    return offset, data
+
+
+def _read_entries(buffer, sections, count, dim, verify):
+    """
+    从向量（float16 或 int8 + 缩放）/元数据/文本索引/文本四个区构建 MemoryStore
+    int8 编码时不还原为浮点向量，记忆库直接保存码和缩放（MemoryStore.quantized）
+    """
+    scales = None
+    if SECTION_VECTORS in sections:
+        _, data = _section(buffer, sections, SECTION_VECTORS, verify)
+        vectors = np.frombuffer(data, dtype="<f2", count=count * dim).reshape(count, dim)
+    else:
+        _, data = _section(buffer, sections, SECTION_VECTORS_INT8, verify)
+        vectors = np.frombuffer(data, dtype=np.int8, count=count * dim).reshape(count, dim)
+        _, data = _section(buffer, sections, SECTION_VECTOR_SCALES, verify)
+        scales = np.frombuffer(data, dtype="<f4", count=count)
+
+    _, data = _section(buffer, sections, SECTION_METADATA, verify)
+    norms_at, frequency_at, created_at, updated_at, _ = _metadata_layout(count)
+    norms = np.frombuffer(data, dtype="<f2", count=count, offset=norms_at)
+    frequency = np.frombuffer(data, dtype=_U32, count=count, offset=frequency_at)
+    created = np.frombuffer(data, dtype=_U32, count=count, offset=created_at)
+    updated = np.frombuffer(data, dtype=_U32, count=count, offset=updated_at)
+
+    _, data = _section(buffer, sections, SECTION_TEXT_INDEX, verify)
+    text_index = np.frombuffer(data, dtype=_U32, count=count + 1).astype(np.int64)
+    texts_at, texts = _section(buffer, sections, SECTION_TEXTS, verify)
+    lengths = np.diff(text_index)
+    if text_index[0] != 0 or (lengths < 0).any() or text_index[-1] > len(texts):
+        raise ValueError("text index out of range")
+
+    return MemoryStore.from_columns(vectors, norms, frequency, created, updated,
+                                    TextColumn(buffer, texts_at + text_index[:-1], lengths), dim, scales)
+
+
+def load_memory_file(path, verify=True):
+    """以内存映射方式读取本地 memory.bin，返回 (header, store)"""
+    return parse_memory_bin(np.memmap(path, dtype=np.uint8, mode="r"), verify)
+
+
+def build_memory_bin(avatar_id, memory_version, created_at, updated_at, store, format_version=None,
+                     vector_encoding=None, compacted=None):
+    """
+    生成与 parse_memory_bin 对应的 memory.bin（bytearray），未指定格式时使用 MEMORY_BIN_FORMAT_VERSION，
+    v2 未指定向量编码时使用 MEMORY_BIN_VECTOR_ENCODING；compacted 为 {增量段版本: 头部 CRC} 时写入合并记录区
+    """
+    format_version = MEMORY_BIN_FORMAT_VERSION if format_version is None else format_version
+    if format_version == 1:
+        return _build_v1(avatar_id, memory_version, created_at, updated_at, store)
+    if format_version == 2:
+        sections = _entry_sections(store, None, vector_encoding)
+        if compacted:
+            pairs = np.array(sorted(compacted.items()), dtype=_U32).reshape(-1)
+            sections.insert(0, (SECTION_COMPACTED_DELTAS, pairs.nbytes, _copy_into(pairs)))
+        return _build_container(MEMORY_BIN_MAGIC, avatar_id, sections, memory_version=memory_version,
+                                created_at=created_at, updated_at=updated_at, num_entries=len(store), dim=store.dim)
+    raise ValueError(f"unsupported format version {format_version}")
+
+
+def build_memory_delta(avatar_id, base_version, memory_version, created_at, updated_at, store, deletions, ids,
+                       vector_encoding=None):
+    """生成增量段（bytearray）：deletions / ids 即 store.changes() 的返回值"""
+    ids = np.asarray(ids, dtype=_U32)
+    deletions = np.asarray(deletions, dtype=_U32)
+    sections = _entry_sections(store, ids, vector_encoding)
+    sections.append((SECTION_ENTRY_IDS, ids.nbytes, _copy_into(ids)))
+    sections.append((SECTION_DELETIONS, deletions.nbytes, _copy_into(deletions)))
+    return _build_container(MEMORY_DELTA_MAGIC, avatar_id, sections, memory_version=memory_version,
+                            base_version=base_version, created_at=created_at, updated_at=updated_at,
+                            num_entries=len(ids), dim=store.dim)
+
+
+def build_memory_index(avatar_id, memory_version, store):
+    """生成近似检索索引（bytearray）：store 的聚类中心和各条记忆所属的聚类"""
+    centroids = store.centroids.astype("<f2")
+    lists = np.ascontiguousarray(store.lists, dtype="<i4")
+    sections = [
+        (SECTION_CENTROIDS, centroids.nbytes, _copy_into(centroids.reshape(-1))),
+        (SECTION_LISTS, lists.nbytes, _copy_into(lists)),
+    ]
+    return _build_container(MEMORY_INDEX_MAGIC, avatar_id, sections, memory_version=memory_version,
+                            num_entries=len(store), dim=store.dim)
+
+
+def _build_v1(avatar_id, memory_version, created_at, updated_at, store):
+    """v1：各区直接写入预先分配好的缓冲区"""
+    count, dim = len(store), store.dim
+    dtype = record_dtype(dim)
+    avatar_id_bytes = avatar_id.encode("utf-8")
+    encoded = store.texts.encoded()
+    lengths = np.fromiter((len(text) for text in encoded), dtype=_U32, count=count)
+
+    header_size = 4 + len(avatar_id_bytes) + 4 * len(_HEADER_FIELDS)
+    records_end = header_size + count * dtype.itemsize
+    out = bytearray(records_end + 4 * count + int(lengths.sum()))
+
+    np.frombuffer(out, dtype=_U32, count=1)[0] = len(avatar_id_bytes)
+    out[4:4 + len(avatar_id_bytes)] = avatar_id_bytes
+    np.frombuffer(out, dtype=_U32, count=5, offset=4 + len(avatar_id_bytes))[:] = \
+        (memory_version, created_at, updated_at, count, dim)
+
+    records = np.frombuffer(out, dtype=dtype, count=count, offset=header_size)
+    records["vector"] = store.vectors
+    records["norm"] = store.norms
+    records["frequency"] = store.frequency
+    records["created_at"] = store.created_at
+    records["updated_at"] = store.updated_at
+
+    position = records_end
+    for length, text in zip(lengths.tolist(), encoded):
+        out[position:position + 4] = length.to_bytes(4, "little")
+        out[position + 4:position + 4 + length] = text
+        position += 4 + length
+    return out
+
+
+def _copy_into(array):
+    def write(out, offset):
+        np.frombuffer(out, dtype=array.dtype, count=len(array), offset=offset)[:] = array
+    return write
+
+
+def _entry_sections(store, rows, vector_encoding=None):
+    """
+    条目对应的各区 [(区 id, 长度, 写入函数)]，rows 为 None 时为全部条目
+    写入函数 write(out, offset) 把数据直接写到输出缓冲区，不生成中间的 bytes
+    """
+    dim = store.dim
+    if rows is None:
+        count, take = len(store), (lambda column: column)
+    else:
+        count, take = len(rows), (lambda column: column[rows])
+    encoded = store.texts.encoded(None if rows is None else rows.tolist())
+    text_index = np.zeros(count + 1, dtype=np.int64)
+    text_index[1:] = np.cumsum(np.fromiter((len(text) for text in encoded), dtype=np.int64, count=count))
+    if text_index[-1] > np.iinfo(_U32).max:
+        raise ValueError("text section too large")
+
+    vector_encoding = vector_encoding or MEMORY_BIN_VECTOR_ENCODING
+    if vector_encoding == "int8":
+        if store.quantized:
+            codes, scales = take(store.codes), take(store.scales)  # 直接写出原有的码，不重复量化
+        else:
+            codes, scales = quantize_int8(take(store.vectors))
+        vector_sections = [
+            (SECTION_VECTORS_INT8, codes.nbytes, _copy_into(codes.reshape(-1))),
+            (SECTION_VECTOR_SCALES, scales.nbytes, _copy_into(scales.astype("<f4"))),
+        ]
+    elif vector_encoding == "float16":
+        def write_vectors(out, offset):
+            np.frombuffer(out, dtype="<f2", count=count * dim, offset=offset).reshape(count, dim)[:] = take(store.vectors)
+        vector_sections = [(SECTION_VECTORS, 2 * count * dim, write_vectors)]
+    else:
+        raise ValueError(f"unsupported vector encoding {vector_encoding}")
+
+    def write_metadata(out, offset):
+        norms_at, frequency_at, created_at, updated_at, _ = _metadata_layout(count)
+        np.frombuffer(out, dtype="<f2", count=count, offset=offset + norms_at)[:] = take(store.norms)
+        np.frombuffer(out, dtype=_U32, count=count, offset=offset + frequency_at)[:] = take(store.frequency)
+        np.frombuffer(out, dtype=_U32, count=count, offset=offset + created_at)[:] = take(store.created_at)
+        np.frombuffer(out, dtype=_U32, count=count, offset=offset + updated_at)[:] = take(store.updated_at)
+
+    def write_texts(out, offset):
+        for text in encoded:
+            out[offset:offset + len(text)] = text
+            offset += len(text)
+
+    return vector_sections + [
+        (SECTION_METADATA, _metadata_layout(count)[-1], write_metadata),
+        (SECTION_TEXT_INDEX, 4 * (count + 1), _copy_into(text_index.astype(_U32))),
+        (SECTION_TEXTS, int(text_index[-1]), write_texts),
+    ]
+
+
+def _build_container(magic, avatar_id, sections, **fields):
+    """v2 容器：先确定各区位置，再把各区直接写入预先分配好的缓冲区，最后填写区表和 CRC"""
+    avatar_id_bytes = avatar_id.encode("utf-8")
+    table_at = _V2_HEADER.itemsize + _align(len(avatar_id_bytes), 8)
+    header_size = table_at + len(sections) * _V2_SECTION.itemsize
+    offsets, position = [], _align(header_size, MEMORY_BIN_SECTION_ALIGN)
+    for _, length, _ in sections:
+        offsets.append(position)
+        end = position + length
+        position = _align(end, MEMORY_BIN_SECTION_ALIGN)
+    out = bytearray(end if sections else header_size)
+
+    view = memoryview(out)
+    table = np.frombuffer(out, dtype=_V2_SECTION, count=len(sections), offset=table_at)
+    for row, offset, (section_id, length, write) in zip(table, offsets, sections):
+        write(out, offset)
+        row["id"], row["offset"], row["length"] = section_id, offset, length
+        row["crc"] = zlib.crc32(view[offset:offset + length])
+
+    out[_V2_HEADER.itemsize:_V2_HEADER.itemsize + len(avatar_id_bytes)] = avatar_id_bytes
+    header = np.frombuffer(out, dtype=_V2_HEADER, count=1)
+    header["magic"] = magic
+    header["format_version"] = 2
+    header["header_size"] = header_size
+    header["avatar_id_len"] = len(avatar_id_bytes)
+    header["section_count"] = len(sections)
+    for name, value in fields.items():
+        header[name] = value
+    header["header_crc"] = _header_crc(view, header_size)
+    view.release()
+    return out
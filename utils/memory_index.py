@@ -0,0 +1,91 @@
+# memory_index.py
+# 每个角色可选的 IVF 近似检索索引：球面 k-means 聚类中心 + 每条记忆所属的聚类
+# 保存在 memory.bin 旁边（<avatar_id>/memory.index），检索时只计算最近的几个聚类中的记忆（见 MemoryStore.search）
+# 新增的记忆在 MemoryStore.extend 中直接分配到最近的聚类（增量更新），条数增长较多后才重新训练聚类中心
+import numpy as np
+
+from utils import memory_segments
+from utils.memory_format import build_memory_index, parse_memory_index
+from utils.memory_store import MEMORY_ANN_MIN_ENTRIES
+
+MEMORY_ANN_ENABLED = True
+MEMORY_ANN_ITERATIONS = 10  # k-means 迭代次数
+MEMORY_ANN_TRAIN_SAMPLE = 20000  # 训练时最多使用的向量数
+MEMORY_ANN_RETRAIN_GROWTH = 4  # 条数增长到训练时的该倍数后重新训练（聚类数随 √n 增长）
+
+
+def index_key(avatar_id):
+    return f"{avatar_id}/memory.index"
+
+
+def list_count(size):
+    """聚类数：约为 √n，每个聚类平均 √n 条记忆"""
+    return max(1, int(round(np.sqrt(size))))
+
+
+def train_centroids(vectors, nlist, iterations=MEMORY_ANN_ITERATIONS, seed=0):
+    """球面 k-means：向量和聚类中心都单位化，按余弦相似度分配，返回 (nlist, dim) 的单位化聚类中心"""
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors) > MEMORY_ANN_TRAIN_SAMPLE:
+        vectors = vectors[rng.choice(len(vectors), MEMORY_ANN_TRAIN_SAMPLE, replace=False)]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms > 0, norms, 1)
+    nlist = min(nlist, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)]
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        # 按聚类排序后分段求和，避免 np.add.at 的逐元素开销
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=nlist)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        filled = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[filled] = np.add.reduceat(vectors[order], starts[filled], axis=0)
+        # 空聚类用随机向量重新初始化
+        sums[~filled] = vectors[rng.choice(len(vectors), int((~filled).sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.where(norms > 0, norms, 1)
+    return centroids
+
+
+def needs_training(store):
+    if len(store) < MEMORY_ANN_MIN_ENTRIES:
+        return False
+    return store.centroids is None or len(store) >= MEMORY_ANN_RETRAIN_GROWTH * len(store.centroids) ** 2
+
+
+def load_index(avatar_id, store, memory_version):
+    """
+    读取保存的索引并设置到 store，返回是否启用了近似检索
+    索引与当前记忆版本一致时直接使用保存的聚类分配，否则只复用聚类中心、重新分配全部条目
+    """
+    if not MEMORY_ANN_ENABLED or len(store) < MEMORY_ANN_MIN_ENTRIES:
+        return False
+    data = memory_segments.storage.get(index_key(avatar_id))
+    if data is None:
+        return False
+    try:
+        header, centroids, lists = parse_memory_index(data)
+    except ValueError as e:
+        print(f"读取记忆索引失败 avatar_id={avatar_id}: {e}")
+        return False
+    if header["dim"] != store.dim:
+        return False
+    current = header["memory_version"] == memory_version and header["num_entries"] == len(store)
+    store.set_centroids(centroids, lists if current else None)
+    return True
+
+
+def update_index(avatar_id, store, memory_version):
+    """
+    记忆写入成功后调用：条数足够时按需（重新）训练聚类中心，并保存当前的聚类分配，返回是否保存了索引
+    新增条目已在追加时分配到最近的聚类，未重新训练时只需重写分配区
+    """
+    if not MEMORY_ANN_ENABLED or len(store) < MEMORY_ANN_MIN_ENTRIES:
+        return False
+    if needs_training(store):
+        store.set_centroids(train_centroids(store.vectors, list_count(len(store))))
+        print(f"记忆索引训练完成 avatar_id={avatar_id}: {len(store)} 条记忆, {len(store.centroids)} 个聚类")
+    memory_segments.storage.put(index_key(avatar_id), build_memory_index(avatar_id, memory_version, store))
+    return True
@@ -0,0 +1,204 @@
+# memory_job_queue.py
+# 持久化的记忆任务队列（SQLite WAL）：会话到期时先把历史写入任务表，处理成功后才删除，
+# 进程崩溃或上游出错都不会丢失；失败按指数退避重试，超过次数后标记为 failed 保留待人工处理
+# 出队采用租约：同一角色的所有就绪任务一次性租给一个 worker（合并为一个任务），
+# 租约未过期期间其他 worker/进程不会处理该角色，持有者崩溃后租约到期自动释放
+import json
+import random
+import sqlite3
+import time
+
+MEMORY_JOB_DB = "memory_jobs.db"
+MEMORY_JOB_LEASE_SECONDS = 60  # 租约时长（秒），处理期间由 worker 定期续约
+MEMORY_JOB_MAX_ATTEMPTS = 8  # 最大尝试次数，超过后标记为 failed
+MEMORY_JOB_RETRY_BASE = 30  # 首次重试延迟（秒），之后每次翻倍
+MEMORY_JOB_RETRY_MAX = 3600  # 重试延迟上限（秒）
+
+
+class LeasedJob:
+    """一次租约取得的任务：同一角色的若干条历史"""
+    __slots__ = ("ids", "avatar_id", "messages", "histories", "attempts", "created_at")
+
+    def __init__(self, ids, avatar_id, messages, histories, attempts, created_at):
+        self.ids = ids
+        self.avatar_id = avatar_id
+        self.messages = messages
+        self.histories = histories
+        self.attempts = attempts
+        self.created_at = created_at
+
+
+def retry_delay(attempts):
+    """第 attempts 次失败后的重试延迟：指数退避，带 ±10% 抖动避免集中重试"""
+    delay = min(MEMORY_JOB_RETRY_BASE * 2 ** (attempts - 1), MEMORY_JOB_RETRY_MAX)
+    return delay * random.uniform(0.9, 1.1)
+
+
+class MemoryJobQueue:
+    """线程安全：每次操作使用独立连接，可被多个线程/进程同时使用"""
+
+    def __init__(self, path=None, lease_seconds=MEMORY_JOB_LEASE_SECONDS, max_attempts=MEMORY_JOB_MAX_ATTEMPTS):
+        self.path = path or MEMORY_JOB_DB
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS memory_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                avatar_id TEXT NOT NULL,
+                base_memory_version INTEGER DEFAULT 0,  /* 会话开始时的记忆版本（仅用于排查） */
+                messages TEXT NOT NULL,                 /* OpenAI 格式消息的 JSON */
+                priority INTEGER DEFAULT 1,
+                status TEXT DEFAULT 'pending',          /* pending / failed */
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires_at REAL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_memory_jobs_ready ON memory_jobs (status, priority, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_memory_jobs_avatar ON memory_jobs (avatar_id, lease_expires_at)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def enqueue_many(self, jobs, max_pending=None, full_policy="drop_oldest"):
+        """
+        批量入队 [(avatar_id, base_memory_version, messages, priority), ...]
+        超过 max_pending 时按 full_policy 丢弃最早的待处理任务或拒绝新任务，返回丢弃的任务数
+        """
+        if not jobs:
+            return 0
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                dropped = 0
+                if max_pending is not None:
+                    pending = conn.execute("SELECT COUNT(*) FROM memory_jobs WHERE status = 'pending'").fetchone()[0]
+                    overflow = pending + len(jobs) - max_pending
+                    if overflow > 0 and full_policy == "drop_newest":
+                        dropped, jobs = overflow, jobs[:max(len(jobs) - overflow, 0)]
+                    elif overflow > 0:
+                        # 只丢弃没有被租用的任务，正在处理的不受影响
+                        dropped = conn.execute("""
+                            DELETE FROM memory_jobs WHERE id IN (
+                                SELECT id FROM memory_jobs WHERE status = 'pending' AND lease_expires_at <= ?
+                                ORDER BY created_at LIMIT ?)
+                        """, (now, overflow)).rowcount
+                conn.executemany("""
+                    INSERT INTO memory_jobs (avatar_id, base_memory_version, messages, priority, next_attempt_at, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, [(avatar_id, base_version, json.dumps(messages, ensure_ascii=False), priority, now, now)
+                      for avatar_id, base_version, messages, priority in jobs])
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return dropped
+        finally:
+            conn.close()
+
+    def lease(self, owner, max_messages=None):
+        """
+        租用优先级最高、且该角色当前没有租约的一组就绪任务，返回 LeasedJob；没有时返回 None
+        同一角色的就绪历史按时间顺序合并为一个任务，合并后的消息数不超过 max_messages；
+        其余历史不被租用、留在表中，由之后的任务依次处理（单条历史超过上限时单独成为一个任务，不截断）
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("""
+                    SELECT avatar_id FROM memory_jobs AS j
+                    WHERE status = 'pending' AND next_attempt_at <= ? AND lease_expires_at <= ?
+                      AND NOT EXISTS (SELECT 1 FROM memory_jobs AS r WHERE r.avatar_id = j.avatar_id AND r.lease_expires_at > ?)
+                    ORDER BY priority, created_at LIMIT 1
+                """, (now, now, now)).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                avatar_id = row[0]
+                rows, count = [], 0
+                for r in conn.execute("""
+                    SELECT id, messages, attempts, created_at FROM memory_jobs
+                    WHERE avatar_id = ? AND status = 'pending' AND next_attempt_at <= ? AND lease_expires_at <= ?
+                    ORDER BY created_at, id
+                """, (avatar_id, now, now)):
+                    messages = json.loads(r[1])
+                    if rows and max_messages is not None and count + len(messages) > max_messages:
+                        break
+                    rows.append((r[0], messages, r[2], r[3]))
+                    count += len(messages)
+                ids = [r[0] for r in rows]
+                conn.execute(f"""
+                    UPDATE memory_jobs SET lease_owner = ?, lease_expires_at = ?
+                    WHERE id IN ({",".join("?" * len(ids))})
+                """, (owner, now + self.lease_seconds, *ids))
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        messages = []
+        for r in rows:
+            messages.extend(r[1])
+        return LeasedJob(ids, avatar_id, messages, len(rows), max(r[2] for r in rows), min(r[3] for r in rows))
+
+    def _update_leased(self, sql, params, job, owner):
+        conn = self._connect()
+        try:
+            conn.execute(f"{sql} WHERE id IN ({','.join('?' * len(job.ids))}) AND lease_owner = ?",
+                         (*params, *job.ids, owner))
+        finally:
+            conn.close()
+
+    def renew(self, job, owner):
+        """续约（处理时间较长时由 worker 定期调用）"""
+        self._update_leased("UPDATE memory_jobs SET lease_expires_at = ?", (time.time() + self.lease_seconds,),
+                            job, owner)
+
+    def complete(self, job, owner):
+        self._update_leased("DELETE FROM memory_jobs", (), job, owner)
+
+    def fail(self, job, owner, error):
+        """记录失败：未超过最大次数时按指数退避重新排队，否则标记为 failed"""
+        attempts = job.attempts + 1
+        if attempts >= self.max_attempts:
+            self._update_leased("""
+                UPDATE memory_jobs SET status = 'failed', attempts = attempts + 1, last_error = ?,
+                                       lease_owner = NULL, lease_expires_at = 0
+            """, (error,), job, owner)
+        else:
+            self._update_leased("""
+                UPDATE memory_jobs SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?,
+                                       lease_owner = NULL, lease_expires_at = 0
+            """, (error, time.time() + retry_delay(attempts)), job, owner)
+        return attempts
+
+    def stats(self):
+        now = time.time()
+        conn = self._connect()
+        try:
+            pending, leased, retrying, failed = conn.execute("""
+                SELECT
+                    COALESCE(SUM(status = 'pending'), 0),
+                    COALESCE(SUM(status = 'pending' AND lease_expires_at > ?), 0),
+                    COALESCE(SUM(status = 'pending' AND next_attempt_at > ?), 0),
+                    COALESCE(SUM(status = 'failed'), 0)
+                FROM memory_jobs
+            """, (now, now)).fetchone()
+        finally:
+            conn.close()
+        return {"pending": pending, "leased": leased, "retrying": retrying, "abandoned": failed}
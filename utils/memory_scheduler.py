@@ -0,0 +1,218 @@
+# memory_scheduler.py
+# 记忆生成任务调度器：按角色串行、合并排队中的同角色历史、有界队列、可配置工作线程数
+# 同一角色同一时刻只有一个任务在运行，后续到期的会话历史合并为一个任务，
+# 避免两个任务从同一个 memory_version 出发、后上传的覆盖先上传的
+# 任务持久化在 MemoryJobQueue 中：提交后由写入线程批量落盘，工作线程按租约取出，
+# 成功后删除、失败后退避重试，进程重启后自动继续处理未完成的任务
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from utils.memory_job_queue import MemoryJobQueue
+
+MEMORY_WORKERS = 2  # 记忆生成工作线程数
+MEMORY_QUEUE_MAX_JOBS = 1000  # 待处理任务数上限
+MEMORY_QUEUE_FULL_POLICY = "drop_oldest"  # 队列满时的策略：drop_oldest 丢弃最早的任务 / drop_newest 拒绝新任务
+MEMORY_JOB_MAX_MESSAGES = 400  # 合并后单个任务的消息数上限，超出的历史留给之后的任务
+MEMORY_PRIORITY_HIGH = 0  # 因容量上限被淘汰的会话（用户很可能刚刚还在活跃）
+MEMORY_PRIORITY_NORMAL = 1  # 正常过期的会话
+MEMORY_QUEUE_POLL_INTERVAL = 1  # 没有就绪任务时的轮询间隔（秒），用于发现到期的重试和其他进程提交的任务
+MEMORY_METRICS_WINDOW = 1000  # 延迟统计保留的最近任务数
+MEMORY_SHUTDOWN_TIMEOUT = 30  # 关闭时等待正在运行的任务的最长时间（秒），超时的任务由租约到期后重新处理
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class MemoryJobScheduler:
+    """
+    线程安全的记忆任务调度器，submit 不阻塞，可在事件循环或任意线程中调用
+    runner(avatar_id, messages, histories) 在工作线程中执行，抛出异常表示失败、稍后重试
+    """
+
+    def __init__(self, runner, queue=None, workers=MEMORY_WORKERS, max_jobs=MEMORY_QUEUE_MAX_JOBS,
+                 full_policy=MEMORY_QUEUE_FULL_POLICY):
+        self.runner = runner
+        self.queue = queue  # 未指定时在启动时按 MEMORY_JOB_DB 创建
+        self.max_jobs = max_jobs
+        self.full_policy = full_policy
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"  # 租约持有者标识
+        self._cond = threading.Condition()
+        self._buffer = []  # 尚未落盘的提交
+        self._running = 0
+        self._closed = False
+        self.submitted = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self._wait_times = deque(maxlen=MEMORY_METRICS_WINDOW)
+        self._run_times = deque(maxlen=MEMORY_METRICS_WINDOW)
+        self._writer = threading.Thread(target=self._write_loop, name="MemoryQueueWriter", daemon=True)
+        self._threads = [threading.Thread(target=self._worker, name=f"MemoryWorker-{i}", daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        """启动写入线程和工作线程；任务表中上次未完成的任务会被继续处理"""
+        if self.queue is None:
+            self.queue = MemoryJobQueue()
+        self._writer.start()
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, avatar_id, messages, priority=MEMORY_PRIORITY_NORMAL, base_memory_version=0):
+        """提交一段会话历史，返回是否被接受"""
+        if not messages:
+            return True
+        with self._cond:
+            if self._closed:
+                print(f"记忆调度器已关闭，丢弃任务 avatar_id={avatar_id}")
+                self.dropped += 1
+                return False
+            self.submitted += 1
+            self._buffer.append((avatar_id, base_memory_version, list(messages), priority))
+            self._cond.notify_all()
+            return True
+
+    def _flush(self):
+        """把缓冲的提交批量写入任务表，返回是否成功"""
+        with self._cond:
+            batch, self._buffer = self._buffer, []
+        if not batch:
+            return True
+        try:
+            dropped = self.queue.enqueue_many(batch, self.max_jobs, self.full_policy)
+        except Exception as e:
+            print(f"记忆任务写入失败: {e}")
+            with self._cond:
+                self._buffer[:0] = batch
+            return False
+        with self._cond:
+            if dropped:
+                self.dropped += dropped
+                print(f"记忆队列已满，丢弃 {dropped} 个任务（{self.full_policy}）")
+            self._cond.notify_all()  # 唤醒工作线程取新任务
+        return True
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    self._cond.wait()
+                closing = self._closed
+            if self._flush():
+                if closing:
+                    return
+            elif closing:
+                print(f"关闭时记忆任务写入失败，丢弃 {len(self._buffer)} 个任务")
+                return
+            else:
+                time.sleep(MEMORY_QUEUE_POLL_INTERVAL)  # 稍后重试
+
+    def _renew_until(self, job, done):
+        """处理期间定期续约，避免长任务的租约过期被其他 worker 重复处理"""
+        while not done.wait(self.queue.lease_seconds / 3):
+            try:
+                self.queue.renew(job, self.owner)
+            except Exception as e:
+                print(f"记忆任务续约失败 avatar_id={job.avatar_id}: {e}")
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+            try:
+                job = self.queue.lease(self.owner, MEMORY_JOB_MAX_MESSAGES)
+            except Exception as e:
+                print(f"记忆任务出队失败: {e}")
+                job = None
+            if job is None:
+                with self._cond:
+                    if not self._closed:
+                        self._cond.wait(MEMORY_QUEUE_POLL_INTERVAL)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        with self._cond:
+            self._running += 1
+        started = time.time()
+        done = threading.Event()
+        keeper = threading.Thread(target=self._renew_until, args=(job, done), daemon=True)
+        keeper.start()
+        error = None
+        try:
+            self.runner(job.avatar_id, job.messages, job.histories)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        finally:
+            done.set()
+            keeper.join()
+        finished = time.time()
+        try:
+            if error is None:
+                self.queue.complete(job, self.owner)
+            else:
+                attempts = self.queue.fail(job, self.owner, error)
+                print(f"记忆任务失败 avatar_id={job.avatar_id}（第 {attempts} 次）: {error}")
+        except Exception as e:
+            # 状态没写回时租约到期后任务会被重新处理
+            print(f"记忆任务状态写入失败 avatar_id={job.avatar_id}: {e}")
+        with self._cond:
+            self._running -= 1
+            self._wait_times.append(started - job.created_at)
+            self._run_times.append(finished - started)
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def shutdown(self, wait=True, timeout=MEMORY_SHUTDOWN_TIMEOUT):
+        """
+        停止接收新任务并把缓冲的提交落盘；wait=True 时最多等待 timeout 秒让正在运行的任务完成
+        （任务可能在后台优先级的准入队列中等待很久）。尚未开始的任务保留在任务表中，
+        超时仍在运行的任务随进程退出停止续约，租约到期后由下次启动的进程重新处理
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if not self._writer.is_alive():
+            # 未启动时直接落盘
+            if self.queue is None:
+                self.queue = MemoryJobQueue()
+            self._flush()
+            return
+        self._writer.join()
+        if wait:
+            deadline = time.monotonic() + timeout
+            for thread in self._threads:
+                thread.join(max(0.0, deadline - time.monotonic()))
+            with self._cond:
+                running = self._running
+            if running:
+                print(f"记忆调度器关闭超时，{running} 个任务仍在运行，租约到期后重新处理")
+
+    def stats(self):
+        with self._cond:
+            wait_times, run_times = list(self._wait_times), list(self._run_times)
+            stats = {
+                "buffered": len(self._buffer),
+                "running": self._running,
+                "submitted": self.submitted,
+                "dropped": self.dropped,
+                "completed": self.completed,
+                "failed": self.failed,
+                "wait_p50_s": round(_percentile(wait_times, 0.50), 3),
+                "wait_p95_s": round(_percentile(wait_times, 0.95), 3),
+                "run_p50_s": round(_percentile(run_times, 0.50), 3),
+                "run_p95_s": round(_percentile(run_times, 0.95), 3),
+            }
+        if self.queue is not None:
+            stats.update(self.queue.stats())
+        return stats
@@ -0,0 +1,241 @@
+# memory_segments.py
+# 角色记忆的存储布局：基准快照 <avatar_id>/memory.bin + 只追加的增量段 <avatar_id>/memory.deltas/<版本>.bin
+# 每次记忆整理只写入一个增量段（新增/修改的条目和删除的下标），客户端和记忆任务只需读取本地版本之后的增量段
+# 增量段累积到一定数量或大小后在后台合并为新的基准快照（compaction），旧的增量段随后删除
+# 文件通过 memory_storage 读写（本地目录 / S3 兼容对象存储 / 内存），记忆任务和 FastAPI 路由共用
+import threading
+import time
+from datetime import datetime
+
+from utils.memory_format import (build_memory_bin, load_memory_file, parse_memory_delta, parse_memory_bin,
+                                 parse_memory_header, read_compacted_deltas)
+from utils.memory_storage import create_memory_storage
+from utils.memory_store import MemoryStore
+
+MEMORY_COMPACT_MIN_DELTAS = 16  # 增量段达到该数量时合并
+MEMORY_COMPACT_DELTA_RATIO = 0.5  # 增量段总大小超过基准快照的该比例时合并
+MEMORY_COMPACT_LOCK_TTL = 300  # 合并锁的有效期（秒），持有进程崩溃后超时自动失效
+MEMORY_COMPACTED_HISTORY = 64  # 基准快照的合并记录保留最近并入的增量段数
+_HEADER_READ_SIZE = 64 * 1024  # 读取基准快照头部时读取的字节数（头部和合并记录只有几百字节）
+
+storage = create_memory_storage()
+
+
+class MemoryVersionConflict(Exception):
+    """增量段的基准版本不是当前最新版本（并发写入或基于过期版本生成），需要重新加载后再生成"""
+
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def _avatar_lock(avatar_id):
+    """进程内按角色的锁；跨进程依靠独占写入（增量段和合并锁）"""
+    with _locks_guard:
+        return _locks.setdefault(avatar_id, threading.Lock())
+
+
+def base_key(avatar_id):
+    return f"{avatar_id}/memory.bin"
+
+
+def delta_key(avatar_id, version):
+    return f"{avatar_id}/memory.deltas/{version}.bin"
+
+
+def _list_deltas(avatar_id):
+    """[(版本, key, 大小), ...]，按版本排序"""
+    prefix = f"{avatar_id}/memory.deltas/"
+    deltas = []
+    for key, size in storage.list(prefix):
+        name = key[len(prefix):]
+        if name.endswith(".bin") and name[:-4].isdigit():
+            deltas.append((int(name[:-4]), key, size))
+    return sorted(deltas)
+
+
+def _base_header(avatar_id):
+    """(基准快照的版本, 大小)，没有基准快照时为 (0, 0)"""
+    base_size = storage.size(base_key(avatar_id)) or 0
+    if not base_size:
+        return 0, 0
+    return parse_memory_header(storage.get_range(base_key(avatar_id), 0, _HEADER_READ_SIZE))["memory_version"], base_size
+
+
+def _base_compacted(avatar_id):
+    """(基准快照的版本, 合并记录 {增量段版本: 头部 CRC})，没有基准快照时为 (0, {})"""
+    data = storage.get_range(base_key(avatar_id), 0, _HEADER_READ_SIZE)
+    if not data:
+        return 0, {}
+    return parse_memory_header(data)["memory_version"], read_compacted_deltas(data)
+
+
+def manifest(avatar_id):
+    """
+    当前存储状态：{"avatar_id", "base_version", "base_size", "version", "deltas": [{"version", "size"}, ...]}
+    version 为应用全部增量段后的最新版本；没有基准快照时 base_version 为 0（空记忆库）
+    """
+    base_version, base_size = _base_header(avatar_id)
+
+    # 只有从基准版本开始连续的增量段才有效
+    deltas, version = [], base_version
+    for delta_version, _, size in _list_deltas(avatar_id):
+        if delta_version <= base_version:
+            continue
+        if delta_version != version + 1:
+            break
+        deltas.append({"version": delta_version, "size": size})
+        version = delta_version
+    return {"avatar_id": avatar_id, "base_version": base_version, "base_size": base_size,
+            "version": version, "deltas": deltas}
+
+
+def read_base(avatar_id):
+    """读取基准快照，返回 (header, store)；不存在时返回 None。本地存储直接内存映射"""
+    path = storage.local_path(base_key(avatar_id))
+    if path is not None:
+        return load_memory_file(path) if path.exists() else None
+    data = storage.get(base_key(avatar_id))
+    return None if data is None else parse_memory_bin(data)
+
+
+def read_delta(avatar_id, version):
+    """读取增量段，返回 parse_memory_delta 的结果；已被合并删除时返回 None"""
+    data = storage.get(delta_key(avatar_id, version))
+    return None if data is None else parse_memory_delta(data)
+
+
+def write_snapshot(avatar_id, data):
+    """写入完整快照：校验后替换基准快照，并删除全部增量段（它们基于被替换的历史）"""
+    header, _ = parse_memory_bin(data)
+    with _avatar_lock(avatar_id):
+        storage.put(base_key(avatar_id), data)
+        _remove_deltas(avatar_id, None)
+    return header["memory_version"]
+
+
+def append_delta(avatar_id, data):
+    """
+    追加一个增量段：校验格式，且其基准版本必须是当前最新版本，否则抛出 MemoryVersionConflict
+    返回追加后的版本号
+    进程内由 _avatar_lock 串行；跨进程时，另一个进程的合并可能在读取 manifest 之后把同一版本号的增量段
+    并入新的基准快照并删除，此时独占写入会重新创建这个已被合并的版本、且永远不会被应用。
+    合并总是先写入基准快照再删除增量段，并在基准快照中记录并入的增量段，因此写入后再读一次基准快照：
+    版本已覆盖本增量段、但合并记录中不是本增量段（头部 CRC 不同）时，说明写入的是过期版本
+    """
+    header, _, _, _ = parse_memory_delta(data)
+    if header["avatar_id"] != avatar_id:
+        raise ValueError("avatar_id mismatch")
+    with _avatar_lock(avatar_id):
+        current = manifest(avatar_id)["version"]
+        if header["base_version"] != current or header["memory_version"] != current + 1:
+            raise MemoryVersionConflict(
+                f"delta {header['base_version']}->{header['memory_version']} does not apply to version {current}")
+        # 独占写入：其他进程已写入同一版本时失败
+        key = delta_key(avatar_id, header["memory_version"])
+        if not storage.put_if_absent(key, data):
+            raise MemoryVersionConflict(f"version {header['memory_version']} already exists")
+        base_version, compacted = _base_compacted(avatar_id)
+        if base_version >= header["memory_version"] and compacted.get(header["memory_version"]) != header["checksum"]:
+            storage.delete(key)
+            raise MemoryVersionConflict(f"version {header['memory_version']} was already compacted into the base")
+    return header["memory_version"]
+
+
+def load_head(avatar_id):
+    """读取基准快照并依次应用增量段，返回 (version, store, created_at)"""
+    version, store, created_at, _ = _load_head(avatar_id)
+    return version, store, created_at
+
+
+def _load_head(avatar_id):
+    """同 load_head，另外返回已应用的增量段 {版本: 头部 CRC}"""
+    state = manifest(avatar_id)
+    store, created_at = None, int(datetime.now().timestamp())
+    if state["base_version"]:
+        header, store = read_base(avatar_id)
+        created_at = header["created_at"]
+    version, applied = state["base_version"], {}
+    for delta in state["deltas"]:
+        parsed = read_delta(avatar_id, delta["version"])
+        if parsed is None:
+            raise ValueError(f"delta {delta['version']} is gone")
+        header, deletions, ids, rows = parsed
+        if header["base_version"] != version:
+            raise ValueError(f"delta {delta['version']} does not apply to version {version}")
+        if store is None:
+            store = MemoryStore(header["dim"])
+        store.apply_changes(deletions, ids, rows)
+        version = header["memory_version"]
+        applied[version] = header["checksum"]
+    return version, store if store is not None else MemoryStore(), created_at, applied
+
+
+def needs_compaction(state):
+    if not state["deltas"]:
+        return False
+    delta_size = sum(delta["size"] for delta in state["deltas"])
+    return len(state["deltas"]) >= MEMORY_COMPACT_MIN_DELTAS or delta_size > state["base_size"] * MEMORY_COMPACT_DELTA_RATIO
+
+
+def _remove_deltas(avatar_id, up_to):
+    """删除版本 <= up_to 的增量段（up_to 为 None 时全部删除）"""
+    for version, key, _ in _list_deltas(avatar_id):
+        if up_to is None or version <= up_to:
+            storage.delete(key)
+
+
+def _acquire_compact_lock(lock_key):
+    if storage.put_if_absent(lock_key, str(time.time()).encode("ascii")):
+        return True
+    try:
+        locked_at = float(storage.get(lock_key) or 0)
+    except ValueError:
+        locked_at = 0
+    if time.time() - locked_at < MEMORY_COMPACT_LOCK_TTL:
+        return False
+    # 持有者已崩溃：删除过期的锁后重新竞争
+    storage.delete(lock_key)
+    return storage.put_if_absent(lock_key, str(time.time()).encode("ascii"))
+
+
+def compact(avatar_id, force=False):
+    """
+    把基准快照和增量段合并为新的基准快照，返回是否执行了合并
+    合并期间新追加的增量段不受影响；其他进程正在合并同一角色时直接跳过
+    """
+    state = manifest(avatar_id)
+    if not state["deltas"] or not (force or needs_compaction(state)):
+        return False
+    lock_key = f"{avatar_id}/memory.compact.lock"
+    if not _acquire_compact_lock(lock_key):
+        return False
+    try:
+        # 合并记录沿用旧基准快照的记录（基准快照被替换时下面会放弃合并），只保留最近的若干个
+        _, compacted = _base_compacted(avatar_id)
+        version, store, created_at, applied = _load_head(avatar_id)
+        compacted = dict(sorted({**compacted, **applied}.items())[-MEMORY_COMPACTED_HISTORY:])
+        data = build_memory_bin(avatar_id, version, created_at, int(datetime.now().timestamp()), store,
+                                compacted=compacted)
+        del store  # 释放对旧快照的映射
+        with _avatar_lock(avatar_id):
+            # 合并期间基准快照被整体替换（write_snapshot，同时删除了增量段）时放弃，不能用旧历史覆盖新上传的记忆
+            current = manifest(avatar_id)
+            if current["base_version"] != state["base_version"] or current["base_size"] != state["base_size"] \
+                    or current["version"] < version:
+                print(f"记忆合并放弃 avatar_id={avatar_id}: 基准快照已被替换")
+                return False
+            storage.put(base_key(avatar_id), data)
+            _remove_deltas(avatar_id, version)
+        print(f"记忆合并完成 avatar_id={avatar_id}: {len(state['deltas'])} 个增量段 -> 版本 {version}")
+        return True
+    finally:
+        storage.delete(lock_key)
+
+
+def compact_if_needed(avatar_id):
+    """在后台调用（写入增量段之后），失败不影响写入结果"""
+    try:
+        compact(avatar_id)
+    except Exception as e:
+        print(f"记忆合并失败 avatar_id={avatar_id}: {e}")
@@ -0,0 +1,448 @@
+# memory_storage.py
+# 记忆文件的存储后端：记忆任务和 FastAPI 路由共用同一个实例直接读写，不再经由 HTTP 回环访问自身
+# - LocalStorage：本地目录（默认 assets/），写入先写临时文件再原子替换，本地文件可直接内存映射
+# - S3Storage：S3 兼容的对象存储（AWS S3 / MinIO / OSS 等），SigV4 签名，复用连接
+# - InMemoryStorage：进程内字典，用于测试
+# 所有后端都提供：原子写入 put、独占写入 put_if_absent、流式读取 stream、按范围读取 get_range、按前缀列出 list
+import datetime
+import hashlib
+import hmac
+import os
+import threading
+import uuid
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from stat import S_ISREG
+from urllib.parse import quote, urlparse, parse_qs
+
+import requests
+
+MEMORY_STORAGE_LOCAL_ROOT = "assets"
+MEMORY_STORAGE_CHUNK_SIZE = 256 * 1024  # 流式读取的块大小（字节）
+MEMORY_STORAGE_TIMEOUT = 30  # 对象存储请求超时（秒）
+
+
+class MemoryStorage:
+    """存储后端接口，key 为以 / 分隔的相对路径，如 "<avatar_id>/memory.bin"；读取不存在的 key 时返回 None"""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_range(self, key, start, length):
+        """读取 [start, start + length) 范围的字节（文件较短时返回实际长度）"""
+        data = self.get(key)
+        return None if data is None else data[start:start + length]
+
+    def stream(self, key, chunk_size=MEMORY_STORAGE_CHUNK_SIZE):
+        """按块读取，返回字节块的迭代器；key 不存在时返回 None"""
+        data = self.get(key)
+        if data is None:
+            return None
+        return (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+
+    def size(self, key):
+        raise NotImplementedError
+
+    def put(self, key, data):
+        """原子写入：读者只会看到旧内容或完整的新内容"""
+        raise NotImplementedError
+
+    def put_if_absent(self, key, data):
+        """仅在 key 不存在时写入，返回是否写入（多个进程同时写入同一 key 时只有一个成功）"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def list(self, prefix):
+        """列出以 prefix 开头的 key，返回 [(key, size), ...]"""
+        raise NotImplementedError
+
+    def local_path(self, key):
+        """本地文件路径（可直接内存映射）；非本地存储返回 None"""
+        return None
+
+
+class LocalStorage(MemoryStorage):
+    def __init__(self, root=MEMORY_STORAGE_LOCAL_ROOT):
+        self.root = Path(root).resolve()
+
+    def _path(self, key):
+        path = (self.root / key).resolve()
+        if self.root not in path.parents:
+            raise ValueError(f"invalid storage key: {key}")
+        return path
+
+    def get(self, key):
+        try:
+            return self._path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def get_range(self, key, start, length):
+        try:
+            with open(self._path(key), "rb") as f:
+                f.seek(start)
+                return f.read(length)
+        except FileNotFoundError:
+            return None
+
+    def stream(self, key, chunk_size=MEMORY_STORAGE_CHUNK_SIZE):
+        try:
+            f = open(self._path(key), "rb")
+        except FileNotFoundError:
+            return None
+
+        def chunks():
+            with f:
+                while chunk := f.read(chunk_size):
+                    yield chunk
+        return chunks()
+
+    def size(self, key):
+        try:
+            return self._path(key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def _write_tmp(self, path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        return tmp
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.replace(self._write_tmp(path, data), path)
+
+    def put_if_absent(self, key, data):
+        path = self._path(key)
+        tmp = self._write_tmp(path, data)
+        try:
+            # 硬链接是独占的：目标已存在时失败，且读者不会看到写了一半的文件
+            os.link(tmp, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.unlink(tmp)
+
+    def delete(self, key):
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix):
+        directory = self._path(prefix.rsplit("/", 1)[0]) if "/" in prefix else self.root
+        if not directory.is_dir():
+            return []
+        result = []
+        for path in directory.rglob("*"):
+            key = path.relative_to(self.root).as_posix()
+            if not key.startswith(prefix) or path.name.startswith("."):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # 遍历期间被其他进程删除（如合并后删除增量段）
+            if S_ISREG(stat.st_mode):
+                result.append((key, stat.st_size))
+        return result
+
+    def local_path(self, key):
+        return self._path(key)
+
+
+class InMemoryStorage(MemoryStorage):
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._objects.get(key)
+
+    def size(self, key):
+        data = self.get(key)
+        return None if data is None else len(data)
+
+    def put(self, key, data):
+        with self._lock:
+            self._objects[key] = bytes(data)
+
+    def put_if_absent(self, key, data):
+        with self._lock:
+            if key in self._objects:
+                return False
+            self._objects[key] = bytes(data)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._objects.pop(key, None)
+
+    def list(self, prefix):
+        with self._lock:
+            return [(key, len(data)) for key, data in self._objects.items() if key.startswith(prefix)]
+
+
+class S3Storage(MemoryStorage):
+    """
+    S3 兼容对象存储（路径风格 URL：<endpoint>/<bucket>/<key>），请求使用 AWS SigV4 签名
+    独占写入使用条件写入 If-None-Match: *（AWS S3、MinIO 等均已支持）
+    """
+    _NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region="us-east-1", prefix=""):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self._host = urlparse(self.endpoint).netloc
+        self._session = requests.Session()  # 复用连接
+
+    def _signing_key(self, datestamp):
+        key = f"AWS4{self.secret_key}".encode("utf-8")
+        for part in (datestamp, self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+        return key
+
+    def _request(self, method, key=None, query=None, data=b"", headers=None, stream=False):
+        path = f"/{self.bucket}" + (f"/{quote(self.prefix + key, safe='/~')}" if key is not None else "")
+        query = query or {}
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date, datestamp = now.strftime("%Y%m%dT%H%M%SZ"), now.strftime("%Y%m%d")
+        payload_hash = hashlib.sha256(data).hexdigest()
+        canonical_query = "&".join(f"{quote(k, safe='~')}={quote(str(v), safe='~')}" for k, v in sorted(query.items()))
+        canonical_headers = f"host:{self._host}\nx-amz-content-sha256:{payload_hash}\nx-amz-date:{amz_date}\n"
+        signed_headers = "host;x-amz-content-sha256;x-amz-date"
+        canonical_request = "\n".join([method, path, canonical_query, canonical_headers, signed_headers, payload_hash])
+        scope = f"{datestamp}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()])
+        signature = hmac.new(self._signing_key(datestamp), string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        request_headers = {
+            "x-amz-date": amz_date,
+            "x-amz-content-sha256": payload_hash,
+            "Authorization": f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                             f"SignedHeaders={signed_headers}, Signature={signature}",
+            **(headers or {}),
+        }
+        url = self.endpoint + path + (f"?{canonical_query}" if canonical_query else "")
+        return self._session.request(method, url, data=data or None, headers=request_headers, stream=stream,
+                                     timeout=MEMORY_STORAGE_TIMEOUT)
+
+    def get(self, key):
+        response = self._request("GET", key)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.content
+
+    def get_range(self, key, start, length):
+        response = self._request("GET", key, headers={"Range": f"bytes={start}-{start + length - 1}"})
+        if response.status_code == 404:
+            return None
+        if response.status_code == 416:
+            return b""
+        response.raise_for_status()
+        return response.content[:length] if response.status_code == 200 else response.content
+
+    def stream(self, key, chunk_size=MEMORY_STORAGE_CHUNK_SIZE):
+        response = self._request("GET", key, stream=True)
+        if response.status_code == 404:
+            response.close()
+            return None
+        response.raise_for_status()
+
+        def chunks():
+            with response:
+                yield from response.iter_content(chunk_size)
+        return chunks()
+
+    def size(self, key):
+        response = self._request("HEAD", key)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return int(response.headers["Content-Length"])
+
+    def put(self, key, data):
+        self._request("PUT", key, data=bytes(data)).raise_for_status()
+
+    def put_if_absent(self, key, data):
+        response = self._request("PUT", key, data=bytes(data), headers={"If-None-Match": "*"})
+        if response.status_code in (409, 412):
+            return False
+        response.raise_for_status()
+        return True
+
+    def delete(self, key):
+        response = self._request("DELETE", key)
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    def list(self, prefix):
+        result, token = [], None
+        while True:
+            query = {"list-type": "2", "prefix": self.prefix + prefix}
+            if token:
+                query["continuation-token"] = token
+            response = self._request("GET", query=query)
+            response.raise_for_status()
+            root = ET.fromstring(response.content)
+            for item in root.iter(f"{self._NS}Contents"):
+                key = item.find(f"{self._NS}Key").text[len(self.prefix):]
+                result.append((key, int(item.find(f"{self._NS}Size").text)))
+            if root.findtext(f"{self._NS}IsTruncated") != "true":
+                return result
+            token = root.findtext(f"{self._NS}NextContinuationToken")
+
+
+class S3StandInServer:
+    """
+    S3 兼容接口的本地替身服务（内存实现，不校验签名，只要求带 SigV4 Authorization 头），用于测试 S3Storage：
+    PUT（支持 If-None-Match: *）、GET（支持 Range）、HEAD、DELETE、ListObjectsV2（支持分页）
+    """
+    _PAGE_SIZE = 1000
+
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self, host="127.0.0.1", port=0):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=b"", headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _route(self):
+                if not self.headers.get("Authorization", "").startswith("AWS4-HMAC-SHA256 "):
+                    self._reply(403)
+                    return None
+                parsed = urlparse(self.path)
+                bucket, _, key = parsed.path.lstrip("/").partition("/")
+                return key, {k: v[0] for k, v in parse_qs(parsed.query).items()}
+
+            def do_PUT(self):
+                route = self._route()
+                if route is None:
+                    return
+                data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stand_in._lock:
+                    if self.headers.get("If-None-Match") == "*" and route[0] in stand_in.objects:
+                        self._reply(412)
+                        return
+                    stand_in.objects[route[0]] = data
+                self._reply(200)
+
+            def do_DELETE(self):
+                route = self._route()
+                if route is not None:
+                    with stand_in._lock:
+                        stand_in.objects.pop(route[0], None)
+                    self._reply(204)
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                route = self._route()
+                if route is None:
+                    return
+                key, query = route
+                if not key and query.get("list-type") == "2":
+                    self._list(query)
+                    return
+                with stand_in._lock:
+                    data = stand_in.objects.get(key)
+                if data is None:
+                    self._reply(404)
+                    return
+                if self.command == "GET" and self.headers.get("Range", "").startswith("bytes="):
+                    start, _, end = self.headers["Range"][6:].partition("-")
+                    start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+                    if start >= len(data):
+                        self._reply(416)
+                        return
+                    self._reply(206, data[start:end + 1],
+                                {"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if self.command == "GET":
+                    self.wfile.write(data)
+
+            def _list(self, query):
+                prefix = query.get("prefix", "")
+                with stand_in._lock:
+                    keys = sorted(k for k in stand_in.objects if k.startswith(prefix))
+                    sizes = {k: len(stand_in.objects[k]) for k in keys}
+                start = keys.index(query["continuation-token"]) if query.get("continuation-token") in keys else 0
+                page = keys[start:start + stand_in._PAGE_SIZE]
+                truncated = start + stand_in._PAGE_SIZE < len(keys)
+                root = ET.Element("ListBucketResult", xmlns="http://s3.amazonaws.com/doc/2006-03-01/")
+                for key in page:
+                    item = ET.SubElement(root, "Contents")
+                    ET.SubElement(item, "Key").text = key
+                    ET.SubElement(item, "Size").text = str(sizes[key])
+                ET.SubElement(root, "IsTruncated").text = "true" if truncated else "false"
+                if truncated:
+                    ET.SubElement(root, "NextContinuationToken").text = keys[start + stand_in._PAGE_SIZE]
+                self._reply(200, ET.tostring(root), {"Content-Type": "application/xml"})
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[1]
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def create_memory_storage():
+    """
+    根据环境变量创建记忆存储：
+    MEMORY_STORAGE=local（默认，MEMORY_STORAGE_URL 为目录）/ s3（MEMORY_STORAGE_URL 为 http(s)://<endpoint>/<bucket>[/<前缀>]，
+    凭证读取 AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY / AWS_REGION）/ memory（进程内，仅用于测试）
+    """
+    kind = os.environ.get("MEMORY_STORAGE", "local")
+    url = os.environ.get("MEMORY_STORAGE_URL", "")
+    if kind == "s3":
+        parsed = urlparse(url or "http://127.0.0.1:9000/matesx")
+        bucket, _, prefix = parsed.path.lstrip("/").partition("/")
+        return S3Storage(f"{parsed.scheme}://{parsed.netloc}", bucket,
+                         os.environ.get("AWS_ACCESS_KEY_ID", ""), os.environ.get("AWS_SECRET_ACCESS_KEY", ""),
+                         os.environ.get("AWS_REGION", "us-east-1"), prefix)
+    if kind == "memory":
+        return InMemoryStorage()
+    return LocalStorage(url or MEMORY_STORAGE_LOCAL_ROOT)
+
+
+if __name__ == "__main__":
+    # 启动本地 S3 兼容替身服务：python -m utils.memory_storage
+    server = S3StandInServer()
+    port = server.start(port=9000)
+    print(f"S3 兼容替身服务已启动: http://127.0.0.1:{port}/matesx")
+    threading.Event().wait()
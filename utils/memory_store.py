@@ -0,0 +1,410 @@
+# memory_store.py
+# 记忆库的紧凑内存表示：所有向量存放在一个连续矩阵中，并预先计算每行模长的倒数，
+# 相似度检索是一次矩阵乘法加 argpartition 取 top-k，且支持一次检索一批查询向量
+# 同时记录自上次 mark_clean 以来的变更（新增/修改/删除的条目），用于生成增量段
+# 设置了 IVF 聚类中心（见 memory_index）且条数足够多时，检索只计算最近的若干个聚类中的记忆
+# 从 int8 编码的 memory.bin 加载时直接保存 int8 码和每行缩放（内存约为 float32 的 1/4），在码上计算相似度
+import numpy as np
+
+MEMORY_DEFAULT_DIM = 768
+MEMORY_ANN_MIN_ENTRIES = 2000  # 条数少于该值时始终精确检索
+MEMORY_ANN_NPROBE = 8  # 近似检索时每个查询检索的聚类数
+MEMORY_SCORE_CHUNK = 4096  # int8 码按块转换为 float32 后做矩阵乘法（numpy 没有 int8 矩阵乘法），限制临时内存
+
+
+def quantize_int8(vectors):
+    """按行缩放的 int8 量化：scale = max|v| / 127，code = round(v / scale)，返回 (codes, scales)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = (np.abs(vectors).max(axis=1, initial=0) / 127).astype(np.float32)
+    codes = np.rint(vectors / np.where(scales > 0, scales, 1)[:, None])
+    return np.clip(codes, -127, 127).astype(np.int8), scales
+
+
+class TextColumn:
+    """
+    文本列：可直接引用 memory.bin 的文本区（只保存每段的起止位置），首次访问时才解码；
+    修改和新追加的文本以 str 保存
+    """
+    __slots__ = ("_buffer", "_starts", "_lengths", "_texts")
+
+    def __init__(self, buffer=None, starts=None, lengths=None):
+        self._buffer = buffer
+        self._starts = starts
+        self._lengths = lengths
+        self._texts = [None] * (0 if starts is None else len(starts))
+
+    def __len__(self):
+        return len(self._texts)
+
+    def _raw(self, index):
+        start = int(self._starts[index])
+        return bytes(self._buffer[start:start + int(self._lengths[index])])
+
+    def __getitem__(self, index):
+        text = self._texts[index]
+        if text is None:
+            text = self._texts[index] = self._raw(index).decode("utf-8")
+        return text
+
+    def __setitem__(self, index, text):
+        self._texts[index] = text
+
+    def __iter__(self):
+        for index in range(len(self._texts)):
+            yield self[index]
+
+    def append(self, text):
+        self._texts.append(text)
+
+    def extend(self, texts):
+        self._texts.extend(texts)
+
+    def delete(self, keep):
+        """按布尔掩码 keep 删除文本；尚未解码的文本仍然只保存位置"""
+        lazy = 0 if self._starts is None else len(self._starts)
+        if lazy:
+            self._starts = self._starts[keep[:lazy]]
+            self._lengths = self._lengths[keep[:lazy]]
+        self._texts = [text for text, kept in zip(self._texts, keep) if kept]
+
+    def encoded(self, indices=None):
+        """文本的UTF-8字节（indices 为 None 时为全部）；从未解码过的直接取原始字节，不经过 str"""
+        if indices is None:
+            indices = range(len(self._texts))
+        return [self._raw(index) if self._texts[index] is None else self._texts[index].encode("utf-8")
+                for index in indices]
+
+
+class MemoryStore:
+    """
+    按列存储的记忆条目：
+    - vectors: (n, dim) float32 连续矩阵（容量按倍数增长，追加为均摊 O(dim)）；
+      quantized 时实际保存 int8 码 codes 和每行缩放 scales（向量 = code * scale），vectors 返回还原后的副本
+    - inv_norms: 每条向量模长的倒数（模为 0 时为 0，相似度恒为 0）；quantized 时为码的模长倒数，
+      余弦相似度与每行缩放无关，检索直接在码上计算
+    - norms / frequency / created_at / updated_at: 与 memory.bin 中的字段一一对应
+    - texts: 文本列（TextColumn）
+    变更记录：origin 为每条记忆在上次 mark_clean 时的下标（之后新增的为 -1），modified 标记之后被修改过的条目
+    近似检索：centroids 为单位化的 IVF 聚类中心，lists 为每条记忆所属的聚类（-1 为未分配，检索时总是参与计算）
+    """
+    _COLUMNS = ("_vectors", "_scales", "_inv_norms", "_norms", "_frequency", "_created_at", "_updated_at", "_origin",
+                "_modified", "_lists")
+
+    def __init__(self, dim=MEMORY_DEFAULT_DIM, capacity=0):
+        self.dim = dim
+        self._size = 0
+        self.quantized = False
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._scales = np.ones(capacity, dtype=np.float32)
+        self._inv_norms = np.zeros(capacity, dtype=np.float32)
+        self._norms = np.zeros(capacity, dtype=np.float16)
+        self._frequency = np.zeros(capacity, dtype=np.uint32)
+        self._created_at = np.zeros(capacity, dtype=np.uint32)
+        self._updated_at = np.zeros(capacity, dtype=np.uint32)
+        self._origin = np.full(capacity, -1, dtype=np.int64)
+        self._modified = np.zeros(capacity, dtype=bool)
+        self._clean_size = 0
+        self._lists = np.full(capacity, -1, dtype=np.int32)
+        self.centroids = None
+        self.texts = TextColumn()
+
+    @classmethod
+    def from_columns(cls, vectors, norms, frequency, created_at, updated_at, texts, dim, scales=None):
+        """
+        由 memory.bin 中映射出的各列数组构建（每列一次向量化转换，不逐条处理）
+        提供 scales 时 vectors 为 int8 码，记忆库保持量化存储（quantized）
+        """
+        store = cls(dim)
+        if scales is None:
+            store._vectors = np.asarray(vectors).astype(np.float32).reshape(-1, dim)
+            store._scales = np.ones(len(store._vectors), dtype=np.float32)
+        else:
+            store.quantized = True
+            store._vectors = np.asarray(vectors).astype(np.int8).reshape(-1, dim)
+            store._scales = np.asarray(scales).astype(np.float32)
+        store._inv_norms = cls._inverse(cls._row_norms(store._vectors))
+        store._norms = np.asarray(norms).astype(np.float16)
+        store._frequency = np.asarray(frequency).astype(np.uint32)
+        store._created_at = np.asarray(created_at).astype(np.uint32)
+        store._updated_at = np.asarray(updated_at).astype(np.uint32)
+        store.texts = texts
+        store._size = len(store._vectors)
+        store._origin = np.arange(store._size, dtype=np.int64)
+        store._modified = np.zeros(store._size, dtype=bool)
+        store._clean_size = store._size
+        store._lists = np.full(store._size, -1, dtype=np.int32)
+        return store
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def vectors(self):
+        if self.quantized:
+            return self._vectors[:self._size] * self._scales[:self._size, None]
+        return self._vectors[:self._size]
+
+    @property
+    def codes(self):
+        """quantized 时为 int8 码矩阵"""
+        return self._vectors[:self._size]
+
+    @property
+    def scales(self):
+        return self._scales[:self._size]
+
+    @property
+    def inv_norms(self):
+        return self._inv_norms[:self._size]
+
+    @property
+    def norms(self):
+        return self._norms[:self._size]
+
+    @property
+    def frequency(self):
+        return self._frequency[:self._size]
+
+    @property
+    def created_at(self):
+        return self._created_at[:self._size]
+
+    @property
+    def updated_at(self):
+        return self._updated_at[:self._size]
+
+    @property
+    def lists(self):
+        return self._lists[:self._size]
+
+    def _reserve(self, capacity):
+        if capacity <= len(self._vectors):
+            return
+        capacity = max(capacity, 2 * len(self._vectors), 16)
+        for name in self._COLUMNS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    @staticmethod
+    def _row_norms(vectors):
+        # einsum 不产生与矩阵同样大小的平方临时数组（int8 码按 float32 累加）
+        return np.sqrt(np.einsum("ij,ij->i", vectors, vectors, dtype=np.float32))
+
+    @staticmethod
+    def _inverse(norms):
+        with np.errstate(divide="ignore"):
+            return np.where(norms > 0, 1.0 / norms, 0.0).astype(np.float32)
+
+    @staticmethod
+    def _matmul(queries, vectors):
+        """queries @ vectors.T；int8 码按 MEMORY_SCORE_CHUNK 行分块转换，不一次性展开整个矩阵"""
+        if vectors.dtype != np.int8:
+            return queries @ vectors.T
+        out = np.empty((len(queries), len(vectors)), dtype=np.float32)
+        for i in range(0, len(vectors), MEMORY_SCORE_CHUNK):
+            out[:, i:i + MEMORY_SCORE_CHUNK] = queries @ vectors[i:i + MEMORY_SCORE_CHUNK].astype(np.float32).T
+        return out
+
+    def _encode(self, vectors):
+        """把 float32 向量转换为本记忆库的存储形式，返回 (存储的向量, 缩放, 模长倒数)"""
+        if not self.quantized:
+            return vectors, 1.0, self._inverse(self._row_norms(vectors))
+        codes, scales = quantize_int8(vectors)
+        return codes, scales, self._inverse(self._row_norms(codes))
+
+    def extend(self, vectors, texts, norms=None, frequency=1, created_at=0, updated_at=0):
+        """批量追加；vectors 为 (m, dim) 数组，其余字段可为标量或长度为 m 的数组（quantized 时追加前量化）"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        count = len(vectors)
+        if count != len(texts):
+            raise ValueError("vectors and texts length mismatch")
+        start, end = self._size, self._size + count
+        self._reserve(end)
+        stored, scales, inv_norms = self._encode(vectors)
+        self._vectors[start:end] = stored
+        self._scales[start:end] = scales
+        self._inv_norms[start:end] = inv_norms
+        self._norms[start:end] = self._row_norms(vectors) if norms is None else norms
+        self._frequency[start:end] = frequency
+        self._created_at[start:end] = created_at
+        self._updated_at[start:end] = updated_at
+        self._origin[start:end] = -1
+        self._modified[start:end] = False
+        self._lists[start:end] = self._assign(stored)
+        self.texts.extend(texts)
+        self._size = end
+
+    def append(self, vector, text, norm=None, frequency=1, created_at=0, updated_at=0):
+        """追加一条记忆，返回其下标"""
+        self.extend(np.asarray(vector)[None, :], [text], None if norm is None else [norm],
+                    frequency, created_at, updated_at)
+        return self._size - 1
+
+    def update(self, index, text=None, updated_at=None, frequency_increment=0):
+        """修改一条记忆的文本/时间戳/频率（向量不变，检索结果仍然有效）"""
+        if not 0 <= index < self._size:
+            raise IndexError("memory index out of range")
+        if text is not None:
+            self.texts[index] = text
+        if updated_at is not None:
+            self._updated_at[index] = updated_at
+        self._frequency[index] += frequency_increment
+        self._modified[index] = True
+
+    def delete(self, indices):
+        """删除若干条记忆，其后的条目下标前移"""
+        keep = np.ones(self._size, dtype=bool)
+        keep[np.asarray(indices, dtype=np.int64)] = False
+        for name in self._COLUMNS:
+            column = getattr(self, name)[:self._size]
+            setattr(self, name, column[keep])
+        self.texts.delete(keep)
+        self._size = int(keep.sum())
+
+    def mark_clean(self):
+        """把当前状态作为之后计算变更的基准（加载完成或增量段上传成功后调用）"""
+        self._origin[:self._size] = np.arange(self._size)
+        self._modified[:self._size] = False
+        self._clean_size = self._size
+
+    def changes(self):
+        """
+        自上次 mark_clean 以来的变更，返回 (deletions, ids)：
+        deletions 为被删除条目在基准中的下标，ids 为需要写入的条目（新增或修改过的）的当前下标
+        按先删除、再按 ids 写入的顺序应用到基准上即可得到当前状态
+        """
+        origin = self._origin[:self._size]
+        kept = np.zeros(self._clean_size, dtype=bool)
+        kept[origin[origin >= 0]] = True
+        deletions = np.flatnonzero(~kept)
+        ids = np.flatnonzero((origin < 0) | self._modified[:self._size])
+        return deletions, ids
+
+    def apply_changes(self, deletions, ids, rows):
+        """
+        应用一个增量段：先删除 deletions（基准下标），再把 rows 的第 j 条写入下标 ids[j]
+        （小于当前条数时替换，等于当前条数时追加），变更记录随之更新
+        """
+        deletions = np.unique(np.asarray(deletions, dtype=np.int64))
+        ids = np.asarray(ids, dtype=np.int64)
+        size = self._size - len(deletions)
+        replaced = ids < size
+        appended = np.flatnonzero(~replaced)
+        # 先整体校验，不合法的增量段不会改动记忆库
+        if (len(deletions) and deletions[-1] >= self._size) or \
+                not np.array_equal(ids[appended], np.arange(size, size + len(appended))):
+            raise ValueError("delta entry ids out of range")
+        if len(deletions):
+            self.delete(deletions)
+        targets = ids[replaced]
+        sources = np.flatnonzero(replaced)
+        self._vectors[targets], self._scales[targets], self._inv_norms[targets] = self._encode(rows.vectors[sources])
+        self._norms[targets] = rows.norms[sources]
+        self._frequency[targets] = rows.frequency[sources]
+        self._created_at[targets] = rows.created_at[sources]
+        self._updated_at[targets] = rows.updated_at[sources]
+        self._modified[targets] = True
+        self._lists[targets] = self._assign(self._vectors[targets])
+        for target, source in zip(targets.tolist(), sources.tolist()):
+            self.texts[target] = rows.texts[source]
+
+        self.extend(rows.vectors[appended], [rows.texts[j] for j in appended.tolist()],
+                    rows.norms[appended], rows.frequency[appended], rows.created_at[appended],
+                    rows.updated_at[appended])
+
+    def _assign(self, vectors):
+        """每个向量（或 int8 码，按行缩放不影响结果）最近的聚类中心；没有聚类中心时为 -1"""
+        if self.centroids is None:
+            return np.full(len(vectors), -1, dtype=np.int32)
+        return np.argmax(self._matmul(self.centroids, vectors), axis=0).astype(np.int32)
+
+    def set_centroids(self, centroids, lists=None):
+        """
+        设置 IVF 聚类中心（None 为取消近似检索）；lists 为已知的各条记忆所属聚类（与当前条目一一对应），
+        未提供时重新分配全部条目
+        """
+        if centroids is None:
+            self.centroids = None
+            self._lists[:self._size] = -1
+            return
+        centroids = np.asarray(centroids, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        self.centroids = centroids / np.where(norms > 0, norms, 1)
+        if lists is not None and len(lists) == self._size:
+            lists = np.asarray(lists, dtype=np.int32)
+            if (lists < len(self.centroids)).all():
+                self._lists[:self._size] = lists
+                return
+        self._lists[:self._size] = self._assign(self._vectors[:self._size])
+
+    def entry(self, index):
+        """以字典形式返回一条记忆（与旧版 memories 列表的元素格式相同）"""
+        return {
+            "vector": (self._vectors[index] * self._scales[index]).tolist(),
+            "norm": float(self._norms[index]),
+            "text": self.texts[index],
+            "frequency": int(self._frequency[index]),
+            "created_at": int(self._created_at[index]),
+            "updated_at": int(self._updated_at[index]),
+        }
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("memory index out of range")
+        return self.entry(index)
+
+    def __iter__(self):
+        for index in range(self._size):
+            yield self.entry(index)
+
+    def similarities(self, queries, start=0):
+        """查询向量与第 start 条之后所有记忆的余弦相似度矩阵 (m, n - start)"""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        query_inv_norms = self._inverse(np.linalg.norm(queries, axis=1))
+        scores = self._matmul(queries, self._vectors[start:self._size])
+        scores *= query_inv_norms[:, None]
+        scores *= self._inv_norms[start:self._size][None, :]
+        return scores
+
+    def search(self, queries, k=5, threshold=0.7, start=0, exact=False):
+        """
+        批量检索：对每个查询向量返回相似度 >= threshold 的前 k 条 [(index, similarity), ...]，按相似度降序
+        start > 0 时只检索第 start 条及之后的记忆（用于增量检索新追加的条目）
+        设置了聚类中心且条数不少于 MEMORY_ANN_MIN_ENTRIES 时为近似检索，exact=True 时强制精确检索
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if self._size <= start or k <= 0:
+            return [[] for _ in range(len(queries))]
+        if not exact and self.centroids is not None and self._size - start >= MEMORY_ANN_MIN_ENTRIES:
+            return self._search_ann(queries, k, threshold, start)
+        scores = self.similarities(queries, start)
+        candidates = np.arange(start, self._size)
+        return [self._top_k(row, candidates, k, threshold) for row in scores]
+
+    @staticmethod
+    def _top_k(scores, candidates, k, threshold):
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(candidates[i]), float(scores[i])) for i in top if scores[i] >= threshold]
+
+    def _search_ann(self, queries, k, threshold, start):
+        """只计算每个查询最近的 MEMORY_ANN_NPROBE 个聚类中的记忆（以及未分配聚类的记忆）"""
+        nprobe = min(MEMORY_ANN_NPROBE, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        lists = self._lists[start:self._size]
+        query_inv_norms = self._inverse(np.linalg.norm(queries, axis=1))
+        results = []
+        for query, inv_norm, probe in zip(queries, query_inv_norms, probes):
+            candidates = np.flatnonzero(np.isin(lists, probe) | (lists < 0)) + start
+            scores = self._matmul(query[None, :], self._vectors[candidates])[0]
+            scores *= inv_norm
+            scores *= self._inv_norms[candidates]
+            results.append(self._top_k(scores, candidates, k, threshold))
+        return results
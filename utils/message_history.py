@@ -0,0 +1,94 @@
+# message_history.py
+# 会话历史的紧凑存储：固定容量环形缓冲区，角色用单字节编码，内容可选以UTF-8字节保存
+import sys
+from array import array
+
+ROLES = ("system", "user", "assistant", "tool")
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+
+class MessageHistory:
+    """
+    固定容量的环形缓冲区，append/popleft 均为 O(1)
+    - 角色存为 bytearray 中的单字节编码，避免每条消息重复持有角色字符串
+    - 每条消息的token数缓存在 array('I') 中
+    - store_bytes=True 时内容以UTF-8字节保存（中文内容约省去一半以上的str开销），读取时再解码
+    迭代时按需生成 OpenAI 格式的 {"role", "content"} 字典，不保留中间列表
+    """
+    __slots__ = ("capacity", "store_bytes", "total_tokens", "_roles", "_contents", "_tokens", "_start", "_size")
+
+    def __init__(self, capacity=100, store_bytes=False):
+        self.capacity = capacity
+        self.store_bytes = store_bytes
+        self.total_tokens = 0
+        self._roles = bytearray(capacity)
+        self._contents = [None] * capacity
+        self._tokens = array("I", bytes(4 * capacity))
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _slot(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("message index out of range")
+        return (self._start + index) % self.capacity
+
+    def _message(self, slot):
+        content = self._contents[slot]
+        if self.store_bytes:
+            content = content.decode("utf-8")
+        return {"role": ROLES[self._roles[slot]], "content": content}
+
+    def append(self, role, content, tokens=0):
+        """追加一条消息；缓冲区已满时覆盖最旧的一条并返回它，否则返回 None"""
+        dropped = self.popleft() if self._size == self.capacity else None
+        slot = (self._start + self._size) % self.capacity
+        self._roles[slot] = ROLE_CODES[role]
+        self._contents[slot] = content.encode("utf-8") if self.store_bytes else content
+        self._tokens[slot] = tokens
+        self._size += 1
+        self.total_tokens += tokens
+        return dropped
+
+    def popleft(self):
+        """移除并返回最旧的一条消息"""
+        if not self._size:
+            raise IndexError("pop from empty history")
+        slot = self._start
+        message = self._message(slot)
+        self.total_tokens -= self._tokens[slot]
+        self._contents[slot] = None
+        self._start = (self._start + 1) % self.capacity
+        self._size -= 1
+        return message
+
+    def __getitem__(self, index):
+        return self._message(self._slot(index))
+
+    def role(self, index):
+        return ROLES[self._roles[self._slot(index)]]
+
+    def tokens(self, index):
+        return self._tokens[self._slot(index)]
+
+    def iter_messages(self, start=0):
+        """从第 start 条开始按时间顺序产出 OpenAI 格式的消息"""
+        for index in range(max(start, 0), self._size):
+            yield self._message((self._start + index) % self.capacity)
+
+    __iter__ = iter_messages
+
+    def to_list(self):
+        return list(self.iter_messages())
+
+    def nbytes(self):
+        """估算本历史占用的内存（字节）"""
+        size = sys.getsizeof(self._roles) + sys.getsizeof(self._contents) + sys.getsizeof(self._tokens)
+        for content in self._contents:
+            if content is not None:
+                size += sys.getsizeof(content)
+        return size
@@ -0,0 +1,148 @@
+# response_cache.py
+# 按角色缓存常见短句（"你好"、"在吗"、"再见"）的回复，命中时无需再请求上游LLM
+# 缓存键：avatar_id + 上下文指纹（系统提示词 + 最近历史）+ 归一化后的用户输入；支持精确匹配和向量相似度匹配
+# 系统提示词中包含每个用户自己的记忆摘要，必须参与指纹，否则同一角色的不同用户可能拿到彼此的回复
+import asyncio
+import hashlib
+import threading
+import unicodedata
+
+import numpy as np
+from cachetools import TTLCache
+
+from utils.embedding_cache import get_cached_embeddings
+from utils.llm_backend import get_llm_backend
+
+RESPONSE_CACHE_ENABLED = False  # 默认关闭，需要时手动开启
+RESPONSE_CACHE_SEMANTIC = True  # 精确匹配未命中时是否再做向量相似度匹配
+RESPONSE_CACHE_MAXSIZE = 10000  # 最大缓存条数（超出按LRU淘汰）
+RESPONSE_CACHE_TTL = 3600  # 缓存有效期（秒）
+RESPONSE_CACHE_MAX_PROMPT_CHARS = 20  # 仅缓存短句输入
+RESPONSE_CACHE_CONTEXT_MESSAGES = 2  # 参与上下文指纹的最近消息条数
+RESPONSE_CACHE_SIMILARITY = 0.95  # 相似度匹配阈值
+
+
+def normalize_prompt(prompt):
+    """归一化用户输入：全半角统一、小写、去除空白和标点"""
+    text = unicodedata.normalize("NFKC", prompt or "").lower()
+    return "".join(ch for ch in text if not (ch.isspace() or unicodedata.category(ch).startswith("P")))
+
+
+def context_fingerprint(messages):
+    """系统提示词和最近若干条历史消息的指纹（不含本轮输入）"""
+    history = messages[1:-1][-RESPONSE_CACHE_CONTEXT_MESSAGES:] if RESPONSE_CACHE_CONTEXT_MESSAGES else []
+    digest = hashlib.blake2b(digest_size=16)
+    for message in messages[:1] + history:
+        digest.update(message.get("role", "").encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(message.get("content", "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """线程安全的回复缓存，TTL + LRU 淘汰"""
+
+    def __init__(self, maxsize=RESPONSE_CACHE_MAXSIZE, ttl=RESPONSE_CACHE_TTL, semantic=RESPONSE_CACHE_SEMANTIC,
+                 similarity=RESPONSE_CACHE_SIMILARITY):
+        self.semantic = semantic
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)  # (avatar_id, fingerprint, prompt) -> (reply, embedding)
+        self._groups = {}  # (avatar_id, fingerprint) -> set(prompt)，用于相似度匹配时缩小候选范围
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _cache_key(avatar_id, messages):
+        prompt = normalize_prompt(messages[-1]["content"])
+        if not prompt or len(prompt) > RESPONSE_CACHE_MAX_PROMPT_CHARS:
+            return None
+        return avatar_id, context_fingerprint(messages), prompt
+
+    def _embed(self, text, admission=None):
+        # 查找和写入时的同一输入由共享的嵌入缓存命中，不会重复请求上游；未命中时经 admission 申请上游名额
+        vector = get_cached_embeddings(get_llm_backend(), [text], admission=admission)[0].astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _semantic_lookup(self, group, embedding):
+        with self._lock:
+            prompts = self._groups.get(group)
+            if not prompts:
+                return None
+            best_reply, best_score = None, self.similarity
+            for prompt in list(prompts):
+                entry = self._entries.get(group + (prompt,))
+                if entry is None:
+                    prompts.discard(prompt)  # 已过期/被淘汰，顺便清理
+                    continue
+                reply, cached_embedding = entry
+                if cached_embedding is None:
+                    continue
+                score = float(np.dot(cached_embedding, embedding))
+                if score >= best_score:
+                    best_reply, best_score = reply, score
+            if not prompts:
+                del self._groups[group]
+            return best_reply
+
+    async def lookup(self, avatar_id, messages, admission=None):
+        """
+        查找缓存的回复，未命中返回 None
+        admission: 相似度匹配需要请求上游向量化时使用的准入上下文管理器工厂（见 get_cached_embeddings），
+        名额不足时跳过相似度匹配
+        """
+        key = self._cache_key(avatar_id, messages)
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[0]
+
+        if self.semantic:
+            try:
+                embedding = await asyncio.to_thread(self._embed, key[2], admission)
+            except Exception as e:
+                print(f"回复缓存向量化失败: {e}")
+            else:
+                reply = self._semantic_lookup(key[:2], embedding)
+                if reply is not None:
+                    self.hits += 1
+                    self.semantic_hits += 1
+                    return reply
+        self.misses += 1
+        return None
+
+    async def store(self, avatar_id, messages, reply, admission=None):
+        """写入一条完整的回复，admission 同 lookup"""
+        key = self._cache_key(avatar_id, messages)
+        if key is None or not reply:
+            return
+        embedding = None
+        if self.semantic:
+            try:
+                embedding = await asyncio.to_thread(self._embed, key[2], admission)
+            except Exception as e:
+                print(f"回复缓存向量化失败: {e}")
+        with self._lock:
+            self._entries[key] = (reply, embedding)
+            self._groups.setdefault(key[:2], set()).add(key[2])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            size = len(self._entries)
+        return {
+            "size": size,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,81 @@
+# sentence_segmenter.py
+# 流式文本的增量分句器：在 LLM 增量输出中尽早识别句子边界，便于下游 TTS 提前合成
+
+# 中文（全角）句末标点，遇到即可断句
+CJK_TERMINATORS = frozenset("。！？；…")
+# 英文（半角）句末标点；"." 需要看到后续字符才能确定（避免 3.14、e.g. 等误切）
+LATIN_TERMINATORS = frozenset("!?;")
+LATIN_PERIOD = "."
+# 句末标点后可能紧跟的闭合引号/括号，应归属于当前句子
+CLOSERS = frozenset("”’」』》）)]\"'")
+# 可选的分句（逗号级）边界
+CLAUSE_TERMINATORS = frozenset("，、,：:")
+
+
+class SentenceSegmenter:
+    """
+    增量分句器
+    feed() 每次接收一段增量文本，返回 [(片段, 是否句末), ...]；
+    非句末的文本会立即返回，只有结尾处无法判定的 "." 会暂存到下一次 feed。
+    """
+    __slots__ = ("clause", "min_clause_len", "_pending", "_since_boundary")
+
+    def __init__(self, clause=False, min_clause_len=8):
+        self.clause = clause  # 是否在逗号等分句标点处也断开
+        self.min_clause_len = min_clause_len  # 分句最短长度，避免过碎
+        self._pending = ""
+        self._since_boundary = 0  # 距离上一个边界已输出的字符数
+
+    def _is_boundary(self, text, i, start):
+        """判断 text[i] 处的标点是否为边界，返回 True/False，无法判定时返回 None"""
+        ch = text[i]
+        if ch in CJK_TERMINATORS or ch in LATIN_TERMINATORS:
+            return True
+        if ch == LATIN_PERIOD:
+            if i + 1 >= len(text):
+                return None
+            nxt = text[i + 1]
+            return nxt.isspace() or nxt in CLOSERS or nxt == LATIN_PERIOD or ord(nxt) > 0x2E7F
+        if self.clause and ch in CLAUSE_TERMINATORS:
+            return self._since_boundary + i - start + 1 >= self.min_clause_len
+        return False
+
+    def feed(self, text):
+        text = self._pending + text
+        self._pending = ""
+        segments = []
+        start = 0
+        i = 0
+        n = len(text)
+        while i < n:
+            boundary = self._is_boundary(text, i, start)
+            if boundary is None:
+                # 结尾的 "." 暂存，等待下一段文本再判断
+                break
+            if not boundary:
+                i += 1
+                continue
+            # 吞并连续的句末标点（如 "？！"、"..."）和闭合引号
+            end = i + 1
+            while end < n and (text[end] in CJK_TERMINATORS or text[end] in LATIN_TERMINATORS
+                               or text[end] == LATIN_PERIOD or text[end] in CLOSERS):
+                end += 1
+            if end >= n and text[end - 1] == LATIN_PERIOD:
+                # 以 "." 结尾的连续标点同样需要等待后续字符
+                break
+            segments.append((text[start:end], True))
+            self._since_boundary = 0
+            start = i = end
+
+        if i < n:
+            self._pending = text[i:]
+        if start < i:
+            segments.append((text[start:i], False))
+            self._since_boundary += i - start
+        return segments
+
+    def flush(self):
+        """流结束时调用，返回剩余文本（视为句末）"""
+        pending, self._pending = self._pending, ""
+        self._since_boundary = 0
+        return [(pending, True)] if pending else []
@@ -1,27 +1,40 @@
 # session_manager.py
 from datetime import datetime, timedelta
 import asyncio
-from collections import defaultdict
-from cachetools import LRUCache
+import sys
+import heapq
+import itertools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from utils.sqlite_manager import get_role_by_avatar_id, insert_or_update_table
 from utils.memory import MemoryManager
-from concurrent.futures import ThreadPoolExecutor
-memory_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="MemoryWorker")
-user_session_cache = defaultdict(lambda: LRUCache(maxsize=5))
-user_locks = defaultdict(asyncio.Lock)
+from utils.context_builder import message_tokens, fold_into_summary, CONTEXT_ROLLING_SUMMARY
+from utils.message_history import MessageHistory
+from utils.session_store import create_session_store
+from utils.memory_scheduler import MemoryJobScheduler, MEMORY_PRIORITY_HIGH, MEMORY_PRIORITY_NORMAL
 SESSION_TIMEOUT = 100  # 5分钟
-CLEANUP_INTERVAL = 60  # 2分钟
+CLEANUP_INTERVAL = 60  # 2分钟（清理任务最长休眠间隔）
+SESSION_EXPIRY_PRECISION = 1  # 过期检查精度（秒），即清理任务最短休眠间隔
+SESSION_MAX_MESSAGES = 100  # 单个会话保留的最大消息数
+SESSION_MAX_TOKENS = 6000  # 单个会话保留的历史token上限
+SESSION_STORE_UTF8 = False  # 历史消息内容是否以UTF-8字节存储（省内存，读取时需解码）
+SESSION_MAX_PER_USER = 5  # 每个用户同时保留的会话（角色）数
+SESSION_REGISTRY_MAX_SESSIONS = 100000  # 全进程会话总数上限，超出按LRU淘汰
+SHARED_STORE_CLEANUP_INTERVAL = 5  # 使用共享会话存储时，清理任务查询到期会话的间隔（秒）
 
 
 class Session:
-    __slots__ = ("messages", "last_active", "system_prompt", "memory_prompt", "memory_version", "combined_prompt", "chat_count")
+    __slots__ = ("messages", "summary", "last_active", "system_prompt", "memory_prompt", "memory_version",
+                 "combined_prompt", "chat_count", "dirty")
 
     def __init__(self, system_prompt="", memory_prompt=[], memory_version=0, chat_count=0):
         system_prompt = "" if system_prompt is None else system_prompt
         memory_prompt = [] if memory_prompt is None else memory_prompt
 
         self.memory_version = memory_version
-        self.messages = []
+        self.messages = MessageHistory(SESSION_MAX_MESSAGES, SESSION_STORE_UTF8)
+        self.summary = ""  # 被截断的旧消息折叠成的滚动摘要
+        self.dirty = True  # 自上次快照以来是否有变化
         self.last_active = datetime.now()
         self.chat_count = chat_count
         self.update_system_prompt(system_prompt, memory_prompt)
@@ -30,13 +43,27 @@ class Session:
         self.last_active = datetime.now()
 
     def add_messages(self, new_messages):
-        """添加消息并保持最多100条记录"""
-        self.messages.extend(new_messages)
-        # 截断到最新的100条消息
-        if len(self.messages) > 100:
-            self.messages = self.messages[-100:]
+        """添加消息，并按条数和token数上限截断最旧的记录"""
+        dropped = []
+        for message in new_messages:
+            # 环形缓冲区已满时会自动覆盖最旧的消息
+            oldest = self.messages.append(message["role"], message["content"], message_tokens(message))
+            if oldest is not None:
+                dropped.append(oldest)
+        while self.messages and self.messages.total_tokens > SESSION_MAX_TOKENS:
+            dropped.append(self.messages.popleft())
+        if dropped and CONTEXT_ROLLING_SUMMARY:
+            self.summary = fold_into_summary(self.summary, dropped)
+        self.dirty = True
         self.update_activity()
 
+    def memory_usage(self):
+        """估算本会话占用的内存（字节）"""
+        size = sys.getsizeof(self) + self.messages.nbytes()
+        for text in (self.summary, self.system_prompt, self.combined_prompt):
+            size += sys.getsizeof(text)
+        return size
+
     def update_system_prompt(self, system_prompt="", memory_prompt=[]):
         """更新系统提示词"""
         self.system_prompt = "" if system_prompt is None else system_prompt
@@ -52,80 +79,330 @@ class Session:
 
         # 添加额外的指令
         self.combined_prompt += "请遵守以下回复要求：不要使用括号及括号内的动作描述，只能以对话文本形式进行回复。"
+        self.dirty = True
         self.update_activity()
 
+    def to_dict(self):
+        """序列化为可JSON编码的字典（用于共享会话存储）"""
+        history = self.messages
+        return {
+            "system_prompt": self.system_prompt,
+            "memory_prompt": self.memory_prompt,
+            "memory_version": self.memory_version,
+            "chat_count": self.chat_count,
+            "summary": self.summary,
+            "messages": [[message["role"], message["content"], history.tokens(i)]
+                         for i, message in enumerate(history.iter_messages())],
+            "last_active": self.last_active.timestamp(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls(
+            system_prompt=data.get("system_prompt"),
+            memory_prompt=data.get("memory_prompt"),
+            memory_version=data.get("memory_version", 0),
+            chat_count=data.get("chat_count", 0)
+        )
+        for role, content, tokens in data.get("messages", []):
+            session.messages.append(role, content, tokens)
+        session.summary = data.get("summary") or ""
+        session.last_active = datetime.fromtimestamp(data["last_active"])
+        return session
+
+
+class SessionRegistry:
+    """
+    统一管理会话和用户级锁
+    - 会话按 (unionid, avatar_id) 存储，同时受每用户上限和全局上限约束，超出时按LRU淘汰，
+      被淘汰的会话交给 on_evict 回调（用于生成记忆），不会静默丢失
+    - 用户锁按引用计数管理，没有持有者和等待者时立即回收，锁的数量不随历史用户数增长
+    """
+
+    def __init__(self, max_sessions=SESSION_REGISTRY_MAX_SESSIONS, max_per_user=SESSION_MAX_PER_USER, on_evict=None):
+        self.max_sessions = max_sessions
+        self.max_per_user = max_per_user
+        self.on_evict = on_evict
+        self._sessions = OrderedDict()  # (unionid, avatar_id) -> Session，按最近使用排序
+        self._user_sessions = {}  # unionid -> OrderedDict(avatar_id -> None)，按最近使用排序
+        self._locks = {}  # unionid -> [asyncio.Lock, 持有者+等待者数量]
+        self._removed = set()  # 自上次快照以来被移除的会话键
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, unionid, avatar_id):
+        """查找会话，不改变LRU顺序"""
+        return self._sessions.get((unionid, avatar_id))
+
+    def touch(self, unionid, avatar_id):
+        """查找会话并标记为最近使用"""
+        key = (unionid, avatar_id)
+        session = self._sessions.get(key)
+        if session is not None:
+            self._sessions.move_to_end(key)
+            self._user_sessions[unionid].move_to_end(avatar_id)
+        return session
+
+    def items(self):
+        """遍历 ((unionid, avatar_id), session)"""
+        return list(self._sessions.items())
+
+    def pop_removed(self):
+        """返回并清空自上次调用以来被移除的会话键（供增量快照删除）"""
+        removed, self._removed = self._removed, set()
+        return removed
+
+    def restore_removed(self, keys):
+        """快照写入失败时放回待删除的会话键"""
+        self._removed.update(key for key in keys if key not in self._sessions)
+
+    def put(self, unionid, avatar_id, session):
+        key = (unionid, avatar_id)
+        self._removed.discard(key)
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        avatars = self._user_sessions.setdefault(unionid, OrderedDict())
+        avatars[avatar_id] = None
+        avatars.move_to_end(avatar_id)
+
+        while len(avatars) > self.max_per_user:
+            self._evict(unionid, next(iter(avatars)))
+        while len(self._sessions) > self.max_sessions:
+            self._evict(*next(iter(self._sessions)))
+
+    def remove(self, unionid, avatar_id):
+        session = self._sessions.pop((unionid, avatar_id), None)
+        if session is not None:
+            self._removed.add((unionid, avatar_id))
+        avatars = self._user_sessions.get(unionid)
+        if avatars is not None:
+            avatars.pop(avatar_id, None)
+            if not avatars:
+                del self._user_sessions[unionid]
+        return session
+
+    def _evict(self, unionid, avatar_id):
+        session = self.remove(unionid, avatar_id)
+        if session is not None and self.on_evict is not None:
+            self.on_evict(unionid, avatar_id, session)
+
+    @asynccontextmanager
+    async def lock(self, unionid):
+        """用户级锁，用法：async with session_registry.lock(unionid): ..."""
+        entry = self._locks.get(unionid)
+        if entry is None:
+            entry = self._locks[unionid] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[unionid]
+
+    def memory_usage(self):
+        """所有会话占用内存的估算值（字节），需要遍历全部会话，仅用于监控采样"""
+        return sum(session.memory_usage() for session in self._sessions.values())
+
+    def stats(self):
+        return {
+            "users": len(self._user_sessions),
+            "sessions": len(self._sessions),
+            "locks": len(self._locks),
+            "lock_waiters": sum(max(0, count - 1) for _, count in self._locks.values()),
+        }
+
+
+class SessionExpiryIndex:
+    """
+    会话过期索引：以预计过期时间为键的最小堆
+    update_activity 只修改 last_active，不触碰堆；弹出时若发现会话期间有活动，
+    再按最新的 last_active 重新入堆（惰性重新布防），因此每次检查只处理真正到期的会话
+    """
+
+    def __init__(self, timeout=SESSION_TIMEOUT):
+        self.timeout = timedelta(seconds=timeout)
+        self._heap = []  # (deadline, seq, unionid, avatar_id, session)
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, unionid, avatar_id, session):
+        heapq.heappush(self._heap, (session.last_active + self.timeout, next(self._seq), unionid, avatar_id, session))
+
+    def next_deadline(self):
+        return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, now, lookup):
+        """
+        弹出所有已到期且仍在缓存中的会话，返回 [(unionid, avatar_id, session), ...]
+        lookup(unionid, avatar_id) 返回当前缓存中的会话（不存在时返回 None）
+        """
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, unionid, avatar_id, session = heapq.heappop(self._heap)
+            if lookup(unionid, avatar_id) is not session:
+                continue  # 已被LRU淘汰或替换，丢弃失效条目
+            deadline = session.last_active + self.timeout
+            if deadline > now:
+                # 期间有过活动，按新的过期时间重新入堆
+                heapq.heappush(self._heap, (deadline, next(self._seq), unionid, avatar_id, session))
+                continue
+            expired.append((unionid, avatar_id, session))
+        return expired
+
+
+session_expiry_index = SessionExpiryIndex()
+
 
 def get_or_create_session(unionid, avatar_id, memory_prompt):
     """获取或创建用户的会话"""
-    sessions = user_session_cache[unionid]
-    try:
-        session = sessions[avatar_id]
+    session = session_registry.touch(unionid, avatar_id)
+    if session is not None:
         if memory_prompt:
             session.memory_prompt = memory_prompt
         session.update_activity()
         return session
-    except KeyError:
-        # 从数据库获取角色信息
-        role = get_role_by_avatar_id(avatar_id)
-        session = Session(
-            system_prompt=role.get("system_prompt", ""),
-            memory_prompt=memory_prompt,
-            memory_version=role.get("memory_version", 0),
-            chat_count=role.get("chat_count", 0)
-        )
-        sessions[avatar_id] = session
+
+    # 从数据库获取角色信息
+    role = get_role_by_avatar_id(avatar_id)
+    session = Session(
+        system_prompt=role.get("system_prompt", ""),
+        memory_prompt=memory_prompt,
+        memory_version=role.get("memory_version", 0),
+        chat_count=role.get("chat_count", 0)
+    )
+    session_registry.put(unionid, avatar_id, session)
+    session_expiry_index.add(unionid, avatar_id, session)
+    return session
+
+
+# 共享会话存储（SESSION_STORE=sqlite/redis 时启用，可多 worker 运行）；为 None 时会话只保存在本进程的 session_registry 中
+session_store = create_session_store()
+
+
+@asynccontextmanager
+async def user_session_lock(unionid):
+    """用户级锁：先取进程内锁，启用共享存储时再取跨进程锁"""
+    async with session_registry.lock(unionid):
+        if session_store is None:
+            yield
+        else:
+            async with session_store.lock(unionid):
+                yield
+
+
+async def load_session(unionid, avatar_id, memory_prompt):
+    """获取或创建会话（需在 user_session_lock 内调用），修改后用 commit_session 写回"""
+    if session_store is None:
+        return get_or_create_session(unionid, avatar_id, memory_prompt)
+    data = await session_store.load(unionid, avatar_id)
+    if data is not None:
+        session = Session.from_dict(data)
+        if memory_prompt:
+            session.memory_prompt = memory_prompt
+        session.update_activity()
         return session
+    role = get_role_by_avatar_id(avatar_id)
+    return Session(
+        system_prompt=role.get("system_prompt", ""),
+        memory_prompt=memory_prompt,
+        memory_version=role.get("memory_version", 0),
+        chat_count=role.get("chat_count", 0)
+    )
+
+
+async def commit_session(unionid, avatar_id, session):
+    """把会话写回共享存储；进程内模式下会话对象本身就是存储，无需写回"""
+    if session_store is not None:
+        await session_store.save(unionid, avatar_id, session.to_dict())
+
+def _process_memory_in_thread(avatar_id, messages, histories=1):
+    """在记忆工作线程中执行的记忆处理函数；同一角色的任务由调度器保证串行，失败时抛出异常以便重试"""
+    # 从数据库读取当前版本，而不是会话创建时的版本，避免基于过期版本生成并覆盖记忆
+    role = get_role_by_avatar_id(avatar_id) or {}
+    memory_version = role.get("memory_version", 0)
+    memoryManager = MemoryManager(avatar_id, memory_version)
+    if not memoryManager.process_chat_history(messages):
+        raise RuntimeError("记忆处理失败")
+
+    # 可选：更新数据库中的 chat_count 和 memory_version（以存储中实际的最新版本为准）
+    new_memory_version = memoryManager.memory_version
+    insert_or_update_table(
+        table_name="roles",
+        avatar_id=avatar_id,
+        memory_version=new_memory_version,
+        chat_count=role.get("chat_count", 0) + histories,
+        updated_at = datetime.now().isoformat()
+    )
+
+
+memory_scheduler = MemoryJobScheduler(_process_memory_in_thread)
+
+
+def _schedule_memory_processing(avatar_id, session, priority=MEMORY_PRIORITY_NORMAL):
+    """把会话历史交给记忆调度器"""
+    memory_scheduler.submit(avatar_id, session.messages.to_list(), priority, session.memory_version)
+
+
+def _on_session_evicted(unionid, avatar_id, session):
+    """会话因容量上限被淘汰时同样生成记忆"""
+    _schedule_memory_processing(avatar_id, session, MEMORY_PRIORITY_HIGH)
+
+
+session_registry = SessionRegistry(on_evict=_on_session_evicted)
+
+
+def start_memory_jobs():
+    """启动记忆任务处理，继续处理上次运行遗留的任务（在应用启动时调用）"""
+    memory_scheduler.start()
+
+
+async def drain_memory_jobs():
+    """把已提交的记忆任务落盘并等待正在处理的任务完成（有超时，在应用关闭时调用），其余任务下次启动后继续"""
+    await asyncio.get_running_loop().run_in_executor(None, memory_scheduler.shutdown, True)
+
+
+async def _cleanup_shared_sessions():
+    """清理共享存储中的过期会话；多个 worker 同时清理时，由用户锁保证每个会话只处理一次"""
+    cutoff = datetime.now().timestamp() - SESSION_TIMEOUT
+    for unionid, avatar_id in await session_store.due(cutoff):
+        async with user_session_lock(unionid):
+            data = await session_store.load(unionid, avatar_id)
+            if data is None or data["last_active"] > cutoff:
+                continue  # 已被其他 worker 处理，或期间有过活动
+            await session_store.delete(unionid, avatar_id)
+        _schedule_memory_processing(avatar_id, Session.from_dict(data))
 
-def _process_memory_in_thread(avatar_id, memory_version, messages, chat_count):
-    """在线程池中执行的记忆处理函数"""
-    try:
-        memoryManager = MemoryManager(avatar_id, memory_version)
-        memoryManager.load_memories()
-        memoryManager.process_chat_history(messages)
-
-        # 可选：更新数据库中的 chat_count 和 memory_version
-        new_memory_version = memory_version + 1
-        insert_or_update_table(
-            table_name="roles",
-            avatar_id=avatar_id,
-            memory_version=new_memory_version,
-            chat_count=chat_count + 1,
-            updated_at = datetime.now().isoformat()
-        )
-    except Exception as e:
-        print(f"线程内处理记忆失败 avatar_id={avatar_id}: {e}")
 
 async def cleanup_expired_sessions():
     """定期清理过期的会话，并异步生成历史记忆"""
-    loop = asyncio.get_running_loop()
     while True:
         try:
-            await asyncio.sleep(CLEANUP_INTERVAL)
-            now = datetime.now()
-            for unionid in list(user_session_cache.keys()):
-                sessions = user_session_cache[unionid]
-                for avatar_id in list(sessions.keys()):
-                    session = sessions[avatar_id]
-                    if (now - session.last_active).seconds > SESSION_TIMEOUT:
-                        loop.run_in_executor(
-                            memory_executor,
-                            _process_memory_in_thread,
-                            avatar_id,
-                            session.memory_version,
-                            session.messages,
-                            session.chat_count  # 如果需要更新数据库
-                        )
-
-                        # 从缓存中删除会话
-                        del sessions[avatar_id]
-
-                # 如果该用户的所有会话都已清理，则删除用户的缓存条目
-                if not sessions:
-                    del user_session_cache[unionid]
+            if session_store is not None:
+                await asyncio.sleep(SHARED_STORE_CLEANUP_INTERVAL)
+                await _cleanup_shared_sessions()
+                continue
+            # 休眠到最近一个会话的预计过期时间（限制在精度和最长间隔之间）
+            next_deadline = session_expiry_index.next_deadline()
+            if next_deadline is None:
+                delay = CLEANUP_INTERVAL
+            else:
+                delay = (next_deadline - datetime.now()).total_seconds()
+                delay = min(max(delay, SESSION_EXPIRY_PRECISION), CLEANUP_INTERVAL)
+            await asyncio.sleep(delay)
+
+            expired = session_expiry_index.pop_expired(datetime.now(), session_registry.get)
+            for unionid, avatar_id, session in expired:
+                _schedule_memory_processing(avatar_id, session)
+                # 从缓存中删除会话
+                session_registry.remove(unionid, avatar_id)
         except asyncio.CancelledError:
             print("清理任务被取消")
             break
         except Exception as e:
             print(f"清理任务发生错误: {e}")
             await asyncio.sleep(60)  # 出错后等待一段时间再继续
-
@@ -0,0 +1,101 @@
+# session_snapshot.py
+# 活跃会话的增量快照：定期把有变化的会话写入本地SQLite，启动时恢复，
+# 使发布/重启对用户无感知，且不会丢失待生成的记忆
+# 与共享会话存储一样只保存会话的字典形式（Session.to_dict()），新增会话字段无需修改快照
+import asyncio
+import json
+import sqlite3
+
+from utils.session_manager import Session, session_registry, session_expiry_index
+
+SESSION_SNAPSHOT_DB = "sessions_snapshot.db"
+SESSION_SNAPSHOT_INTERVAL = 30  # 快照间隔（秒）
+
+
+def _connect():
+    conn = sqlite3.connect(SESSION_SNAPSHOT_DB)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS session_snapshots (
+        unionid TEXT NOT NULL,
+        avatar_id TEXT NOT NULL,
+        data TEXT NOT NULL,                 /* Session.to_dict() 的 JSON */
+        last_active REAL NOT NULL,          /* 时间戳（秒） */
+        PRIMARY KEY (unionid, avatar_id)
+    )""")
+    return conn
+
+
+def collect_changes(registry=session_registry):
+    """在事件循环线程中收集需要写入/删除的会话，并清除脏标记"""
+    upserts = []
+    for (unionid, avatar_id), session in registry.items():
+        if not session.dirty:
+            continue
+        data = session.to_dict()
+        upserts.append((unionid, avatar_id, json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+                        data["last_active"]))
+        session.dirty = False
+    return upserts, list(registry.pop_removed())
+
+
+def write_changes(upserts, deletes):
+    """把增量写入快照库（在线程中执行）"""
+    if not upserts and not deletes:
+        return
+    conn = _connect()
+    try:
+        with conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO session_snapshots (unionid, avatar_id, data, last_active)
+                VALUES (?, ?, ?, ?)
+            """, upserts)
+            conn.executemany("DELETE FROM session_snapshots WHERE unionid = ? AND avatar_id = ?", deletes)
+    finally:
+        conn.close()
+
+
+async def save_snapshot(registry=session_registry):
+    upserts, deletes = collect_changes(registry)
+    try:
+        await asyncio.to_thread(write_changes, upserts, deletes)
+    except Exception:
+        # 写入失败时恢复脏标记和删除记录，下次重试
+        for unionid, avatar_id, *_ in upserts:
+            session = registry.get(unionid, avatar_id)
+            if session is not None:
+                session.dirty = True
+        registry.restore_removed(deletes)
+        raise
+    return len(upserts), len(deletes)
+
+
+def load_snapshot(registry=session_registry, expiry_index=session_expiry_index):
+    """启动时恢复快照中的会话，返回恢复的会话数；已过期的会话会在下一次清理时照常生成记忆"""
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT unionid, avatar_id, data FROM session_snapshots").fetchall()
+    finally:
+        conn.close()
+
+    for unionid, avatar_id, data in rows:
+        session = Session.from_dict(json.loads(data))
+        session.dirty = False
+        registry.put(unionid, avatar_id, session)
+        expiry_index.add(unionid, avatar_id, session)
+    registry.pop_removed()
+    return len(rows)
+
+
+async def snapshot_sessions_periodically():
+    """定期增量快照"""
+    while True:
+        try:
+            await asyncio.sleep(SESSION_SNAPSHOT_INTERVAL)
+            await save_snapshot()
+        except asyncio.CancelledError:
+            print("快照任务被取消")
+            break
+        except Exception as e:
+            print(f"会话快照失败: {e}")
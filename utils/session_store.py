@@ -0,0 +1,412 @@
+# session_store.py
+# 多进程共享的会话存储，使 API 可以用多个 uvicorn worker 运行
+# - memory：进程内存储（默认，即原有行为），由 session_manager 中的 SessionRegistry 负责
+# - sqlite：本机共享的 SQLite（WAL 模式），用租约表实现跨进程用户锁
+# - redis：Redis 协议适配器（内置精简 RESP 客户端，无额外依赖），附带本地替身服务便于测试
+# 通过环境变量 SESSION_STORE=memory|sqlite|redis 选择，SESSION_STORE_URL 指定 SQLite 文件路径或 redis://host:port
+# 存储层只处理会话的字典形式（Session.to_dict()），序列化为 JSON
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+SESSION_LOCK_TTL = 10  # 跨进程用户锁的租约时长（秒），持锁进程崩溃后自动失效
+SESSION_LOCK_TIMEOUT = 30  # 获取用户锁的最长等待时间（秒）
+SESSION_LOCK_POLL_MIN = 0.005  # 锁被占用时的轮询间隔（指数退避的起点和上限）
+SESSION_LOCK_POLL_MAX = 0.1
+
+
+class SessionStore:
+    """共享会话存储接口"""
+
+    @asynccontextmanager
+    async def lock(self, unionid):
+        """跨进程的用户级锁"""
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + SESSION_LOCK_TIMEOUT
+        delay = SESSION_LOCK_POLL_MIN
+        while not await self._attempt_lock(unionid, token):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"acquire session lock timeout: {unionid}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SESSION_LOCK_POLL_MAX)
+        try:
+            yield
+        finally:
+            # 屏蔽取消，确保租约被释放，而不是等到超时
+            await asyncio.shield(self._unlock(unionid, token))
+
+    async def _attempt_lock(self, unionid, token):
+        """尝试加锁一次；等待期间被取消时，已在后台成功的加锁会被立即释放"""
+        attempt = asyncio.ensure_future(self._try_lock(unionid, token))
+        try:
+            return await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            def release_if_acquired(future):
+                if not future.cancelled() and future.exception() is None and future.result():
+                    asyncio.ensure_future(self._unlock(unionid, token))
+            attempt.add_done_callback(release_if_acquired)
+            raise
+
+    async def _try_lock(self, unionid, token):
+        raise NotImplementedError
+
+    async def _unlock(self, unionid, token):
+        raise NotImplementedError
+
+    async def load(self, unionid, avatar_id):
+        """返回会话字典，不存在时返回 None"""
+        raise NotImplementedError
+
+    async def save(self, unionid, avatar_id, data):
+        raise NotImplementedError
+
+    async def delete(self, unionid, avatar_id):
+        raise NotImplementedError
+
+    async def due(self, before, limit=1000):
+        """返回 last_active 早于 before（时间戳）的会话键 [(unionid, avatar_id), ...]"""
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """本机多进程共享的 SQLite 会话存储"""
+
+    def __init__(self, path="sessions_shared.db"):
+        self.path = path
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS shared_sessions (
+                unionid TEXT NOT NULL,
+                avatar_id TEXT NOT NULL,
+                data TEXT NOT NULL,
+                last_active REAL NOT NULL,
+                PRIMARY KEY (unionid, avatar_id)
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_shared_sessions_last_active ON shared_sessions (last_active)")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS session_locks (
+                unionid TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=SESSION_LOCK_TIMEOUT, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _run(self, sql_fn):
+        conn = self._connect()
+        try:
+            return sql_fn(conn)
+        finally:
+            conn.close()
+
+    async def _try_lock(self, unionid, token):
+        def try_lock(conn):
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT owner, expires_at FROM session_locks WHERE unionid = ?", (unionid,)).fetchone()
+                if row is not None and row[1] > now:
+                    return False
+                conn.execute("INSERT OR REPLACE INTO session_locks (unionid, owner, expires_at) VALUES (?, ?, ?)",
+                             (unionid, token, now + SESSION_LOCK_TTL))
+                return True
+            finally:
+                conn.execute("COMMIT")
+        return await asyncio.to_thread(self._run, try_lock)
+
+    async def _unlock(self, unionid, token):
+        await asyncio.to_thread(self._run, lambda conn: conn.execute(
+            "DELETE FROM session_locks WHERE unionid = ? AND owner = ?", (unionid, token)))
+
+    async def load(self, unionid, avatar_id):
+        row = await asyncio.to_thread(self._run, lambda conn: conn.execute(
+            "SELECT data FROM shared_sessions WHERE unionid = ? AND avatar_id = ?", (unionid, avatar_id)).fetchone())
+        return json.loads(row[0]) if row else None
+
+    async def save(self, unionid, avatar_id, data):
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        await asyncio.to_thread(self._run, lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO shared_sessions (unionid, avatar_id, data, last_active) VALUES (?, ?, ?, ?)",
+            (unionid, avatar_id, payload, data["last_active"])))
+
+    async def delete(self, unionid, avatar_id):
+        await asyncio.to_thread(self._run, lambda conn: conn.execute(
+            "DELETE FROM shared_sessions WHERE unionid = ? AND avatar_id = ?", (unionid, avatar_id)))
+
+    async def due(self, before, limit=1000):
+        rows = await asyncio.to_thread(self._run, lambda conn: conn.execute(
+            "SELECT unionid, avatar_id FROM shared_sessions WHERE last_active < ? ORDER BY last_active LIMIT ?",
+            (before, limit)).fetchall())
+        return [tuple(row) for row in rows]
+
+
+# ---------- Redis 协议 ----------
+
+class RespError(Exception):
+    """Redis 服务端返回的错误"""
+
+
+def _encode_command(*args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode("utf-8")
+    if kind == b"-":
+        return RespError(body.decode("utf-8"))
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        count = int(body)
+        if count < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(count)]
+    raise RespError(f"unknown reply type: {line!r}")
+
+
+class RespClient:
+    """精简的 Redis 协议异步客户端，带简单连接池"""
+
+    def __init__(self, host="127.0.0.1", port=6379, pool_size=16):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self._idle = []
+
+    async def execute(self, *args):
+        if self._idle:
+            reader, writer = self._idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(_encode_command(*args))
+            await writer.drain()
+            reply = await _read_reply(reader)
+        except BaseException:
+            writer.close()
+            raise
+        if len(self._idle) < self.pool_size:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    async def aclose(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+# 仅当锁仍属于自己时才删除（比较并删除）
+_UNLOCK_SCRIPT = 'if redis.call("get", KEYS[1]) == ARGV[1] then return redis.call("del", KEYS[1]) else return 0 end'
+
+
+class RedisSessionStore(SessionStore):
+    """基于 Redis 协议的共享会话存储"""
+
+    def __init__(self, host="127.0.0.1", port=6379, prefix="matesx:"):
+        self.client = RespClient(host, port)
+        self.prefix = prefix
+        self._expiry_key = prefix + "session_expiry"
+
+    def _session_key(self, unionid, avatar_id):
+        return f"{self.prefix}session:{unionid}:{avatar_id}"
+
+    @staticmethod
+    def _member(unionid, avatar_id):
+        return json.dumps([unionid, avatar_id], ensure_ascii=False)
+
+    async def _try_lock(self, unionid, token):
+        reply = await self.client.execute("SET", f"{self.prefix}lock:{unionid}", token, "NX", "PX",
+                                          int(SESSION_LOCK_TTL * 1000))
+        return reply == "OK"
+
+    async def _unlock(self, unionid, token):
+        await self.client.execute("EVAL", _UNLOCK_SCRIPT, 1, f"{self.prefix}lock:{unionid}", token)
+
+    async def load(self, unionid, avatar_id):
+        data = await self.client.execute("GET", self._session_key(unionid, avatar_id))
+        return json.loads(data) if data is not None else None
+
+    async def save(self, unionid, avatar_id, data):
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        await self.client.execute("SET", self._session_key(unionid, avatar_id), payload)
+        await self.client.execute("ZADD", self._expiry_key, repr(data["last_active"]), self._member(unionid, avatar_id))
+
+    async def delete(self, unionid, avatar_id):
+        await self.client.execute("DEL", self._session_key(unionid, avatar_id))
+        await self.client.execute("ZREM", self._expiry_key, self._member(unionid, avatar_id))
+
+    async def due(self, before, limit=1000):
+        members = await self.client.execute("ZRANGEBYSCORE", self._expiry_key, "-inf", f"({before!r}",
+                                            "LIMIT", 0, limit)
+        return [tuple(json.loads(member)) for member in members]
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class RespStandInServer:
+    """
+    Redis 协议的本地替身服务（内存实现），支持本模块用到的命令：
+    PING、GET、SET [NX] [PX|EX]、DEL、ZADD、ZREM、ZRANGEBYSCORE [LIMIT]、EVAL（仅比较并删除脚本）
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._zsets = {}
+        self._server = None
+        self._handlers = set()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in list(self._handlers):
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    def _get(self, key):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return self._data.get(key)
+
+    @staticmethod
+    def _encode_reply(value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, RespError):
+            return b"-%s\r\n" % str(value).encode("utf-8")
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode("utf-8")
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(RespStandInServer._encode_reply(v) for v in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _execute(self, args):
+        command = args[0].decode().upper()
+        if command == "PING":
+            return "PONG"
+        if command == "GET":
+            return self._get(args[1])
+        if command == "SET":
+            key, value = args[1], args[2]
+            options = [a.decode().upper() for a in args[3:]]
+            if "NX" in options and self._get(key) is not None:
+                return None
+            self._data[key] = value
+            self._expires.pop(key, None)
+            for unit, scale in (("PX", 0.001), ("EX", 1)):
+                if unit in options:
+                    self._expires[key] = time.time() + int(options[options.index(unit) + 1]) * scale
+            return "OK"
+        if command == "DEL":
+            return sum(1 for key in args[1:] if self._get(key) is not None and self._data.pop(key, None) is not None)
+        if command == "ZADD":
+            zset = self._zsets.setdefault(args[1], {})
+            added = int(args[3] not in zset)
+            zset[args[3]] = float(args[2])
+            return added
+        if command == "ZREM":
+            return int(self._zsets.get(args[1], {}).pop(args[2], None) is not None)
+        if command == "ZRANGEBYSCORE":
+            def bound(raw, low):
+                raw = raw.decode()
+                exclusive = raw.startswith("(")
+                value = float(raw.lstrip("("))
+                return value, exclusive
+            (low, low_ex), (high, high_ex) = bound(args[2], True), bound(args[3], False)
+            items = sorted(self._zsets.get(args[1], {}).items(), key=lambda item: item[1])
+            members = [m for m, score in items
+                       if (score > low if low_ex else score >= low) and (score < high if high_ex else score <= high)]
+            if len(args) > 4 and args[4].decode().upper() == "LIMIT":
+                offset, count = int(args[5]), int(args[6])
+                members = members[offset:offset + count]
+            return members
+        if command == "EVAL" and args[1].decode() == _UNLOCK_SCRIPT:
+            key, token = args[3], args[4]
+            if self._get(key) == token:
+                del self._data[key]
+                return 1
+            return 0
+        return RespError(f"ERR unsupported command '{command}'")
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while True:
+                args = await _read_reply(reader)
+                writer.write(self._encode_reply(self._execute(args)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+
+def create_session_store():
+    """根据环境变量创建共享会话存储；进程内模式返回 None"""
+    kind = os.environ.get("SESSION_STORE", "memory")
+    url = os.environ.get("SESSION_STORE_URL", "")
+    if kind == "sqlite":
+        return SQLiteSessionStore(url or "sessions_shared.db")
+    if kind == "redis":
+        parsed = urlparse(url or "redis://127.0.0.1:6379")
+        return RedisSessionStore(parsed.hostname or "127.0.0.1", parsed.port or 6379)
+    return None
+
+
+if __name__ == "__main__":
+    # 启动本地 Redis 协议替身服务：python -m utils.session_store
+    async def serve():
+        server = RespStandInServer()
+        port = await server.start(port=6379)
+        print(f"Redis 协议替身服务已启动: redis://127.0.0.1:{port}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
@@ -90,18 +90,15 @@ document.addEventListener('DOMContentLoaded', function() {
             if (selectedRole.memory_version > 0 &&
             (!memoryData || memoryData.memoryVersion !== selectedRole.memory_version))
             {
-                const response = await fetch(selectedRole.memory_prompt_url);
-                if (!response.ok) {
-                    throw new Error(`HTTP error! status: ${response.status}`);
-                }
-
-                const buffer = await response.arrayBuffer();
-                memoryData = window.memoryDataDB.parseBinaryData(buffer);
-                await window.memoryDataDB.saveMemoryData(memoryData);
+                // 本地已有较早版本时只下载之后的增量段
+                memoryData = await window.memoryDataDB.syncMemoryData(selectedRoleID, memoryData);
             }
             if (memoryData)
             {
-                window.embeddingManager.initialize(memoryData.memories);
+                // 记忆较多时使用服务端建立的近似检索索引
+                const memoryIndex = memoryData.memories.length >= EmbeddingManager.ANN_MIN_ENTRIES ?
+                    await window.memoryDataDB.fetchMemoryIndex(selectedRoleID, memoryData) : null;
+                window.embeddingManager.initialize(memoryData.memories, memoryIndex);
                 console.log("memoryData.memories.length: ", memoryData.memories.length)
             }
 
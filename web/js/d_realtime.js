@@ -59,6 +59,7 @@ let sse_startpoint = true;                // SSE传输开始标志
 let sse_endpoint = false;                 // SSE传输结束标志
 let sse_controller = null;                // SSE网络中断控制器，可用于打断传输
 let sse_data_buffer = "";                 // SSE网络传输数据缓存区，用于存储不完整的 JSON 块
+let tts_text_buffer = "";                 // 待送入TTS的文本缓存，按服务端 sentence_end 标记整句发送
 
 // 播放音频阶段
 let player = null;
@@ -406,7 +407,16 @@ async function handleResponseStream(responseBody, signal) {
                         data.endpoint = false;
                     }
                     addMessage(data.text, false, sse_startpoint);
-                    cosyvoice.sendText(data.text);
+                    // 服务端带 sentence_end 字段时按整句送入TTS，旧服务端则逐块发送
+                    tts_text_buffer += data.text;
+                    if (data.sentence_end === undefined || data.sentence_end || data.endpoint)
+                    {
+                        if (tts_text_buffer)
+                        {
+                            cosyvoice.sendText(tts_text_buffer);
+                        }
+                        tts_text_buffer = "";
+                    }
                     sse_startpoint = false;
                     sse_endpoint = data.endpoint;
                     if (sse_endpoint)
@@ -464,8 +474,7 @@ async function sendTextMessage(inputValue) {
     const similarMemoryTextList = [];
     if (window.parent.embeddingManager.memories)
     {
-        const token = await getTempToken("", "");
-        const queryEmbedding = await window.parent.embeddingManager.getEmbedding(inputValue, token);
+        const queryEmbedding = await window.parent.embeddingManager.getEmbedding(inputValue, unionid);
         const similarMemoryTextList = window.parent.embeddingManager.searchSimilarMemories(queryEmbedding, 5, 0.0);
         console.log("similarMemoryTextList:", similarMemoryTextList);
     }
@@ -497,6 +506,7 @@ async function sendTextMessage(inputValue) {
             sse_controller = new AbortController();
             sse_startpoint = true;
             sse_endpoint = false;
+            tts_text_buffer = "";
             textInput.value = "";
             const response = await fetch(server_url, {
                 method: 'POST',
@@ -196,97 +196,472 @@ class MemoryDataDB {
     }
 
     /**
-     * 解析二进制缓冲区为角色数据对象
+     * 计算 CRC32（与 Python zlib.crc32 相同）
+     * @param {Uint8Array} bytes - 数据
+     * @returns {number} - 无符号 32 位校验值
+     */
+    _crc32(bytes) {
+        if (!MemoryDataDB._crcTable) {
+            const table = new Uint32Array(256);
+            for (let n = 0; n < 256; n++) {
+                let c = n;
+                for (let k = 0; k < 8; k++) {
+                    c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+                }
+                table[n] = c >>> 0;
+            }
+            MemoryDataDB._crcTable = table;
+        }
+        const table = MemoryDataDB._crcTable;
+        let crc = 0xFFFFFFFF;
+        for (let i = 0; i < bytes.length; i++) {
+            crc = table[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+        }
+        return (crc ^ 0xFFFFFFFF) >>> 0;
+    }
+
+    /**
+     * 解析二进制缓冲区为角色数据对象，自动识别 v1（无魔数）和 v2（"MXMEMBIN" 分区格式）
      * @param {ArrayBuffer} buffer - 二进制数据缓冲区
      * @returns {Object} - 解析后的角色数据对象
-     * @throws {Error} - 解析失败时抛出错误
+     * @throws {Error} - 解析失败或校验不通过时抛出错误
      */
     parseBinaryData(buffer) {
         try {
-            const view = new DataView(buffer);
-            let offset = 0;
-            const decoder = new TextDecoder('utf-8');
+            const magic = new TextDecoder('ascii').decode(new Uint8Array(buffer, 0, Math.min(8, buffer.byteLength)));
+            if (magic === MemoryDataDB.MAGIC) {
+                return this._parseV2(buffer);
+            }
+            return this._parseV1(buffer);
+        } catch (error) {
+            console.error('解析二进制数据失败:', error);
+            throw new Error('文件格式不正确或已损坏');
+        }
+    }
 
-            // 读取 avatarID
-            const avatarIDLength = view.getUint32(offset, true);
-            offset += 4;
-            const avatarIDArray = new Uint8Array(buffer, offset, avatarIDLength);
-            const avatarID = decoder.decode(avatarIDArray);
-            offset += avatarIDLength;
-
-            // 读取元数据
-            const memoryVersion = view.getUint32(offset, true); offset += 4;
-            const createdAt = view.getUint32(offset, true); offset += 4;
-            const updatedAt = view.getUint32(offset, true); offset += 4;
-            const numEntries = view.getUint32(offset, true); offset += 4;
-            const dim = view.getUint32(offset, true); offset += 4;
-
-            // 初始化数组
-            const vectors = [];
-            const norms = [];
-            const frequencies = [];
-            const entryCreatedAts = [];
-            const entryUpdatedAts = [];
-
-            // 读取向量、范数、频率、时间戳
-            for (let i = 0; i < numEntries; i++) {
-                // 向量（float16 数组）
-                const vector = [];
-                for (let j = 0; j < dim; j++) {
-                    const half = view.getUint16(offset, true);
-                    vector.push(this._float16ToFloat32(half));
-                    offset += 2;
-                }
-                vectors.push(vector);
+    /**
+     * 读取并校验 v2 头部和区表（只需要部分区时可单独使用）
+     * @param {ArrayBuffer} buffer - 二进制数据缓冲区（至少包含完整头部）
+     * @returns {{header: Object, sections: Map<number, {offset: number, length: number, crc: number}>}}
+     */
+    readV2Sections(buffer) {
+        const view = new DataView(buffer);
+        if (buffer.byteLength < 64) {
+            throw new Error('头部不完整');
+        }
+        const formatVersion = view.getUint32(8, true);
+        if (formatVersion !== 2) {
+            throw new Error(`不支持的格式版本: ${formatVersion}`);
+        }
+        const headerSize = view.getUint32(12, true);
+        const avatarIDLength = view.getUint32(36, true);
+        const sectionCount = view.getUint32(40, true);
+        const tableOffset = 64 + Math.ceil(avatarIDLength / 8) * 8;
+        if (headerSize > buffer.byteLength || headerSize < tableOffset + sectionCount * 24) {
+            throw new Error('头部不完整');
+        }
 
-                // 范数（float16）
-                const normHalf = view.getUint16(offset, true);
-                norms.push(this._float16ToFloat32(normHalf));
-                offset += 2;
+        // 头部 CRC 计算时 CRC 字段按 0 处理
+        const headerBytes = new Uint8Array(buffer.slice(0, headerSize));
+        headerBytes.fill(0, 44, 48);
+        if (this._crc32(headerBytes) !== view.getUint32(44, true)) {
+            throw new Error('头部校验失败');
+        }
 
-                // 频率和时间戳
-                frequencies.push(view.getUint32(offset, true)); offset += 4;
-                entryCreatedAts.push(view.getUint32(offset, true)); offset += 4;
-                entryUpdatedAts.push(view.getUint32(offset, true)); offset += 4;
+        const header = {
+            avatarID: new TextDecoder('utf-8').decode(new Uint8Array(buffer, 64, avatarIDLength)),
+            formatVersion,
+            baseVersion: view.getUint32(48, true),
+            memoryVersion: view.getUint32(16, true),
+            createdAt: view.getUint32(20, true),
+            updatedAt: view.getUint32(24, true),
+            numEntries: view.getUint32(28, true),
+            dim: view.getUint32(32, true)
+        };
+        const sections = new Map();
+        for (let i = 0; i < sectionCount; i++) {
+            const at = tableOffset + i * 24;
+            const offset = Number(view.getBigUint64(at + 8, true));
+            const length = Number(view.getBigUint64(at + 16, true));
+            if (offset + length > buffer.byteLength) {
+                throw new Error(`区 ${view.getUint32(at, true)} 不完整`);
             }
+            sections.set(view.getUint32(at, true), { offset, length, crc: view.getUint32(at + 4, true) });
+        }
+        return { header, sections };
+    }
 
-            // 读取文本
-            const texts = [];
-            for (let i = 0; i < numEntries; i++) {
-                const textLength = view.getUint32(offset, true);
-                offset += 4;
-                const textArray = new Uint8Array(buffer, offset, textLength);
-                texts.push(decoder.decode(textArray));
-                offset += textLength;
-            }
+    /**
+     * 取出 v2 的一个区并校验 CRC
+     * @returns {{offset: number, length: number}}
+     */
+    _section(buffer, sections, id) {
+        const section = sections.get(id);
+        if (!section) {
+            throw new Error(`缺少区 ${id}`);
+        }
+        if (this._crc32(new Uint8Array(buffer, section.offset, section.length)) !== section.crc) {
+            throw new Error(`区 ${id} 校验失败`);
+        }
+        return section;
+    }
+
+    /**
+     * 解析 v2 格式：各区按 64 字节对齐，直接映射为类型化数组（按小端序平台读取）
+     * @param {ArrayBuffer} buffer - 二进制数据缓冲区
+     * @returns {Object} - 解析后的角色数据对象
+     */
+    _parseV2(buffer) {
+        const { header, sections } = this.readV2Sections(buffer);
+        return {
+            avatarID: header.avatarID,
+            memoryVersion: header.memoryVersion,
+            createdAt: header.createdAt,
+            updatedAt: header.updatedAt,
+            numEntries: header.numEntries,
+            dim: header.dim,
+            memories: this._readEntries(buffer, sections, header.numEntries, header.dim)
+        };
+    }
+
+    /**
+     * 从向量/元数据/文本索引/文本四个区读取记忆条目（memory.bin 和增量段共用）
+     * @returns {Array<Object>} - 记忆条目数组
+     */
+    _readEntries(buffer, sections, numEntries, dim) {
+        const decoder = new TextDecoder('utf-8');
+
+        // 向量为 float16 时解码为数组；为 int8 时保留编码，检索直接在编码上计算（见 EmbeddingManager.quantizedSimilarity）
+        let halves = null, codes = null, scales = null;
+        if (sections.has(MemoryDataDB.SECTION_VECTORS)) {
+            const vectorSection = this._section(buffer, sections, MemoryDataDB.SECTION_VECTORS);
+            halves = new Uint16Array(buffer, vectorSection.offset, numEntries * dim);
+        } else {
+            const codeSection = this._section(buffer, sections, MemoryDataDB.SECTION_VECTORS_INT8);
+            // 复制为独立的紧凑缓冲区供各条记忆共享，保存到 IndexedDB 时不会带上整个文件
+            codes = new Int8Array(buffer.slice(codeSection.offset, codeSection.offset + numEntries * dim));
+            const scaleSection = this._section(buffer, sections, MemoryDataDB.SECTION_VECTOR_SCALES);
+            scales = new Float32Array(buffer, scaleSection.offset, numEntries);
+        }
+
+        const metadataSection = this._section(buffer, sections, MemoryDataDB.SECTION_METADATA);
+        const normsSize = Math.ceil(numEntries * 2 / 4) * 4;
+        const norms = new Uint16Array(buffer, metadataSection.offset, numEntries);
+        const frequencies = new Uint32Array(buffer, metadataSection.offset + normsSize, numEntries);
+        const entryCreatedAts = new Uint32Array(buffer, metadataSection.offset + normsSize + 4 * numEntries, numEntries);
+        const entryUpdatedAts = new Uint32Array(buffer, metadataSection.offset + normsSize + 8 * numEntries, numEntries);
+
+        const indexSection = this._section(buffer, sections, MemoryDataDB.SECTION_TEXT_INDEX);
+        const textIndex = new Uint32Array(buffer, indexSection.offset, numEntries + 1);
+        const textSection = this._section(buffer, sections, MemoryDataDB.SECTION_TEXTS);
+        if (textIndex[0] !== 0 || textIndex[numEntries] > textSection.length) {
+            throw new Error('文本索引越界');
+        }
 
-            // 组装 memories
-            const memories = texts.map((text, i) => ({
-                vector: vectors[i],
-                text,
+        const memories = [];
+        for (let i = 0; i < numEntries; i++) {
+            const start = textIndex[i], end = textIndex[i + 1];
+            if (end < start) {
+                throw new Error('文本索引越界');
+            }
+            const entry = {};
+            if (halves) {
+                entry.vector = new Array(dim);
+                for (let j = 0; j < dim; j++) {
+                    entry.vector[j] = this._float16ToFloat32(halves[i * dim + j]);
+                }
+            } else {
+                entry.codes = codes.subarray(i * dim, (i + 1) * dim);
+                entry.scale = scales[i];
+            }
+            memories.push({
+                ...entry,
+                text: decoder.decode(new Uint8Array(buffer, textSection.offset + start, end - start)),
                 frequency: frequencies[i],
-                norm: norms[i],
+                norm: this._float16ToFloat32(norms[i]),
                 createdAt: entryCreatedAts[i],
                 updatedAt: entryUpdatedAts[i]
-            }));
+            });
+        }
+        return memories;
+    }
 
+    /**
+     * 解析增量段（"MXMEMDLT"）
+     * @param {ArrayBuffer} buffer - 二进制数据缓冲区
+     * @returns {Object} - { avatarID, baseVersion, memoryVersion, updatedAt, dim, ids, deletions, memories }
+     * @throws {Error} - 解析失败或校验不通过时抛出错误
+     */
+    parseDeltaData(buffer) {
+        try {
+            const magic = new TextDecoder('ascii').decode(new Uint8Array(buffer, 0, Math.min(8, buffer.byteLength)));
+            if (magic !== MemoryDataDB.DELTA_MAGIC) {
+                throw new Error('不是增量段');
+            }
+            const { header, sections } = this.readV2Sections(buffer);
+            const idSection = this._section(buffer, sections, MemoryDataDB.SECTION_ENTRY_IDS);
+            const deletionSection = this._section(buffer, sections, MemoryDataDB.SECTION_DELETIONS);
             return {
-                avatarID,
-                memoryVersion,
-                createdAt,
-                updatedAt,
-                numEntries,
-                dim,
-                memories
+                avatarID: header.avatarID,
+                baseVersion: header.baseVersion,
+                memoryVersion: header.memoryVersion,
+                updatedAt: header.updatedAt,
+                dim: header.dim,
+                ids: new Uint32Array(buffer, idSection.offset, header.numEntries),
+                deletions: new Uint32Array(buffer, deletionSection.offset, deletionSection.length / 4),
+                memories: this._readEntries(buffer, sections, header.numEntries, header.dim)
             };
+        } catch (error) {
+            console.error('解析增量段失败:', error);
+            throw new Error('增量段格式不正确或已损坏');
+        }
+    }
 
+    /**
+     * 把增量段应用到角色数据上：先删除，再把第 j 条写入下标 ids[j]（替换已有条目或追加到末尾）
+     * @param {Object} memoryData - 角色数据对象（原地修改）
+     * @param {Object} delta - parseDeltaData 的返回值
+     * @returns {Object} - 修改后的角色数据对象
+     */
+    applyDelta(memoryData, delta) {
+        if (memoryData.memoryVersion !== delta.baseVersion) {
+            throw new Error(`增量段基于版本 ${delta.baseVersion}，本地版本为 ${memoryData.memoryVersion}`);
+        }
+        let memories = memoryData.memories;
+        if (delta.deletions.length > 0) {
+            const deleted = new Set(delta.deletions);
+            memories = memories.filter((_, i) => !deleted.has(i));
+        }
+        delta.ids.forEach((id, j) => {
+            if (id < memories.length) {
+                memories[id] = delta.memories[j];
+            } else if (id === memories.length) {
+                memories.push(delta.memories[j]);
+            } else {
+                throw new Error(`增量段条目下标越界: ${id}`);
+            }
+        });
+        Object.assign(memoryData, {
+            memoryVersion: delta.memoryVersion,
+            updatedAt: delta.updatedAt,
+            numEntries: memories.length,
+            dim: delta.dim,
+            memories
+        });
+        return memoryData;
+    }
+
+    /**
+     * 同步角色记忆到最新版本：本地版本仍在增量段范围内时只下载之后的增量段，否则下载基准快照
+     * 同步结果保存到 IndexedDB
+     * @param {string} avatarID - 角色唯一标识
+     * @param {Object|null} localData - 本地已有的角色数据
+     * @returns {Promise<Object|null>} - 最新的角色数据，没有任何记忆时为 null
+     */
+    async syncMemoryData(avatarID, localData) {
+        const apiBase = `/api/assets/${encodeURIComponent(avatarID)}`;
+        for (let attempt = 0; attempt < 2; attempt++) {
+            const response = await fetch(`${apiBase}/memory.manifest`);
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            const manifest = await response.json();
+            let memoryData = localData;
+            if (memoryData && memoryData.memoryVersion === manifest.version) {
+                return memoryData;
+            }
+            if (!memoryData || memoryData.memoryVersion < manifest.base_version || memoryData.memoryVersion > manifest.version) {
+                if (manifest.base_version > 0) {
+                    const baseResponse = await fetch(`${apiBase}/memory.bin`);
+                    if (!baseResponse.ok) {
+                        throw new Error(`HTTP error! status: ${baseResponse.status}`);
+                    }
+                    memoryData = this.parseBinaryData(await baseResponse.arrayBuffer());
+                } else {
+                    memoryData = { avatarID, memoryVersion: 0, createdAt: 0, updatedAt: 0, numEntries: 0, dim: 0, memories: [] };
+                }
+            } else {
+                // 不修改调用方传入的对象，同步失败时本地数据保持原样
+                memoryData = { ...memoryData, memories: memoryData.memories.slice() };
+            }
+
+            let complete = true;
+            for (let version = memoryData.memoryVersion + 1; version <= manifest.version; version++) {
+                const deltaResponse = await fetch(`${apiBase}/memory.delta/${version}`);
+                if (deltaResponse.status === 404) {
+                    // 增量段刚被合并进基准快照，重新读取 manifest
+                    complete = false;
+                    localData = null;
+                    break;
+                }
+                if (!deltaResponse.ok) {
+                    throw new Error(`HTTP error! status: ${deltaResponse.status}`);
+                }
+                this.applyDelta(memoryData, this.parseDeltaData(await deltaResponse.arrayBuffer()));
+            }
+            if (complete) {
+                if (memoryData.memoryVersion > 0) {
+                    await this.saveMemoryData(memoryData);
+                }
+                return memoryData.memoryVersion > 0 ? memoryData : null;
+            }
+        }
+        throw new Error('记忆同步失败，请稍后重试');
+    }
+
+    /**
+     * 解析近似检索索引（memory.index）
+     * @param {ArrayBuffer} buffer - 索引文件
+     * @returns {Object} - { memoryVersion, numEntries, dim, centroids: Float32Array[], lists: Int32Array }
+     */
+    parseIndexData(buffer) {
+        const magic = new TextDecoder('ascii').decode(new Uint8Array(buffer, 0, Math.min(8, buffer.byteLength)));
+        if (magic !== MemoryDataDB.INDEX_MAGIC) {
+            throw new Error('不是记忆索引');
+        }
+        const { header, sections } = this.readV2Sections(buffer);
+        const centroidSection = this._section(buffer, sections, MemoryDataDB.SECTION_CENTROIDS);
+        const listSection = this._section(buffer, sections, MemoryDataDB.SECTION_LISTS);
+        const halves = new Uint16Array(buffer, centroidSection.offset, centroidSection.length / 2);
+        const centroids = [];
+        for (let start = 0; start + header.dim <= halves.length; start += header.dim) {
+            const centroid = new Float32Array(header.dim);
+            for (let j = 0; j < header.dim; j++) {
+                centroid[j] = this._float16ToFloat32(halves[start + j]);
+            }
+            centroids.push(centroid);
+        }
+        return {
+            memoryVersion: header.memoryVersion,
+            numEntries: header.numEntries,
+            dim: header.dim,
+            centroids,
+            lists: new Int32Array(buffer, listSection.offset, header.numEntries)
+        };
+    }
+
+    /**
+     * 下载与本地记忆版本一致的近似检索索引，没有或版本不一致时返回 null（使用精确检索）
+     * @param {string} avatarID - 角色唯一标识
+     * @param {Object} memoryData - 本地记忆数据
+     * @returns {Promise<Object|null>}
+     */
+    async fetchMemoryIndex(avatarID, memoryData) {
+        try {
+            const response = await fetch(`/api/assets/${encodeURIComponent(avatarID)}/memory.index`);
+            if (!response.ok) {
+                return null;
+            }
+            const index = this.parseIndexData(await response.arrayBuffer());
+            if (index.memoryVersion !== memoryData.memoryVersion || index.numEntries !== memoryData.memories.length) {
+                return null;
+            }
+            return index;
         } catch (error) {
-            console.error('解析二进制数据失败:', error);
-            throw new Error('文件格式不正确或已损坏');
+            console.error('读取记忆索引失败:', error);
+            return null;
+        }
+    }
+
+    /**
+     * 解析 v1 格式（旧版，无魔数）
+     * @param {ArrayBuffer} buffer - 二进制数据缓冲区
+     * @returns {Object} - 解析后的角色数据对象
+     */
+    _parseV1(buffer) {
+        const view = new DataView(buffer);
+        let offset = 0;
+        const decoder = new TextDecoder('utf-8');
+
+        // 读取 avatarID
+        const avatarIDLength = view.getUint32(offset, true);
+        offset += 4;
+        const avatarIDArray = new Uint8Array(buffer, offset, avatarIDLength);
+        const avatarID = decoder.decode(avatarIDArray);
+        offset += avatarIDLength;
+
+        // 读取元数据
+        const memoryVersion = view.getUint32(offset, true); offset += 4;
+        const createdAt = view.getUint32(offset, true); offset += 4;
+        const updatedAt = view.getUint32(offset, true); offset += 4;
+        const numEntries = view.getUint32(offset, true); offset += 4;
+        const dim = view.getUint32(offset, true); offset += 4;
+
+        // 初始化数组
+        const vectors = [];
+        const norms = [];
+        const frequencies = [];
+        const entryCreatedAts = [];
+        const entryUpdatedAts = [];
+
+        // 读取向量、范数、频率、时间戳
+        for (let i = 0; i < numEntries; i++) {
+            // 向量（float16 数组）
+            const vector = [];
+            for (let j = 0; j < dim; j++) {
+                const half = view.getUint16(offset, true);
+                vector.push(this._float16ToFloat32(half));
+                offset += 2;
+            }
+            vectors.push(vector);
+
+            // 范数（float16）
+            const normHalf = view.getUint16(offset, true);
+            norms.push(this._float16ToFloat32(normHalf));
+            offset += 2;
+
+            // 频率和时间戳
+            frequencies.push(view.getUint32(offset, true)); offset += 4;
+            entryCreatedAts.push(view.getUint32(offset, true)); offset += 4;
+            entryUpdatedAts.push(view.getUint32(offset, true)); offset += 4;
         }
+
+        // 读取文本
+        const texts = [];
+        for (let i = 0; i < numEntries; i++) {
+            const textLength = view.getUint32(offset, true);
+            offset += 4;
+            const textArray = new Uint8Array(buffer, offset, textLength);
+            texts.push(decoder.decode(textArray));
+            offset += textLength;
+        }
+
+        // 组装 memories
+        const memories = texts.map((text, i) => ({
+            vector: vectors[i],
+            text,
+            frequency: frequencies[i],
+            norm: norms[i],
+            createdAt: entryCreatedAts[i],
+            updatedAt: entryUpdatedAts[i]
+        }));
+
+        return {
+            avatarID,
+            memoryVersion,
+            createdAt,
+            updatedAt,
+            numEntries,
+            dim,
+            memories
+        };
     }
 }
 
+MemoryDataDB.MAGIC = 'MXMEMBIN';
+MemoryDataDB.DELTA_MAGIC = 'MXMEMDLT';
+MemoryDataDB.INDEX_MAGIC = 'MXMEMIDX';
+MemoryDataDB.SECTION_VECTORS = 1;
+MemoryDataDB.SECTION_METADATA = 2;
+MemoryDataDB.SECTION_TEXT_INDEX = 3;
+MemoryDataDB.SECTION_TEXTS = 4;
+MemoryDataDB.SECTION_ENTRY_IDS = 5;
+MemoryDataDB.SECTION_DELETIONS = 6;
+MemoryDataDB.SECTION_CENTROIDS = 7;
+MemoryDataDB.SECTION_LISTS = 8;
+MemoryDataDB.SECTION_VECTORS_INT8 = 9;
+MemoryDataDB.SECTION_VECTOR_SCALES = 10;
+
 // ———————————————————————————————————————————————————————
 // 单例导出
 // ———————————————————————————————————————————————————————
@@ -3,39 +3,41 @@
 class EmbeddingManager {
     constructor() {
         this.memories = [];
+        this.index = null;
+        this.cache = new Map(); // 文本 -> 向量，按最近使用排序
     }
 
     /**
      * 初始化记忆库
-     * @param {Array} memories - 记忆数组，每个元素包含 vector, text, frequency, norm, createdAt, updatedAt
+     * @param {Array} memories - 记忆数组，每个元素包含 vector（或量化的 codes + scale）, text, frequency, norm, createdAt, updatedAt
+     * @param {Object|null} index - 与 memories 对应的近似检索索引（memoryDataDB.fetchMemoryIndex），null 时精确检索
      */
-    initialize(memories) {
+    initialize(memories, index = null) {
         this.memories = memories || [];
+        this.index = index && index.lists.length === this.memories.length ? index : null;
     }
 
     /**
-     * 获取文本的嵌入向量
+     * 获取文本的嵌入向量（由服务端经共享的嵌入缓存获取，本地再缓存最近的查询）
      * @param {string} text - 输入文本
+     * @param {string} unionid - 当前用户
      * @returns {Promise<Array<number>>} - 嵌入向量
      */
-    async getEmbedding(text, apiKey) {
-        const url = 'https://dashscope.aliyuncs.com/compatible-mode/v1/embeddings';
-
-        const payload = {
-            model: "text-embedding-v4",
-            input: text,
-            dimensions: 768,
-            encoding_format: "float"
-        };
+    async getEmbedding(text, unionid) {
+        const cached = this.cache.get(text);
+        if (cached) {
+            this.cache.delete(text);
+            this.cache.set(text, cached);
+            return cached;
+        }
 
         try {
-            const response = await fetch(url, {
+            const response = await fetch('/embeddings', {
                 method: 'POST',
                 headers: {
-                    'Authorization': `Bearer ${apiKey}`,
                     'Content-Type': 'application/json'
                 },
-                body: JSON.stringify(payload)
+                body: JSON.stringify({ unionid, texts: [text] })
             });
 
             if (!response.ok) {
@@ -44,8 +46,13 @@ class EmbeddingManager {
 
             const data = await response.json();
 
-            if (data.data && data.data.length > 0 && data.data[0].embedding) {
-                return data.data[0].embedding;
+            if (data.embeddings && data.embeddings.length > 0) {
+                const embedding = data.embeddings[0];
+                this.cache.set(text, embedding);
+                if (this.cache.size > EmbeddingManager.CACHE_SIZE) {
+                    this.cache.delete(this.cache.keys().next().value);
+                }
+                return embedding;
             } else {
                 throw new Error('Failed to extract embedding from response');
             }
@@ -85,6 +92,53 @@ class EmbeddingManager {
         return dotProduct / (norm1 * norm2);
     }
 
+    /**
+     * 直接在 int8 编码上计算余弦相似度：向量 = codes * scale，模长使用记忆中保存的原始模长
+     * @param {Array<number>} queryEmbedding - 查询向量
+     * @param {Object} memory - 含 codes (Int8Array), scale, norm 的记忆
+     * @returns {number} - 余弦相似度
+     */
+    quantizedSimilarity(queryEmbedding, memory) {
+        const codes = memory.codes;
+        if (codes.length !== queryEmbedding.length || !memory.norm) {
+            return 0.0;
+        }
+        let dotProduct = 0;
+        let queryNorm = 0;
+        for (let i = 0; i < codes.length; i++) {
+            dotProduct += queryEmbedding[i] * codes[i];
+            queryNorm += queryEmbedding[i] * queryEmbedding[i];
+        }
+        if (queryNorm === 0) {
+            return 0.0;
+        }
+        return dotProduct * memory.scale / (Math.sqrt(queryNorm) * memory.norm);
+    }
+
+    /**
+     * 需要计算相似度的记忆下标：有索引且记忆足够多时只取最近的 ANN_NPROBE 个聚类（及未分配聚类的记忆）
+     * @param {Array<number>} queryEmbedding - 查询向量
+     * @returns {Iterable<number>}
+     */
+    _candidates(queryEmbedding) {
+        if (!this.index || this.memories.length < EmbeddingManager.ANN_MIN_ENTRIES) {
+            return this.memories.keys();
+        }
+        const { centroids, lists } = this.index;
+        const probes = centroids
+            .map((centroid, id) => ({ id, score: this.cosineSimilarity(queryEmbedding, centroid) }))
+            .sort((a, b) => b.score - a.score)
+            .slice(0, EmbeddingManager.ANN_NPROBE);
+        const probed = new Set(probes.map(probe => probe.id));
+        const candidates = [];
+        for (let i = 0; i < lists.length; i++) {
+            if (lists[i] < 0 || probed.has(lists[i])) {
+                candidates.push(i);
+            }
+        }
+        return candidates;
+    }
+
     /**
      * 搜索相似的记忆
      * @param {Array<number>} queryEmbedding - 查询向量
@@ -98,9 +152,18 @@ class EmbeddingManager {
         }
         const similarities = [];
 
-        for (let i = 0; i < this.memories.length; i++) {
+        for (const i of this._candidates(queryEmbedding)) {
             const memory = this.memories[i];
-            if (memory && memory.vector && Array.isArray(memory.vector)) {
+            if (memory && memory.codes) {
+                const similarity = this.quantizedSimilarity(queryEmbedding, memory);
+                if (similarity >= threshold) {
+                    similarities.push({
+                        index: i,
+                        similarity: similarity,
+                        memory: memory
+                    });
+                }
+            } else if (memory && memory.vector && Array.isArray(memory.vector)) {
                 const similarity = this.cosineSimilarity(queryEmbedding, memory.vector);
                 if (similarity >= threshold) {
                     similarities.push({
@@ -120,6 +183,10 @@ class EmbeddingManager {
     }
 }
 
+EmbeddingManager.CACHE_SIZE = 256; // 本地缓存的查询向量条数
+EmbeddingManager.ANN_MIN_ENTRIES = 2000; // 记忆少于该条数时始终精确检索
+EmbeddingManager.ANN_NPROBE = 8; // 近似检索时检索的聚类数
+
 // 创建全局实例（可选）
 const embeddingManagerInstance = new EmbeddingManager();
 